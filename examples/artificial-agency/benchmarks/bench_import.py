@@ -0,0 +1,50 @@
+"""Time a cold import of the client in fresh interpreters.
+
+Usage:
+    uv run python benchmarks/bench_import.py [--runs 9] [--module MODULE]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+CODE = """\
+import time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+from artificial_agency import _requests, api_types
+_requests.GenerateTextRequest(cue="Hello").to_json()
+api_types.TextGenerated.model_validate_json(b'{{"moment_id": "1", "text": "Hi"}}')
+print(imported - started, time.perf_counter() - started)
+"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=9)
+    parser.add_argument("--module", default="artificial_agency.client")
+    args = parser.parse_args()
+
+    imports, first_calls = [], []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-c", CODE.format(module=args.module)],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        imported, first_call = map(float, output.split())
+        imports.append(imported * 1000)
+        first_calls.append(first_call * 1000)
+
+    for label, times in [
+        (f"import {args.module}", imports),
+        ("import + first generate_text", first_calls),
+    ]:
+        print(f"{label:<40}{statistics.median(times):8.1f} ms (median)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Time building and validating a batch of game messages.
+
+Usage:
+    uv run python benchmarks/bench_messages.py [--messages 10000] [--repeat 5]
+"""
+
+import argparse
+import json
+import time
+
+from artificial_agency import _requests, api_types
+
+
+def make_payloads(count: int) -> list[dict]:
+    payloads = []
+    for i in range(count):
+        if i % 2:
+            payload = {"message_type": "KVMessage", "key": f"npc.{i}", "value": "idle"}
+        else:
+            payload = {"message_type": "ContentMessage", "content": f"Event {i}: snow."}
+        payloads.append(payload)
+    return payloads
+
+
+def best_of(repeat: int, func) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.messages)
+    body = json.dumps({"messages": payloads})
+
+    def construct():
+        return [
+            api_types.KVMessage(key=p["key"], value=p["value"])
+            if p["message_type"] == "KVMessage"
+            else api_types.ContentMessage(content=p["content"])
+            for p in payloads
+        ]
+
+    def validate_batch():
+        return _requests.AddMessagesRequest.model_validate_json(body)
+
+    messages = construct()
+
+    def encode_batch():
+        return _requests.AddMessagesRequest(messages=messages).to_json()
+
+    for name, func in [
+        ("construct", construct),
+        ("validate JSON batch", validate_batch),
+        ("encode batch", encode_batch),
+    ]:
+        seconds = best_of(args.repeat, func)
+        per_message = seconds / args.messages * 1e6
+        print(f"{name:<22}{seconds * 1000:9.2f} ms {per_message:8.2f} us/message")
+
+
+if __name__ == "__main__":
+    main()
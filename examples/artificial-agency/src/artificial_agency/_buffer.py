@@ -0,0 +1,101 @@
+"""Per-agent buffer of messages waiting to be sent with the next request."""
+
+from __future__ import annotations
+
+import contextlib
+import threading
+import time
+from typing import Iterator, Sequence
+
+from artificial_agency import _types, api_types
+
+AgentKey = tuple[str, str]
+
+
+class MessageBuffer:
+    """Messages queued per (session_id, agent_id) by `buffer_messages`.
+
+    They are sent ahead of the messages of the agent's next generate_* or
+    add_messages request, or on their own once an agent has `max_messages`
+    pending or its oldest pending message is `max_age` seconds old.
+    """
+
+    def __init__(self, max_messages: int, max_age: float | None):
+        if max_messages < 1:
+            raise ValueError("message_buffer_size must be at least 1")
+        self.max_messages = max_messages
+        self.max_age = max_age
+        # key -> (monotonic time of the oldest message, messages)
+        self._pending: dict[AgentKey, tuple[float, list[api_types.GameMessage]]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(messages) for _, messages in self._pending.values())
+
+    def add(
+        self, key: AgentKey, messages: Sequence[api_types.GameMessage]
+    ) -> list[api_types.GameMessage] | None:
+        """Queue messages; returns all of the agent's messages if they are due now."""
+        with self._lock:
+            added, pending = self._pending.setdefault(key, (time.monotonic(), []))
+            pending.extend(messages)
+            if len(pending) >= self.max_messages or self._expired(added):
+                del self._pending[key]
+                return pending
+        return None
+
+    def take(self, key: AgentKey) -> list[api_types.GameMessage]:
+        """Remove and return the agent's pending messages."""
+        with self._lock:
+            _, pending = self._pending.pop(key, (0.0, []))
+        return pending
+
+    def take_all(self) -> list[tuple[AgentKey, list[api_types.GameMessage]]]:
+        with self._lock:
+            pending = [(key, messages) for key, (_, messages) in self._pending.items()]
+            self._pending.clear()
+        return pending
+
+    def take_due(self) -> list[tuple[AgentKey, list[api_types.GameMessage]]]:
+        """Remove and return the pending messages that have reached `max_age`."""
+        with self._lock:
+            due = [
+                key for key, (added, _) in self._pending.items() if self._expired(added)
+            ]
+            return [(key, self._pending.pop(key)[1]) for key in due]
+
+    def restore(self, key: AgentKey, messages: list[api_types.GameMessage]) -> None:
+        """Put messages that could not be sent back in front of the agent's queue."""
+        if not messages:
+            return
+        with self._lock:
+            added, pending = self._pending.get(key, (time.monotonic(), []))
+            self._pending[key] = (added, messages + pending)
+
+    @contextlib.contextmanager
+    def attach(
+        self,
+        key: AgentKey,
+        messages: Sequence[api_types.GameMessage] | type[_types.NotGiven],
+    ) -> Iterator[Sequence[api_types.GameMessage] | type[_types.NotGiven]]:
+        """Prepend the agent's pending messages to a request's messages.
+
+        If the request fails they are restored, so they go with the next one.
+        """
+        pending = self.take(key)
+        if not pending:
+            yield messages
+            return
+        if messages is not _types.NotGiven:
+            pending_and_new = [*pending, *messages]
+        else:
+            pending_and_new = pending
+        try:
+            yield pending_and_new
+        except Exception:
+            self.restore(key, pending)
+            raise
+
+    def _expired(self, added: float) -> bool:
+        return self.max_age is not None and time.monotonic() - added >= self.max_age
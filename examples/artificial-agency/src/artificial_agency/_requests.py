@@ -1,31 +1,51 @@
 """Types representing requests sent to the Artificial.Agency API."""
 
-from typing import Any, Sequence
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Sequence
 
 import pydantic
 
-from artificial_agency import _types, api_types
+from artificial_agency import _types
+
+if TYPE_CHECKING:
+    # the annotations below resolve `api_types` in model_rebuild, so that
+    # defining the requests does not import the generated types they name.
+    from artificial_agency import api_types
 
 
 class APIRequest(pydantic.BaseModel):
     model_config = {
         "arbitrary_types_allowed": True,
+        "defer_build": True,
     }
 
+    @pydantic.model_validator(mode="before")
+    @classmethod
+    def _drop_not_given(cls, data: Any) -> Any:
+        # arguments given as NotGiven are left unset, so that serializing with
+        # exclude_unset leaves them out without looking at every field.
+        if isinstance(data, dict):
+            return {k: v for k, v in data.items() if v is not _types.NotGiven}
+        return data
+
+    @classmethod
+    def model_rebuild(cls, **kwargs: Any) -> bool | None:
+        # pydantic calls this to build a deferred model on first use.
+        from artificial_agency import api_types
+
+        kwargs.setdefault("_types_namespace", {"api_types": api_types})
+        return super().model_rebuild(**kwargs)
+
     def model_dump(self, **kwargs):
-        exclude = kwargs.get("exclude", set())
-
-        # Find fields with NotGiven values and add them to exclude
-        for field_name, field_value in self.__dict__.items():
-            if field_value is _types.NotGiven:
-                if isinstance(exclude, set):
-                    exclude.add(field_name)
-                else:
-                    exclude = set(exclude)
-                    exclude.add(field_name)
-        kwargs["exclude"] = exclude
         return super().model_dump(**kwargs, exclude_unset=True)
 
+    def to_json(self) -> bytes:
+        """Encode the request body as it is sent to the API."""
+        return self.__pydantic_serializer__.to_json(
+            self, by_alias=True, exclude_unset=True
+        )
+
 
 class CreateSessionRequest(APIRequest):
     project_id: str
@@ -53,17 +73,17 @@ class CreateAgentRequest(APIRequest):
 
 
 class AddMessagesRequest(APIRequest):
-    messages: Sequence[api_types.GameMessage]
+    messages: list[api_types.GameMessage]
 
 
 class UpdateHistoryRequest(APIRequest):
     """Deprecated: use add_messages() and AddMessagesRequest instead."""
 
-    messages: Sequence[api_types.GameMessage]
+    messages: list[api_types.GameMessage]
 
 
 class GenerateTextRequest(APIRequest):
-    messages: Sequence[api_types.GameMessage] | type[_types.NotGiven] = _types.NotGiven
+    messages: list[api_types.GameMessage] | type[_types.NotGiven] = _types.NotGiven
     cue: str | None | type[_types.NotGiven] = _types.NotGiven
     service_id: str | None | type[_types.NotGiven] = _types.NotGiven
     presentation_config: api_types.PresentationConfig | type[_types.NotGiven] = (
@@ -72,8 +92,8 @@ class GenerateTextRequest(APIRequest):
 
 
 class GenerateFunctionCallRequest(APIRequest):
-    messages: Sequence[api_types.GameMessage] | type[_types.NotGiven] = _types.NotGiven
-    functions: Sequence[api_types.FunctionDescription]
+    messages: list[api_types.GameMessage] | type[_types.NotGiven] = _types.NotGiven
+    functions: list[api_types.FunctionDescription]
     cue: str | None | type[_types.NotGiven] = _types.NotGiven
     service_id: str | None | type[_types.NotGiven] = _types.NotGiven
     presentation_config: api_types.PresentationConfig | type[_types.NotGiven] = (
@@ -82,7 +102,7 @@ class GenerateFunctionCallRequest(APIRequest):
 
 
 class GenerateJSONRequest(APIRequest):
-    messages: Sequence[api_types.GameMessage] | type[_types.NotGiven] = _types.NotGiven
+    messages: list[api_types.GameMessage] | type[_types.NotGiven] = _types.NotGiven
     # the name "schema" is used internally by pydantic.
     schema_: dict[str, Any] = pydantic.Field(alias="schema")
     cue: str | None | type[_types.NotGiven] = _types.NotGiven
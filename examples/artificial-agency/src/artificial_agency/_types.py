@@ -1,7 +1,7 @@
 """Types used internally by this library."""
 
 import typing
-from typing import Self, final
+from typing import Any, ClassVar, Self, final
 
 import pydantic
 
@@ -14,6 +14,29 @@ class NotGiven:
 
 
 class GeneratedModel(pydantic.BaseModel):
+    # build the validator and serializer on first use, so importing the
+    # generated modules does not pay for models a process never touches.
+    model_config = pydantic.ConfigDict(defer_build=True)
+
+    # (field name, value) for every field whose type is a single-value
+    # `Literal`, worked out once per class by __pydantic_init_subclass__.
+    __literal_fields__: ClassVar[tuple[tuple[str, Any], ...]] = ()
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs: Any) -> None:
+        super().__pydantic_init_subclass__(**kwargs)
+        literal_fields = []
+        for k, v in cls.model_fields.items():
+            if v.annotation:
+                """
+                …:Literal[…]
+                """
+                if typing.get_origin(v.annotation) == typing.Literal:
+                    literal_value = typing.get_args(v.annotation)
+                    if len(literal_value) == 1:
+                        literal_fields.append((k, literal_value[0]))
+        cls.__literal_fields__ = tuple(literal_fields)
+
     @pydantic.model_validator(mode="after")
     def explicitly_set_literals(self) -> Self:
         """Explicitly set any fields with a `Literal` type.
@@ -24,13 +47,10 @@ class GeneratedModel(pydantic.BaseModel):
 
             type: Literal["openai/llm"] = pydantic.Field(default="openai/llm")
         """
-        for k, v in self.model_fields.items():
-            if v.annotation:
-                """
-                …:Literal[…]
-                """
-                if typing.get_origin(v.annotation) == typing.Literal:
-                    literal_value = typing.get_args(v.annotation)
-                    if len(literal_value) == 1:
-                        setattr(self, k, literal_value[0])
+        literal_fields = self.__literal_fields__
+        if literal_fields:
+            # the same as setattr() for each field, without the per-call
+            # validate_assignment and private attribute checks.
+            self.__dict__.update(literal_fields)
+            self.__pydantic_fields_set__.update(k for k, _ in literal_fields)
         return self
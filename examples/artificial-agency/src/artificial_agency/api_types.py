@@ -1,77 +1,164 @@
 """Types that are part of this library's public interface."""
 
-from typing import Any, TypeAlias
+import importlib
+from typing import TYPE_CHECKING, Any, TypeAlias
 
 import pydantic
 
-from artificial_agency.generated_api_types import (
-    function_description,
-    introspection,
-    presentation_config,
-    role_config,
-    service_config,
-    ui_config,
-)
-
-# re-export generated types
-from artificial_agency.generated_api_types.component_config import (
-    FunctionHinterConfig,
-    KVStoreConfig,
-    LimitedListConfig,
-    PuppeteerKVStoreConfig,
-    PuppeteerLimitedListConfig,
-    StaticTextConfig,
-    TextBlockConfig,
-)
-from artificial_agency.generated_api_types.function_description import (
-    ArrayParameter,
-    ObjectParameter,
-    SimpleParameter,
-)
-from artificial_agency.generated_api_types.messages import (
-    ContentMessage,
-    FunctionCall,
-    KVDelTreeMessage,
-    KVMessage,
-    PuppeteerMessage,
-    Type,
-)
-
-# re-exported types
-FunctionDescription = function_description.FunctionDescription
-PresentationConfig = presentation_config.PresentationConfig
-PresentationOrderItem = presentation_config.PresentationOrderItem
-RoleConfig = role_config.RoleConfig
-UIConfig = ui_config.UIConfig
-
-# re-exported introspection types
-Service = introspection.Service
-
-# unions
-ComponentConfig: TypeAlias = (
-    FunctionHinterConfig
-    | KVStoreConfig
-    | LimitedListConfig
-    | PuppeteerKVStoreConfig
-    | PuppeteerLimitedListConfig
-    | StaticTextConfig
-    | TextBlockConfig
-)
-ServiceConfig: TypeAlias = service_config.ServiceConfig
-FunctionParameters: TypeAlias = SimpleParameter | ArrayParameter | ObjectParameter
-
-
-GameMessage: TypeAlias = (
-    ContentMessage | KVMessage | KVDelTreeMessage | PuppeteerMessage
-)
-
-
-FunctionCall = FunctionCall
-FunctionResultType = Type
+# the response models below need these two; everything else generated is
+# imported on first use by __getattr__.
+from artificial_agency.generated_api_types import introspection, ui_config
+
+if TYPE_CHECKING:
+    from artificial_agency.generated_api_types import (
+        function_description,
+        presentation_config,
+        role_config,
+        service_config,
+    )
+    from artificial_agency.generated_api_types.component_config import (
+        FunctionHinterConfig,
+        KVStoreConfig,
+        LimitedListConfig,
+        PuppeteerKVStoreConfig,
+        PuppeteerLimitedListConfig,
+        StaticTextConfig,
+        TextBlockConfig,
+    )
+    from artificial_agency.generated_api_types.function_description import (
+        ArrayParameter,
+        ObjectParameter,
+        SimpleParameter,
+    )
+    from artificial_agency.generated_api_types.messages import (
+        ContentMessage,
+        FunctionCall,
+        KVDelTreeMessage,
+        KVMessage,
+        PuppeteerMessage,
+        Type,
+    )
+
+    # re-exported types
+    FunctionDescription = function_description.FunctionDescription
+    PresentationConfig = presentation_config.PresentationConfig
+    PresentationOrderItem = presentation_config.PresentationOrderItem
+    RoleConfig = role_config.RoleConfig
+    UIConfig = ui_config.UIConfig
+
+    # re-exported introspection types
+    Service = introspection.Service
+
+    # unions
+    ComponentConfig: TypeAlias = (
+        FunctionHinterConfig
+        | KVStoreConfig
+        | LimitedListConfig
+        | PuppeteerKVStoreConfig
+        | PuppeteerLimitedListConfig
+        | StaticTextConfig
+        | TextBlockConfig
+    )
+    ServiceConfig: TypeAlias = service_config.ServiceConfig
+    FunctionParameters: TypeAlias = SimpleParameter | ArrayParameter | ObjectParameter
+
+    GameMessage: TypeAlias = (
+        ContentMessage | KVMessage | KVDelTreeMessage | PuppeteerMessage
+    )
+
+    FunctionResultType = Type
+
+# re-exported generated types: name -> (module in generated_api_types, name there)
+_REEXPORTS = {
+    **{
+        name: ("component_config", name)
+        for name in (
+            "FunctionHinterConfig",
+            "KVStoreConfig",
+            "LimitedListConfig",
+            "PuppeteerKVStoreConfig",
+            "PuppeteerLimitedListConfig",
+            "StaticTextConfig",
+            "TextBlockConfig",
+        )
+    },
+    **{
+        name: ("function_description", name)
+        for name in ("ArrayParameter", "ObjectParameter", "SimpleParameter")
+    },
+    **{
+        name: ("messages", name)
+        for name in (
+            "ContentMessage",
+            "FunctionCall",
+            "KVDelTreeMessage",
+            "KVMessage",
+            "PuppeteerMessage",
+            "Type",
+        )
+    },
+    "FunctionDescription": ("function_description", "FunctionDescription"),
+    "PresentationConfig": ("presentation_config", "PresentationConfig"),
+    "PresentationOrderItem": ("presentation_config", "PresentationOrderItem"),
+    "RoleConfig": ("role_config", "RoleConfig"),
+    "UIConfig": ("ui_config", "UIConfig"),
+    "Service": ("introspection", "Service"),
+    "ServiceConfig": ("service_config", "ServiceConfig"),
+    "FunctionResultType": ("messages", "Type"),
+    # modules that used to be imported here
+    "function_description": ("function_description", None),
+    "presentation_config": ("presentation_config", None),
+    "role_config": ("role_config", None),
+    "service_config": ("service_config", None),
+}
+
+# unions of re-exported types: name -> members
+_UNIONS = {
+    "ComponentConfig": (
+        "FunctionHinterConfig",
+        "KVStoreConfig",
+        "LimitedListConfig",
+        "PuppeteerKVStoreConfig",
+        "PuppeteerLimitedListConfig",
+        "StaticTextConfig",
+        "TextBlockConfig",
+    ),
+    "FunctionParameters": ("SimpleParameter", "ArrayParameter", "ObjectParameter"),
+    "GameMessage": (
+        "ContentMessage",
+        "KVMessage",
+        "KVDelTreeMessage",
+        "PuppeteerMessage",
+    ),
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in _REEXPORTS:
+        module_name, attribute = _REEXPORTS[name]
+        value = importlib.import_module(
+            f"artificial_agency.generated_api_types.{module_name}"
+        )
+        if attribute is not None:
+            value = getattr(value, attribute)
+    elif name in _UNIONS:
+        members = [__getattr__(member) for member in _UNIONS[name]]
+        value = members[0]
+        for member in members[1:]:
+            value = value | member
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # cache it, so later lookups are plain module attributes.
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted({*globals(), *_REEXPORTS, *_UNIONS})
 
 
 class APIResponse(pydantic.BaseModel):
-    pass
+    model_config = pydantic.ConfigDict(defer_build=True)
 
 
 class Session(APIResponse):
@@ -114,6 +201,8 @@ class TextGenerated(APIResponse):
 
 class FunctionCallGenerated(APIResponse):
     class FunctionCall(pydantic.BaseModel):
+        model_config = pydantic.ConfigDict(defer_build=True)
+
         id: str
         name: str
         args: dict[str, Any]
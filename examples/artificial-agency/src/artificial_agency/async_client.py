@@ -1,14 +1,36 @@
+from __future__ import annotations
+
+import asyncio
+import copy
 import dataclasses
 import warnings
-from typing import Any, Sequence, TypeVar
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Generic,
+    Self,
+    Sequence,
+    TypeVar,
+)
 
 import httpx
 import pydantic
 
-from artificial_agency import _requests, _types, api_types, constants, errors
-from artificial_agency.generated_api_types import error as error_api_type
+from artificial_agency import (
+    _buffer,
+    _requests,
+    _types,
+    api_types,
+    constants,
+    errors,
+    retries,
+)
+from artificial_agency import validation as validation_modes
 
 ResponseT = TypeVar("ResponseT", bound=api_types.APIResponse)
+ResultT = TypeVar("ResultT")
 
 
 @dataclasses.dataclass
@@ -19,6 +41,21 @@ class Agent:
     moment_uuid: str
 
 
+@dataclasses.dataclass
+class BulkResult(Generic[ResultT]):
+    """The outcome of one call made by an AsyncClient `*_many` method."""
+
+    # position of the target in the list that was passed in.
+    index: int
+    target: Agent | dict[str, Any]
+    result: ResultT | None = None
+    error: Exception | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
 class AsyncClient:
     def __init__(
         self,
@@ -27,13 +64,145 @@ class AsyncClient:
         base_url: str = constants.API_URL,
         http_client: httpx.AsyncClient | None = None,
         timeout: int | float = constants.DEFAULT_REQUEST_TIMEOUT,
+        max_connections: int | None = constants.DEFAULT_MAX_CONNECTIONS,
+        max_keepalive_connections: int | None = (
+            constants.DEFAULT_MAX_KEEPALIVE_CONNECTIONS
+        ),
+        keepalive_expiry: float | None = constants.DEFAULT_KEEPALIVE_EXPIRY,
+        http2: bool = False,
+        retry_policy: retries.RetryPolicy = retries.NO_RETRIES,
+        message_buffer_size: int = constants.DEFAULT_MESSAGE_BUFFER_SIZE,
+        message_buffer_max_age: float | None = constants.DEFAULT_MESSAGE_BUFFER_MAX_AGE,
+        validation: validation_modes.ValidationMode = "strict",
     ):
+        """Create a client.
+
+        Args:
+            api_key: Your Artificial.Agency API key.
+            base_url: The API to talk to.
+            http_client:
+                An httpx client to send requests with. The connection options
+                below are ignored when this is given, and the client is left
+                open by `aclose()`.
+            timeout: Seconds to wait for each request.
+            max_connections:
+                Connections the pool may open at once; "None" for no limit.
+            max_keepalive_connections:
+                Idle connections kept open for reuse; "None" for no limit.
+            keepalive_expiry:
+                Seconds an idle connection is kept; "None" to keep it forever.
+            http2:
+                Multiplex requests over HTTP/2 connections. Needs the `h2`
+                package (`httpx[http2]`).
+            retry_policy:
+                When failed requests are retried; by default they are not.
+                Pass `retries.RetryPolicy()` to turn retrying on. Calls that
+                create state (all POSTs) are only resent when the API cannot
+                have processed them, unless the policy sets
+                `retry_non_idempotent`.
+            message_buffer_size:
+                Messages an agent may have queued by `buffer_messages` before
+                they are sent on their own.
+            message_buffer_max_age:
+                Seconds a queued message may wait for the agent's next request
+                before it is sent on its own; "None" for no limit.
+            validation:
+                How responses become models: "strict" validates them, "trusted"
+                builds them without validation and "lazy" validates each field
+                when it is first read. See `artificial_agency.validation`.
+        """
         if not api_key:
             raise ValueError("api_key must not be empty")
 
         self.api_key = api_key
-        self.http_client = http_client or httpx.AsyncClient(base_url=base_url)
+        self._owns_http_client = http_client is None
+        self.http_client = http_client or httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+        )
         self.timeout = timeout
+        self.validation = validation_modes.check_mode(validation)
+        self.retry_policy = retry_policy
+        self._retry_budget = retries.RetryBudget.for_policy(retry_policy)
+        self._message_buffer = _buffer.MessageBuffer(
+            message_buffer_size, message_buffer_max_age
+        )
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        # while an exception propagates, a failing flush must not replace it
+        await self.aclose(flush=exc_info[0] is None)
+
+    async def aclose(self, flush: bool = True) -> None:
+        """Send any buffered messages, then close the connection pool.
+
+        The pool is closed even if sending fails, and is left open if the
+        httpx client was passed in.
+
+        Args:
+            flush: Send buffered messages first; otherwise they are dropped
+                with a warning.
+        """
+        try:
+            if flush:
+                await self.flush_messages()
+            else:
+                self._drop_buffered_messages()
+        finally:
+            if self._owns_http_client:
+                await self.http_client.aclose()
+
+    def _drop_buffered_messages(self) -> None:
+        dropped = sum(len(messages) for _, messages in self._message_buffer.take_all())
+        if dropped:
+            warnings.warn(
+                f"{dropped} buffered message(s) were dropped: the client was "
+                "closed without flushing them.",
+                RuntimeWarning,
+                stacklevel=3,
+            )
+
+    async def warm(self, connections: int = 1) -> int:
+        """Open connections to the API ahead of the first call.
+
+        Sends `connections` concurrent HEAD requests so that the TCP and TLS
+        handshakes are done before the first real request needs them.
+
+        Args:
+            connections: How many pooled connections to open; 0 or less does nothing.
+
+        Returns:
+            How many requests got a response; failures are not raised.
+        """
+        if connections < 1:
+            return 0
+        results = await asyncio.gather(*(self._warm_one() for _ in range(connections)))
+        return sum(results)
+
+    async def _warm_one(self) -> bool:
+        try:
+            await self.http_client.head("/", timeout=self.timeout)
+        except httpx.HTTPError:
+            return False
+        return True
+
+    def with_validation(self, mode: validation_modes.ValidationMode) -> Self:
+        """A view of this client that uses another validation mode.
+
+        It shares the connection pool, retry budget and message buffer, e.g.
+        `client.with_validation("trusted").generate_text(...)`.
+        """
+        view = copy.copy(self)
+        view.validation = validation_modes.check_mode(mode)
+        view._owns_http_client = False
+        return view
 
     def _build_request(
         self,
@@ -42,19 +211,22 @@ class AsyncClient:
         path: str,
         data: _requests.APIRequest | None,
     ) -> httpx.Request:
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "AA-API-Version": constants.API_VERSION,
+        }
         if data:
-            request_json = data.model_dump(mode="json", by_alias=True)
+            # serialized straight to bytes instead of via a dict of JSON values
+            content = data.to_json()
+            headers["Content-Type"] = "application/json"
         else:
-            request_json = None
+            content = None
 
         return self.http_client.build_request(
             method=method,
             url=path,
-            headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "AA-API-Version": constants.API_VERSION,
-            },
-            json=request_json,
+            headers=headers,
+            content=content,
             timeout=self.timeout,
         )
 
@@ -67,15 +239,43 @@ class AsyncClient:
         return_type: type[ResponseT],
     ) -> ResponseT:
         request = self._build_request(method=method, path=path, data=data)
+        idempotent = method in retries.IDEMPOTENT_METHODS
+        self._retry_budget.record_request()
 
-        try:
-            response = await self.http_client.send(request)
-        except httpx.TimeoutException:
-            raise errors.APITimeoutError(
-                status_code=500, error_type="server_error", message="Request timed out."
-            )
+        attempt = 0
+        while True:
+            try:
+                response = await self.http_client.send(request)
+            except httpx.TransportError as e:
+                delay = self.retry_policy.retry_delay(
+                    attempt, idempotent=idempotent, budget=self._retry_budget, error=e
+                )
+                if delay is None:
+                    if isinstance(e, httpx.TimeoutException):
+                        raise errors.APITimeoutError(
+                            status_code=500,
+                            error_type="server_error",
+                            message="Request timed out.",
+                        )
+                    raise
+            else:
+                if response.status_code == 200:
+                    break
+                delay = self.retry_policy.retry_delay(
+                    attempt,
+                    idempotent=idempotent,
+                    budget=self._retry_budget,
+                    response=response,
+                )
+                if delay is None:
+                    break
+            attempt += 1
+            await asyncio.sleep(delay)
 
         if response.status_code != 200:
+            # imported here so that clients that never see an error never load it.
+            from artificial_agency.generated_api_types import error as error_api_type
+
             try:
                 error = error_api_type.ErrorResponseModel.model_validate_json(
                     response.content
@@ -94,8 +294,10 @@ class AsyncClient:
             )
 
         try:
-            parsed = return_type.model_validate_json(response.content)
-        except pydantic.ValidationError:
+            parsed = validation_modes.parse_response(
+                return_type, response.content, self.validation, response.status_code
+            )
+        except (pydantic.ValidationError, ValueError):
             raise errors.APIResponseValidationError(
                 status_code=response.status_code,
                 error_type="server_error",
@@ -289,21 +491,116 @@ class AsyncClient:
     ) -> api_types.MessagesAdded:
         """Update the agent state with new messages.
 
+        Messages queued for this agent with `buffer_messages` are sent ahead
+        of `messages`.
+
         Args:
             session_id: The session that this agent exists within.
             agent_id: The agent to target.
             messages: New history to store.
         """
-        request = _requests.AddMessagesRequest(messages=messages)
+        with self._message_buffer.attach((session_id, agent_id), messages) as messages:
+            request = _requests.AddMessagesRequest(messages=messages)
+
+            result = await self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/messages",
+                data=request,
+                return_type=api_types.MessagesAdded,
+            )
 
-        result = await self._process_request(
-            method="POST",
-            path=f"/v1/sessions/{session_id}/agents/{agent_id}/messages",
-            data=request,
-            return_type=api_types.MessagesAdded,
-        )
+            return result
 
-        return result
+    async def buffer_messages(
+        self,
+        *,
+        session_id: str,
+        agent_id: str,
+        messages: Sequence[api_types.GameMessage],
+    ) -> api_types.MessagesAdded | None:
+        """Queue messages to be sent with the agent's next request.
+
+        Instead of a request per game event, the messages wait locally and go
+        ahead of the `messages` of the agent's next generate_* or add_messages
+        call. They are sent on their own with `add_messages` once the agent has
+        `message_buffer_size` queued, or when the oldest has waited
+        `message_buffer_max_age` seconds; that limit is checked here and by
+        `flush_due_messages`. If the request they go with fails, they stay
+        queued for the next one.
+
+        Args:
+            session_id: The session that this agent exists within.
+            agent_id: The agent to target.
+            messages: New history to store.
+
+        Returns:
+            The `add_messages` result if the queue was sent, otherwise None.
+        """
+        key = (session_id, agent_id)
+        due = self._message_buffer.add(key, messages)
+        if due is None:
+            return None
+        return await self._send_buffered(key, due)
+
+    async def flush_messages(
+        self,
+        *,
+        session_id: str | None = None,
+        agent_id: str | None = None,
+    ) -> list[api_types.MessagesAdded]:
+        """Send queued messages now, for one agent or (by default) every agent.
+
+        Args:
+            session_id: The session of the agent to flush.
+            agent_id: The agent to flush.
+        """
+        if session_id is not None or agent_id is not None:
+            if session_id is None or agent_id is None:
+                raise ValueError("session_id and agent_id must be given together")
+            key = (session_id, agent_id)
+            pending = [(key, self._message_buffer.take(key))]
+        else:
+            pending = self._message_buffer.take_all()
+        return await self._send_all_buffered(pending)
+
+    async def flush_due_messages(self) -> list[api_types.MessagesAdded]:
+        """Send the queues whose oldest message reached `message_buffer_max_age`.
+
+        Call this periodically (e.g. once per game tick) so that messages for
+        agents that go quiet are not held indefinitely.
+        """
+        return await self._send_all_buffered(self._message_buffer.take_due())
+
+    async def _send_all_buffered(
+        self,
+        pending: list[tuple[tuple[str, str], list[api_types.GameMessage]]],
+    ) -> list[api_types.MessagesAdded]:
+        results = []
+        for index, (key, messages) in enumerate(pending):
+            if not messages:
+                continue
+            try:
+                results.append(await self._send_buffered(key, messages))
+            except Exception:
+                for later_key, later_messages in pending[index + 1 :]:
+                    self._message_buffer.restore(later_key, later_messages)
+                raise
+        return results
+
+    async def _send_buffered(
+        self, key: tuple[str, str], messages: list[api_types.GameMessage]
+    ) -> api_types.MessagesAdded:
+        session_id, agent_id = key
+        try:
+            return await self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/messages",
+                data=_requests.AddMessagesRequest(messages=messages),
+                return_type=api_types.MessagesAdded,
+            )
+        except Exception:
+            self._message_buffer.restore(key, messages)
+            raise
 
     async def generate_text(
         self,
@@ -321,26 +618,30 @@ class AsyncClient:
     ) -> api_types.TextGenerated:
         """Ask the agent to generate text.
 
+        Messages queued for this agent with `buffer_messages` are sent ahead
+        of `messages`.
+
         Args:
             session_id: The session that this agent exists within.
             agent_id: The agent to target.
             messages: New history to process before generating text.
             cue: Optional text that can be used to prompt the agent.
         """
-        payload = _requests.GenerateTextRequest(
-            messages=messages,
-            cue=cue,
-            service_id=service_id,
-            presentation_config=presentation_config,
-        )
-        result = await self._process_request(
-            method="POST",
-            path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_text",
-            data=payload,
-            return_type=api_types.TextGenerated,
-        )
+        with self._message_buffer.attach((session_id, agent_id), messages) as messages:
+            payload = _requests.GenerateTextRequest(
+                messages=messages,
+                cue=cue,
+                service_id=service_id,
+                presentation_config=presentation_config,
+            )
+            result = await self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_text",
+                data=payload,
+                return_type=api_types.TextGenerated,
+            )
 
-        return result
+            return result
 
     async def generate_function_call(
         self,
@@ -359,6 +660,9 @@ class AsyncClient:
     ) -> api_types.FunctionCallGenerated:
         """Ask the agent to generate a function call.
 
+        Messages queued for this agent with `buffer_messages` are sent ahead
+        of `messages`.
+
         Args:
             session_id: The session that this agent exists within.
             agent_id: The agent to target.
@@ -366,21 +670,22 @@ class AsyncClient:
             messages: New history to use.
             cue: Optional text that can be used to prompt the agent.
         """
-        payload = _requests.GenerateFunctionCallRequest(
-            messages=messages,
-            functions=functions,
-            cue=cue,
-            service_id=service_id,
-            presentation_config=presentation_config,
-        )
-        result = await self._process_request(
-            method="POST",
-            path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_function_call",
-            data=payload,
-            return_type=api_types.FunctionCallGenerated,
-        )
+        with self._message_buffer.attach((session_id, agent_id), messages) as messages:
+            payload = _requests.GenerateFunctionCallRequest(
+                messages=messages,
+                functions=functions,
+                cue=cue,
+                service_id=service_id,
+                presentation_config=presentation_config,
+            )
+            result = await self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_function_call",
+                data=payload,
+                return_type=api_types.FunctionCallGenerated,
+            )
 
-        return result
+            return result
 
     async def generate_json(
         self,
@@ -399,6 +704,9 @@ class AsyncClient:
     ) -> api_types.JSONGenerated:
         """Ask the agent to generate text.
 
+        Messages queued for this agent with `buffer_messages` are sent ahead
+        of `messages`.
+
         Args:
             session_id: The session that this agent exists within.
             agent_id: The agent to target.
@@ -406,19 +714,181 @@ class AsyncClient:
             messages: New history to process before generating text.
             cue: Optional text that can be used to prompt the agent.
         """
-        payload = _requests.GenerateJSONRequest(
-            messages=messages,
-            schema=schema,
-            cue=cue,
-            service_id=service_id,
-            presentation_config=presentation_config,
-        )
+        with self._message_buffer.attach((session_id, agent_id), messages) as messages:
+            payload = _requests.GenerateJSONRequest(
+                messages=messages,
+                schema=schema,
+                cue=cue,
+                service_id=service_id,
+                presentation_config=presentation_config,
+            )
 
-        result = await self._process_request(
-            method="POST",
-            path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_json",
-            data=payload,
-            return_type=api_types.JSONGenerated,
-        )
+            result = await self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_json",
+                data=payload,
+                return_type=api_types.JSONGenerated,
+            )
 
-        return result
+            return result
+
+    def _many(
+        self,
+        call: Callable[..., Awaitable[ResultT]],
+        targets: Sequence[Agent | dict[str, Any]],
+        concurrency: int,
+        common: dict[str, Any],
+    ) -> AsyncIterator[BulkResult[ResultT]]:
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        return _fan_out(call, targets, concurrency, common)
+
+    def create_agent_many(
+        self,
+        targets: Sequence[dict[str, Any]],
+        *,
+        concurrency: int = constants.DEFAULT_BULK_CONCURRENCY,
+        **common: Any,
+    ) -> AsyncIterator[BulkResult[Agent]]:
+        """Create many agents, at most `concurrency` at a time.
+
+        Args:
+            targets: `create_agent` arguments for each agent.
+            concurrency: How many requests may be in flight at once.
+            common: `create_agent` arguments shared by every agent, e.g. `session_id`.
+
+        Yields:
+            A `BulkResult` per target as soon as its call finishes. A failed
+            call yields its exception in `error` and does not stop the others.
+        """
+        return self._many(self.create_agent, targets, concurrency, common)
+
+    def add_messages_many(
+        self,
+        targets: Sequence[Agent | dict[str, Any]],
+        *,
+        concurrency: int = constants.DEFAULT_BULK_CONCURRENCY,
+        **common: Any,
+    ) -> AsyncIterator[BulkResult[api_types.MessagesAdded]]:
+        """Add messages to many agents, at most `concurrency` at a time.
+
+        e.g. tell every agent in a session about the same event:
+
+            async for item in client.add_messages_many(agents, messages=[event]):
+                ...
+
+        Args:
+            targets:
+                Agents, or `add_messages` arguments for each call (such as
+                per-agent `messages`).
+            concurrency: How many requests may be in flight at once.
+            common:
+                `add_messages` arguments shared by every call; a target's own
+                arguments take precedence.
+
+        Yields:
+            A `BulkResult` per target as soon as its call finishes. A failed
+            call yields its exception in `error` and does not stop the others.
+        """
+        return self._many(self.add_messages, targets, concurrency, common)
+
+    def generate_text_many(
+        self,
+        targets: Sequence[Agent | dict[str, Any]],
+        *,
+        concurrency: int = constants.DEFAULT_BULK_CONCURRENCY,
+        **common: Any,
+    ) -> AsyncIterator[BulkResult[api_types.TextGenerated]]:
+        """Ask many agents to generate text, at most `concurrency` at a time.
+
+        Args:
+            targets: Agents, or `generate_text` arguments for each call.
+            concurrency: How many requests may be in flight at once.
+            common: `generate_text` arguments shared by every call, e.g. `cue`.
+
+        Yields:
+            A `BulkResult` per target as soon as its call finishes. A failed
+            call yields its exception in `error` and does not stop the others.
+        """
+        return self._many(self.generate_text, targets, concurrency, common)
+
+    def generate_function_call_many(
+        self,
+        targets: Sequence[Agent | dict[str, Any]],
+        *,
+        concurrency: int = constants.DEFAULT_BULK_CONCURRENCY,
+        **common: Any,
+    ) -> AsyncIterator[BulkResult[api_types.FunctionCallGenerated]]:
+        """Ask many agents for a function call, at most `concurrency` at a time.
+
+        Args:
+            targets: Agents, or `generate_function_call` arguments for each call.
+            concurrency: How many requests may be in flight at once.
+            common:
+                `generate_function_call` arguments shared by every call, e.g.
+                `functions`.
+
+        Yields:
+            A `BulkResult` per target as soon as its call finishes. A failed
+            call yields its exception in `error` and does not stop the others.
+        """
+        return self._many(self.generate_function_call, targets, concurrency, common)
+
+    def generate_json_many(
+        self,
+        targets: Sequence[Agent | dict[str, Any]],
+        *,
+        concurrency: int = constants.DEFAULT_BULK_CONCURRENCY,
+        **common: Any,
+    ) -> AsyncIterator[BulkResult[api_types.JSONGenerated]]:
+        """Ask many agents to generate JSON, at most `concurrency` at a time.
+
+        Args:
+            targets: Agents, or `generate_json` arguments for each call.
+            concurrency: How many requests may be in flight at once.
+            common: `generate_json` arguments shared by every call, e.g. `schema`.
+
+        Yields:
+            A `BulkResult` per target as soon as its call finishes. A failed
+            call yields its exception in `error` and does not stop the others.
+        """
+        return self._many(self.generate_json, targets, concurrency, common)
+
+
+def _target_kwargs(target: Agent | dict[str, Any]) -> dict[str, Any]:
+    if isinstance(target, Agent):
+        return {"session_id": target.session_id, "agent_id": target.agent_id}
+    return target
+
+
+async def _fan_out(
+    call: Callable[..., Awaitable[ResultT]],
+    targets: Sequence[Agent | dict[str, Any]],
+    concurrency: int,
+    common: dict[str, Any],
+) -> AsyncIterator[BulkResult[ResultT]]:
+    # a fixed set of workers pulls from one iterator, so a large village does
+    # not turn into thousands of pending tasks, and they wait for the caller
+    # once `concurrency` results are unread.
+    finished: asyncio.Queue[BulkResult[ResultT]] = asyncio.Queue(concurrency)
+    pending = enumerate(targets)
+
+    async def worker() -> None:
+        for index, target in pending:
+            item = BulkResult[ResultT](index=index, target=target)
+            try:
+                item.result = await call(**{**common, **_target_kwargs(target)})
+            except Exception as e:
+                item.error = e
+            await finished.put(item)
+
+    workers = [
+        asyncio.create_task(worker()) for _ in range(min(concurrency, len(targets)))
+    ]
+    try:
+        for _ in range(len(targets)):
+            yield await finished.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
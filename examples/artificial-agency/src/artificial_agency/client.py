@@ -1,12 +1,25 @@
+from __future__ import annotations
+
+import concurrent.futures
+import copy
 import dataclasses
+import time
 import warnings
-from typing import Any, Sequence, TypeVar
+from typing import Any, Self, Sequence, TypeVar
 
 import httpx
 import pydantic
 
-from artificial_agency import _requests, _types, api_types, constants, errors
-from artificial_agency.generated_api_types import error as error_api_type
+from artificial_agency import (
+    _buffer,
+    _requests,
+    _types,
+    api_types,
+    constants,
+    errors,
+    retries,
+)
+from artificial_agency import validation as validation_modes
 
 ResponseT = TypeVar("ResponseT", bound=api_types.APIResponse)
 
@@ -27,13 +40,145 @@ class Client:
         base_url: str = constants.API_URL,
         http_client: httpx.Client | None = None,
         timeout: int | float = constants.DEFAULT_REQUEST_TIMEOUT,
+        max_connections: int | None = constants.DEFAULT_MAX_CONNECTIONS,
+        max_keepalive_connections: int | None = (
+            constants.DEFAULT_MAX_KEEPALIVE_CONNECTIONS
+        ),
+        keepalive_expiry: float | None = constants.DEFAULT_KEEPALIVE_EXPIRY,
+        http2: bool = False,
+        retry_policy: retries.RetryPolicy = retries.NO_RETRIES,
+        message_buffer_size: int = constants.DEFAULT_MESSAGE_BUFFER_SIZE,
+        message_buffer_max_age: float | None = constants.DEFAULT_MESSAGE_BUFFER_MAX_AGE,
+        validation: validation_modes.ValidationMode = "strict",
     ):
+        """Create a client.
+
+        Args:
+            api_key: Your Artificial.Agency API key.
+            base_url: The API to talk to.
+            http_client:
+                An httpx client to send requests with. The connection options
+                below are ignored when this is given, and the client is left
+                open by `close()`.
+            timeout: Seconds to wait for each request.
+            max_connections:
+                Connections the pool may open at once; "None" for no limit.
+            max_keepalive_connections:
+                Idle connections kept open for reuse; "None" for no limit.
+            keepalive_expiry:
+                Seconds an idle connection is kept; "None" to keep it forever.
+            http2:
+                Multiplex requests over HTTP/2 connections. Needs the `h2`
+                package (`httpx[http2]`).
+            retry_policy:
+                When failed requests are retried; by default they are not.
+                Pass `retries.RetryPolicy()` to turn retrying on. Calls that
+                create state (all POSTs) are only resent when the API cannot
+                have processed them, unless the policy sets
+                `retry_non_idempotent`.
+            message_buffer_size:
+                Messages an agent may have queued by `buffer_messages` before
+                they are sent on their own.
+            message_buffer_max_age:
+                Seconds a queued message may wait for the agent's next request
+                before it is sent on its own; "None" for no limit.
+            validation:
+                How responses become models: "strict" validates them, "trusted"
+                builds them without validation and "lazy" validates each field
+                when it is first read. See `artificial_agency.validation`.
+        """
         if not api_key:
             raise ValueError("api_key must not be empty")
 
         self.api_key = api_key
-        self.http_client = http_client or httpx.Client(base_url=base_url)
+        self._owns_http_client = http_client is None
+        self.http_client = http_client or httpx.Client(
+            base_url=base_url,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+        )
         self.timeout = timeout
+        self.validation = validation_modes.check_mode(validation)
+        self.retry_policy = retry_policy
+        self._retry_budget = retries.RetryBudget.for_policy(retry_policy)
+        self._message_buffer = _buffer.MessageBuffer(
+            message_buffer_size, message_buffer_max_age
+        )
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        # while an exception propagates, a failing flush must not replace it
+        self.close(flush=exc_info[0] is None)
+
+    def close(self, flush: bool = True) -> None:
+        """Send any buffered messages, then close the connection pool.
+
+        The pool is closed even if sending fails, and is left open if the
+        httpx client was passed in.
+
+        Args:
+            flush: Send buffered messages first; otherwise they are dropped
+                with a warning.
+        """
+        try:
+            if flush:
+                self.flush_messages()
+            else:
+                self._drop_buffered_messages()
+        finally:
+            if self._owns_http_client:
+                self.http_client.close()
+
+    def _drop_buffered_messages(self) -> None:
+        dropped = sum(len(messages) for _, messages in self._message_buffer.take_all())
+        if dropped:
+            warnings.warn(
+                f"{dropped} buffered message(s) were dropped: the client was "
+                "closed without flushing them.",
+                RuntimeWarning,
+                stacklevel=3,
+            )
+
+    def warm(self, connections: int = 1) -> int:
+        """Open connections to the API ahead of the first call.
+
+        Sends `connections` concurrent HEAD requests so that the TCP and TLS
+        handshakes are done before the first real request needs them.
+
+        Args:
+            connections: How many pooled connections to open; 0 or less does nothing.
+
+        Returns:
+            How many requests got a response; failures are not raised.
+        """
+        if connections < 1:
+            return 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as pool:
+            return sum(pool.map(lambda _: self._warm_one(), range(connections)))
+
+    def _warm_one(self) -> bool:
+        try:
+            self.http_client.head("/", timeout=self.timeout)
+        except httpx.HTTPError:
+            return False
+        return True
+
+    def with_validation(self, mode: validation_modes.ValidationMode) -> Self:
+        """A view of this client that uses another validation mode.
+
+        It shares the connection pool, retry budget and message buffer, e.g.
+        `client.with_validation("trusted").generate_text(...)`.
+        """
+        view = copy.copy(self)
+        view.validation = validation_modes.check_mode(mode)
+        view._owns_http_client = False
+        return view
 
     def _build_request(
         self,
@@ -43,20 +188,23 @@ class Client:
         data: _requests.APIRequest | None,
         params: httpx.QueryParams | None = None,
     ) -> httpx.Request:
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "AA-API-Version": constants.API_VERSION,
+        }
         if data:
-            request_json = data.model_dump(mode="json", by_alias=True)
+            # serialized straight to bytes instead of via a dict of JSON values
+            content = data.to_json()
+            headers["Content-Type"] = "application/json"
         else:
-            request_json = None
+            content = None
 
         return self.http_client.build_request(
             method=method,
             url=path,
-            headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "AA-API-Version": constants.API_VERSION,
-            },
+            headers=headers,
             params=params,
-            json=request_json,
+            content=content,
             timeout=self.timeout,
         )
 
@@ -72,14 +220,43 @@ class Client:
         request = self._build_request(
             method=method, path=path, data=data, params=params
         )
-        try:
-            response = self.http_client.send(request)
-        except httpx.TimeoutException:
-            raise errors.APITimeoutError(
-                status_code=500, error_type="server_error", message="Request timed out."
-            )
+        idempotent = method in retries.IDEMPOTENT_METHODS
+        self._retry_budget.record_request()
+
+        attempt = 0
+        while True:
+            try:
+                response = self.http_client.send(request)
+            except httpx.TransportError as e:
+                delay = self.retry_policy.retry_delay(
+                    attempt, idempotent=idempotent, budget=self._retry_budget, error=e
+                )
+                if delay is None:
+                    if isinstance(e, httpx.TimeoutException):
+                        raise errors.APITimeoutError(
+                            status_code=500,
+                            error_type="server_error",
+                            message="Request timed out.",
+                        )
+                    raise
+            else:
+                if response.status_code == 200:
+                    break
+                delay = self.retry_policy.retry_delay(
+                    attempt,
+                    idempotent=idempotent,
+                    budget=self._retry_budget,
+                    response=response,
+                )
+                if delay is None:
+                    break
+            attempt += 1
+            time.sleep(delay)
 
         if response.status_code != 200:
+            # imported here so that clients that never see an error never load it.
+            from artificial_agency.generated_api_types import error as error_api_type
+
             try:
                 error = error_api_type.ErrorResponseModel.model_validate_json(
                     response.content
@@ -98,8 +275,10 @@ class Client:
             )
 
         try:
-            parsed = return_type.model_validate_json(response.content)
-        except pydantic.ValidationError:
+            parsed = validation_modes.parse_response(
+                return_type, response.content, self.validation, response.status_code
+            )
+        except (pydantic.ValidationError, ValueError):
             raise errors.APIResponseValidationError(
                 status_code=response.status_code,
                 error_type="server_error",
@@ -292,21 +471,116 @@ class Client:
     ) -> api_types.MessagesAdded:
         """Update the agent state with new messages.
 
+        Messages queued for this agent with `buffer_messages` are sent ahead
+        of `messages`.
+
         Args:
             session_id: The session that this agent exists within.
             agent_id: The agent to target.
             messages: New history to store.
         """
-        request = _requests.AddMessagesRequest(messages=messages)
+        with self._message_buffer.attach((session_id, agent_id), messages) as messages:
+            request = _requests.AddMessagesRequest(messages=messages)
+
+            result = self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/messages",
+                data=request,
+                return_type=api_types.MessagesAdded,
+            )
 
-        result = self._process_request(
-            method="POST",
-            path=f"/v1/sessions/{session_id}/agents/{agent_id}/messages",
-            data=request,
-            return_type=api_types.MessagesAdded,
-        )
+            return result
 
-        return result
+    def buffer_messages(
+        self,
+        *,
+        session_id: str,
+        agent_id: str,
+        messages: Sequence[api_types.GameMessage],
+    ) -> api_types.MessagesAdded | None:
+        """Queue messages to be sent with the agent's next request.
+
+        Instead of a request per game event, the messages wait locally and go
+        ahead of the `messages` of the agent's next generate_* or add_messages
+        call. They are sent on their own with `add_messages` once the agent has
+        `message_buffer_size` queued, or when the oldest has waited
+        `message_buffer_max_age` seconds; that limit is checked here and by
+        `flush_due_messages`. If the request they go with fails, they stay
+        queued for the next one.
+
+        Args:
+            session_id: The session that this agent exists within.
+            agent_id: The agent to target.
+            messages: New history to store.
+
+        Returns:
+            The `add_messages` result if the queue was sent, otherwise None.
+        """
+        key = (session_id, agent_id)
+        due = self._message_buffer.add(key, messages)
+        if due is None:
+            return None
+        return self._send_buffered(key, due)
+
+    def flush_messages(
+        self,
+        *,
+        session_id: str | None = None,
+        agent_id: str | None = None,
+    ) -> list[api_types.MessagesAdded]:
+        """Send queued messages now, for one agent or (by default) every agent.
+
+        Args:
+            session_id: The session of the agent to flush.
+            agent_id: The agent to flush.
+        """
+        if session_id is not None or agent_id is not None:
+            if session_id is None or agent_id is None:
+                raise ValueError("session_id and agent_id must be given together")
+            key = (session_id, agent_id)
+            pending = [(key, self._message_buffer.take(key))]
+        else:
+            pending = self._message_buffer.take_all()
+        return self._send_all_buffered(pending)
+
+    def flush_due_messages(self) -> list[api_types.MessagesAdded]:
+        """Send the queues whose oldest message reached `message_buffer_max_age`.
+
+        Call this periodically (e.g. once per game tick) so that messages for
+        agents that go quiet are not held indefinitely.
+        """
+        return self._send_all_buffered(self._message_buffer.take_due())
+
+    def _send_all_buffered(
+        self,
+        pending: list[tuple[tuple[str, str], list[api_types.GameMessage]]],
+    ) -> list[api_types.MessagesAdded]:
+        results = []
+        for index, (key, messages) in enumerate(pending):
+            if not messages:
+                continue
+            try:
+                results.append(self._send_buffered(key, messages))
+            except Exception:
+                for later_key, later_messages in pending[index + 1 :]:
+                    self._message_buffer.restore(later_key, later_messages)
+                raise
+        return results
+
+    def _send_buffered(
+        self, key: tuple[str, str], messages: list[api_types.GameMessage]
+    ) -> api_types.MessagesAdded:
+        session_id, agent_id = key
+        try:
+            return self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/messages",
+                data=_requests.AddMessagesRequest(messages=messages),
+                return_type=api_types.MessagesAdded,
+            )
+        except Exception:
+            self._message_buffer.restore(key, messages)
+            raise
 
     def generate_text(
         self,
@@ -324,26 +598,30 @@ class Client:
     ) -> api_types.TextGenerated:
         """Ask the agent to generate text.
 
+        Messages queued for this agent with `buffer_messages` are sent ahead
+        of `messages`.
+
         Args:
             session_id: The session that this agent exists within.
             agent_id: The agent to target.
             messages: New history to process before generating text.
             cue: Optional text that can be used to prompt the agent.
         """
-        payload = _requests.GenerateTextRequest(
-            messages=messages,
-            cue=cue,
-            service_id=service_id,
-            presentation_config=presentation_config,
-        )
-        result = self._process_request(
-            method="POST",
-            path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_text",
-            data=payload,
-            return_type=api_types.TextGenerated,
-        )
+        with self._message_buffer.attach((session_id, agent_id), messages) as messages:
+            payload = _requests.GenerateTextRequest(
+                messages=messages,
+                cue=cue,
+                service_id=service_id,
+                presentation_config=presentation_config,
+            )
+            result = self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_text",
+                data=payload,
+                return_type=api_types.TextGenerated,
+            )
 
-        return result
+            return result
 
     def generate_function_call(
         self,
@@ -362,6 +640,9 @@ class Client:
     ) -> api_types.FunctionCallGenerated:
         """Ask the agent to generate a function call.
 
+        Messages queued for this agent with `buffer_messages` are sent ahead
+        of `messages`.
+
         Args:
             session_id: The session that this agent exists within.
             agent_id: The agent to target.
@@ -369,21 +650,22 @@ class Client:
             messages: New history to use.
             cue: Optional text that can be used to prompt the agent.
         """
-        payload = _requests.GenerateFunctionCallRequest(
-            messages=messages,
-            functions=functions,
-            cue=cue,
-            service_id=service_id,
-            presentation_config=presentation_config,
-        )
-        result = self._process_request(
-            method="POST",
-            path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_function_call",
-            data=payload,
-            return_type=api_types.FunctionCallGenerated,
-        )
+        with self._message_buffer.attach((session_id, agent_id), messages) as messages:
+            payload = _requests.GenerateFunctionCallRequest(
+                messages=messages,
+                functions=functions,
+                cue=cue,
+                service_id=service_id,
+                presentation_config=presentation_config,
+            )
+            result = self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_function_call",
+                data=payload,
+                return_type=api_types.FunctionCallGenerated,
+            )
 
-        return result
+            return result
 
     def generate_json(
         self,
@@ -402,6 +684,9 @@ class Client:
     ) -> api_types.JSONGenerated:
         """Ask the agent to generate text.
 
+        Messages queued for this agent with `buffer_messages` are sent ahead
+        of `messages`.
+
         Args:
             session_id: The session that this agent exists within.
             agent_id: The agent to target.
@@ -409,19 +694,20 @@ class Client:
             messages: New history to process before generating text.
             cue: Optional text that can be used to prompt the agent.
         """
-        payload = _requests.GenerateJSONRequest(
-            messages=messages,
-            schema=schema,
-            cue=cue,
-            service_id=service_id,
-            presentation_config=presentation_config,
-        )
+        with self._message_buffer.attach((session_id, agent_id), messages) as messages:
+            payload = _requests.GenerateJSONRequest(
+                messages=messages,
+                schema=schema,
+                cue=cue,
+                service_id=service_id,
+                presentation_config=presentation_config,
+            )
 
-        result = self._process_request(
-            method="POST",
-            path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_json",
-            data=payload,
-            return_type=api_types.JSONGenerated,
-        )
+            result = self._process_request(
+                method="POST",
+                path=f"/v1/sessions/{session_id}/agents/{agent_id}/generate_json",
+                data=payload,
+                return_type=api_types.JSONGenerated,
+            )
 
-        return result
+            return result
@@ -3,3 +3,15 @@ API_URL = "https://api.artificial.agency/"
 API_VERSION = "2025-05-15"
 
 DEFAULT_REQUEST_TIMEOUT = 45.0  # seconds
+
+# connection pool defaults for the httpx client created by Client / AsyncClient.
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_KEEPALIVE_EXPIRY = 5.0  # seconds
+
+# requests in flight at once for the AsyncClient *_many methods.
+DEFAULT_BULK_CONCURRENCY = 16
+
+# limits for messages queued by Client.buffer_messages / AsyncClient.buffer_messages.
+DEFAULT_MESSAGE_BUFFER_SIZE = 32
+DEFAULT_MESSAGE_BUFFER_MAX_AGE = 10.0  # seconds
@@ -0,0 +1,175 @@
+"""Retry policy used by Client and AsyncClient when a request fails."""
+
+import dataclasses
+import email.utils
+import random
+import threading
+import time
+
+import httpx
+
+# methods that can be sent twice without changing the result.
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+# failures where the request never reached the API, so resending it is safe
+# even for calls that create state.
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+UNPROCESSED_STATUSES = frozenset({429})
+
+
+@dataclasses.dataclass(frozen=True)
+class RetryPolicy:
+    """When and how often a failed request is sent again.
+
+    Args:
+        max_retries: Retries after the first attempt; 0 disables retrying.
+        initial_backoff:
+            Seconds before the first retry; doubled for each further retry and
+            randomized between zero and that value (full jitter).
+        max_backoff: Upper bound on the backoff between two attempts.
+        max_retry_after:
+            Longest `Retry-After` the client will wait for. A longer one ends
+            the retries.
+        retry_statuses: Response status codes worth retrying.
+        retry_error_types: API error types worth retrying, whatever the status.
+        retry_timeouts: Retry requests that timed out or lost their connection.
+        retry_non_idempotent:
+            Also retry POSTs (create_session, add_messages, generate_*, ...)
+            that may have reached the API. Without it they are only retried
+            when the API certainly did not process them: the connection could
+            not be opened, or the response was 429.
+        budget_ratio: Retries allowed per request sent, across the client.
+        budget_min_per_second: Retries always allowed per second at low traffic.
+        budget_max_tokens: Retries that can be saved up for a burst.
+    """
+
+    max_retries: int = 2
+    initial_backoff: float = 0.5
+    max_backoff: float = 8.0
+    max_retry_after: float = 60.0
+    retry_statuses: frozenset[int] = frozenset({408, 429, 500, 502, 503, 504})
+    retry_error_types: frozenset[str] = frozenset({"not_ready"})
+    retry_timeouts: bool = True
+    retry_non_idempotent: bool = False
+    budget_ratio: float = 0.2
+    budget_min_per_second: float = 1.0
+    budget_max_tokens: float = 10.0
+
+    def backoff(self, attempt: int) -> float:
+        """Randomized delay before retry number `attempt` (starting at 0)."""
+        return random.uniform(
+            0, min(self.max_backoff, self.initial_backoff * 2**attempt)
+        )
+
+    def retry_delay(
+        self,
+        attempt: int,
+        *,
+        idempotent: bool,
+        budget: "RetryBudget",
+        response: httpx.Response | None = None,
+        error: httpx.TransportError | None = None,
+    ) -> float | None:
+        """Seconds to wait before retrying a failed attempt, or None to give up.
+
+        Args:
+            attempt: How many retries were already made.
+            idempotent: Whether the request can safely be sent twice.
+            budget: The client's retry budget; charged when a retry is allowed.
+            response: The non-200 response, if one was received.
+            error: The transport error, if no response was received.
+        """
+        if attempt >= self.max_retries:
+            return None
+
+        retry_after = None
+        if response is not None:
+            if not self._retryable_response(response):
+                return None
+            unprocessed = response.status_code in UNPROCESSED_STATUSES
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None and retry_after > self.max_retry_after:
+                return None
+        else:
+            unprocessed = isinstance(error, UNSENT_ERRORS)
+            if not (unprocessed or self.retry_timeouts):
+                return None
+
+        if not (idempotent or unprocessed or self.retry_non_idempotent):
+            return None
+        if not budget.try_spend():
+            return None
+        return max(self.backoff(attempt), retry_after or 0.0)
+
+    def _retryable_response(self, response: httpx.Response) -> bool:
+        if response.status_code in self.retry_statuses:
+            return True
+        if not self.retry_error_types:
+            return False
+        try:
+            error_type = response.json()["error"]["type"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return error_type in self.retry_error_types
+
+
+NO_RETRIES = RetryPolicy(max_retries=0)
+
+
+class RetryBudget:
+    """Client-wide cap on retries so that they cannot amplify an outage.
+
+    Every request deposits `ratio` tokens and every retry spends one, so at
+    most that fraction of the traffic is retries. The balance also refills at
+    `min_per_second` so that a quiet client can still retry, and holds at most
+    `max_tokens`.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, max_tokens: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_policy(cls, policy: RetryPolicy) -> "RetryBudget":
+        return cls(
+            policy.budget_ratio, policy.budget_min_per_second, policy.budget_max_tokens
+        )
+
+    def _refill(self, deposit: float) -> None:
+        now = time.monotonic()
+        refill = (now - self._updated) * self.min_per_second + deposit
+        self._tokens = min(self.max_tokens, self._tokens + refill)
+        self._updated = now
+
+    def record_request(self) -> None:
+        """Count a request sent for the first time."""
+        with self._lock:
+            self._refill(self.ratio)
+
+    def try_spend(self) -> bool:
+        """Take the token for one retry, if the budget has one."""
+        with self._lock:
+            self._refill(0.0)
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait from a `Retry-After` header (delay-seconds or HTTP-date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
@@ -0,0 +1,256 @@
+"""How Client and AsyncClient turn response bodies into response models.
+
+- "strict" (the default) validates the whole response with pydantic.
+- "trusted" parses the JSON and builds the models without validating them.
+  Use it for endpoints whose shape you rely on the API to keep.
+- "lazy" parses the JSON and validates each field the first time it is read,
+  so the fields a caller never looks at are never validated. The response is
+  a `LazyResponse` standing in for the model, not an instance of it.
+
+Where validation runs, a response that does not match its model raises
+`errors.APIResponseValidationError`; with "lazy" that happens when the field
+is read.
+"""
+
+import types
+import typing
+from typing import Annotated, Any, Generic, Literal, TypeVar
+
+import pydantic
+import pydantic_core
+from pydantic.fields import FieldInfo
+
+from artificial_agency import errors
+
+ValidationMode = Literal["strict", "trusted", "lazy"]
+
+VALIDATION_MODES: tuple[ValidationMode, ...] = typing.get_args(ValidationMode)
+
+ModelT = TypeVar("ModelT", bound=pydantic.BaseModel)
+
+# how "trusted" mode builds a model: whether it can set the instance's
+# attributes directly (like `model_construct`, without its per-call overhead),
+# the keys that are not extra (None if extra keys are dropped), and per field:
+# (name, alias, nested model, whether the value is a list of them, the field)
+_ConstructPlan = tuple[
+    bool,
+    frozenset[str] | None,
+    tuple[
+        tuple[str, str, type[pydantic.BaseModel] | None, bool, FieldInfo],
+        ...,
+    ],
+]
+
+_construct_plans: dict[type[pydantic.BaseModel], _ConstructPlan] = {}
+_lazy_fields: dict[
+    type[pydantic.BaseModel],
+    dict[str, tuple[str, pydantic.TypeAdapter, FieldInfo]],
+] = {}
+
+
+def check_mode(mode: str) -> ValidationMode:
+    if mode not in VALIDATION_MODES:
+        raise ValueError(f"validation must be one of {', '.join(VALIDATION_MODES)}")
+    return typing.cast(ValidationMode, mode)
+
+
+def parse_response(
+    model_type: type[ModelT], content: bytes, mode: ValidationMode, status_code: int
+) -> ModelT:
+    """Turn a response body into `model_type` according to `mode`.
+
+    Raises:
+        pydantic.ValidationError: "strict" mode, the body does not match.
+        ValueError: "trusted" or "lazy" mode, the body is not a JSON object.
+    """
+    if mode == "strict":
+        return model_type.model_validate_json(content)
+
+    data = pydantic_core.from_json(content)
+    if not isinstance(data, dict):
+        raise ValueError("the response is not a JSON object")
+    if mode == "trusted":
+        return construct(model_type, data)
+    # reads like `model_type` but is not an instance of it: see LazyResponse.
+    return typing.cast(ModelT, LazyResponse(model_type, data, status_code))
+
+
+def construct(model_type: type[ModelT], data: dict[str, Any]) -> ModelT:
+    """Build `model_type` from parsed JSON without validation.
+
+    Fields that hold a model, or a list of models, are built recursively;
+    every other value is kept as parsed.
+    """
+    direct, known, fields = _construct_plan(model_type)
+    values = {}
+    fields_set = set()
+    used = 0
+    for name, alias, nested, is_list, field in fields:
+        if alias in data:
+            value = data[alias]
+        elif name in data:
+            value = data[name]
+        else:
+            if not field.is_required():
+                values[name] = field.get_default(call_default_factory=True)
+            continue
+        used += 1
+        if nested is not None and value is not None:
+            if not is_list:
+                if isinstance(value, dict):
+                    value = construct(nested, value)
+            elif isinstance(value, list):
+                value = [
+                    construct(nested, item) if isinstance(item, dict) else item
+                    for item in value
+                ]
+        values[name] = value
+        fields_set.add(name)
+
+    if not direct:
+        return model_type.model_construct(fields_set, **values)
+    extra = None
+    if known is not None:
+        if not known:
+            extra = dict(data)
+        elif used < len(data):
+            extra = {key: value for key, value in data.items() if key not in known}
+        else:
+            extra = {}
+    model = model_type.__new__(model_type)
+    object.__setattr__(model, "__dict__", values)
+    object.__setattr__(model, "__pydantic_fields_set__", fields_set)
+    object.__setattr__(model, "__pydantic_extra__", extra)
+    object.__setattr__(model, "__pydantic_private__", None)
+    return model
+
+
+def _construct_plan(model_type: type[pydantic.BaseModel]) -> _ConstructPlan:
+    plan = _construct_plans.get(model_type)
+    if plan is None:
+        fields = []
+        direct = not (
+            model_type.__pydantic_root_model__
+            or model_type.__pydantic_post_init__
+            or model_type.__private_attributes__
+        )
+        for name, field in model_type.model_fields.items():
+            nested, is_list = _nested_model(field.annotation)
+            alias = field.alias or name
+            if field.validation_alias not in (None, alias):
+                direct = False
+            fields.append((name, alias, nested, is_list, field))
+        known = None
+        if model_type.model_config.get("extra") == "allow":
+            known = frozenset(key for field in fields for key in field[:2])
+        plan = _construct_plans[model_type] = (direct, known, tuple(fields))
+    return plan
+
+
+def _nested_model(annotation: Any) -> tuple[type[pydantic.BaseModel] | None, bool]:
+    args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+        # Optional[Model]; unions of several models are left as parsed.
+        if len(args) != 1:
+            return None, False
+        annotation = args[0]
+        args = list(typing.get_args(annotation))
+    if isinstance(annotation, type) and issubclass(annotation, pydantic.BaseModel):
+        return annotation, False
+    if typing.get_origin(annotation) is list and len(args) == 1:
+        item = args[0]
+        if isinstance(item, type) and issubclass(item, pydantic.BaseModel):
+            return item, True
+    return None, False
+
+
+class LazyResponse(Generic[ModelT]):
+    """Stands in for a response model and validates each field on first read.
+
+    Reading a field that does not match the model raises
+    `errors.APIResponseValidationError`. `validated()` returns the real model.
+    Other attributes of the model, such as `model_dump()`, are read from the
+    validated model, and the proxy compares equal to it.
+
+    The proxy is not an instance of the model: `isinstance` checks fail, and
+    pydantic rejects it as a model field or in `model_validate()`. Pass
+    `validated()` there instead.
+    """
+
+    def __init__(
+        self, model_type: type[ModelT], data: dict[str, Any], status_code: int
+    ):
+        self._model_type = model_type
+        self._data = data
+        self._status_code = status_code
+        self._model: ModelT | None = None
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for names not set in __init__: while copy and pickle
+        # rebuild an instance those are missing too, so don't look them up.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        fields = _fields_of(self._model_type)
+        if name not in fields:
+            if hasattr(self._model_type, name):
+                return getattr(self.validated(), name)
+            raise AttributeError(
+                f"{self._model_type.__name__!r} response has no attribute {name!r}"
+            )
+        alias, adapter, field = fields[name]
+        if alias in self._data:
+            try:
+                value = adapter.validate_python(self._data[alias])
+            except pydantic.ValidationError:
+                raise self._error()
+        elif not field.is_required():
+            value = field.get_default(call_default_factory=True)
+        else:
+            raise self._error()
+        # cached, so the next read is a plain attribute lookup.
+        self.__dict__[name] = value
+        return value
+
+    def validated(self) -> ModelT:
+        """Validate the whole response and return it as the real model."""
+        if self._model is None:
+            try:
+                self._model = self._model_type.model_validate(self._data)
+            except pydantic.ValidationError:
+                raise self._error()
+        return self._model
+
+    def __eq__(self, other: object) -> bool:
+        # compared as the model it stands in for, like responses in the other modes.
+        if isinstance(other, LazyResponse):
+            other = other.validated()
+        return self.validated() == other
+
+    # unhashable, like the models.
+    __hash__ = None  # type: ignore[assignment]
+
+    def _error(self) -> errors.APIResponseValidationError:
+        return errors.APIResponseValidationError(
+            status_code=self._status_code,
+            error_type="server_error",
+            message="Server returned data in an unexpected format.",
+        )
+
+    def __repr__(self) -> str:
+        return f"LazyResponse[{self._model_type.__name__}]({self._data!r})"
+
+
+def _fields_of(
+    model_type: type[pydantic.BaseModel],
+) -> dict[str, tuple[str, pydantic.TypeAdapter, FieldInfo]]:
+    fields = _lazy_fields.get(model_type)
+    if fields is None:
+        fields = {}
+        for name, field in model_type.model_fields.items():
+            annotation = field.annotation
+            if field.metadata:
+                annotation = Annotated[annotation, *field.metadata]
+            adapter = pydantic.TypeAdapter(annotation)
+            fields[name] = (field.alias or name, adapter, field)
+        _lazy_fields[model_type] = fields
+    return fields
@@ -1,10 +1,12 @@
+import asyncio
 import json
 import unittest
+from unittest import mock
 
 import httpx
 import respx
 
-from artificial_agency import _requests, api_types, async_client, errors
+from artificial_agency import _requests, api_types, async_client, errors, retries
 
 
 class SimpleRequest(_requests.APIRequest):
@@ -50,6 +52,35 @@ class TestAsyncClientConfiguration(unittest.IsolatedAsyncioTestCase):
         with self.assertRaisesRegex(ValueError, "api_key must not be empty"):
             async_client.AsyncClient("")
 
+    async def test_connection_pool_options(self):
+        with mock.patch.object(
+            httpx, "AsyncClient", wraps=httpx.AsyncClient
+        ) as http_client:
+            async_client.AsyncClient(
+                "test-api-key",
+                max_connections=500,
+                max_keepalive_connections=200,
+                keepalive_expiry=30.0,
+            )
+
+        kwargs = http_client.call_args.kwargs
+        assert kwargs["limits"] == httpx.Limits(
+            max_connections=500, max_keepalive_connections=200, keepalive_expiry=30.0
+        )
+        assert kwargs["http2"] is False
+
+    async def test_context_manager_closes_own_http_client(self):
+        async with async_client.AsyncClient("test-api-key") as client:
+            assert not client.http_client.is_closed
+        assert client.http_client.is_closed
+
+    async def test_aclose_leaves_given_http_client_open(self):
+        http_client = httpx.AsyncClient(base_url="http://localhost")
+        async with async_client.AsyncClient("test-api-key", http_client=http_client):
+            pass
+        assert not http_client.is_closed
+        await http_client.aclose()
+
 
 class TestAsyncClientRequests(unittest.IsolatedAsyncioTestCase):
     client = async_client.AsyncClient(api_key="test-api-key")
@@ -149,6 +180,26 @@ class TestAsyncClientRequests(unittest.IsolatedAsyncioTestCase):
             assert e.exception.status_code == 500
             assert e.exception.error_type == "server_error"
 
+    @respx.mock
+    async def test_warm(self, respx_mock: respx.Router):
+        route = respx_mock.head("/").mock(return_value=httpx.Response(404))
+
+        assert await self.client.warm(connections=3) == 3
+        assert route.call_count == 3
+
+    @respx.mock
+    async def test_warm_connect_error(self, respx_mock: respx.Router):
+        respx_mock.head("/").mock(side_effect=httpx.ConnectError)
+
+        assert await self.client.warm(connections=2) == 0
+
+    @respx.mock
+    async def test_warm_no_connections(self, respx_mock: respx.Router):
+        route = respx_mock.head("/").mock(return_value=httpx.Response(404))
+
+        assert await self.client.warm(connections=0) == 0
+        assert route.call_count == 0
+
     @respx.mock
     async def test_create_session(self, respx_mock: respx.Router):
         route = respx_mock.post("/v1/sessions").mock(
@@ -305,3 +356,269 @@ class TestAsyncClientRequests(unittest.IsolatedAsyncioTestCase):
         )
         assert response.moment_id == "1"
         assert response.json_ == {"species": "Felis catus", "hp": 1}
+
+
+class TestAsyncClientValidation(unittest.IsolatedAsyncioTestCase):
+    function_call = {
+        "moment_id": "1",
+        "function_call": {"id": "call_1", "name": "jump", "args": {"height": 2}},
+    }
+
+    async def generate_function_call(self, client):
+        return await client.generate_function_call(
+            session_id="sess_1234", agent_id="agent_1234", functions=[]
+        )
+
+    @respx.mock
+    async def test_trusted_builds_nested_models(self, respx_mock: respx.Router):
+        respx_mock.post(
+            "/v1/sessions/sess_1234/agents/agent_1234/generate_function_call"
+        ).mock(return_value=httpx.Response(200, json=self.function_call))
+        client = async_client.AsyncClient(
+            api_key="test-api-key", validation="trusted"
+        )
+
+        response = await self.generate_function_call(client)
+        assert isinstance(response, api_types.FunctionCallGenerated)
+        assert isinstance(
+            response.function_call, api_types.FunctionCallGenerated.FunctionCall
+        )
+
+    @respx.mock
+    async def test_lazy_validates_fields_on_read(self, respx_mock: respx.Router):
+        bad_call = dict(self.function_call, moment_id=1)
+        respx_mock.post(
+            "/v1/sessions/sess_1234/agents/agent_1234/generate_function_call"
+        ).mock(return_value=httpx.Response(200, json=bad_call))
+        client = async_client.AsyncClient(api_key="test-api-key", validation="lazy")
+
+        response = await self.generate_function_call(client)
+        assert response.function_call.name == "jump"
+        with self.assertRaises(errors.APIResponseValidationError):
+            response.moment_id
+
+    @respx.mock
+    async def test_with_validation(self, respx_mock: respx.Router):
+        respx_mock.post("/process-request").mock(
+            return_value=httpx.Response(200, json={"ok": "not a bool"})
+        )
+        client = async_client.AsyncClient(api_key="test-api-key")
+
+        async with client.with_validation("trusted") as trusted:
+            response = await trusted._process_request(
+                method="POST",
+                path="/process-request",
+                data=SimpleRequest(),
+                return_type=SimpleResponse,
+            )
+        assert response.ok == "not a bool"
+        assert not client.http_client.is_closed
+        with self.assertRaises(errors.APIResponseValidationError):
+            await client._process_request(
+                method="POST",
+                path="/process-request",
+                data=SimpleRequest(),
+                return_type=SimpleResponse,
+            )
+
+
+class TestAsyncClientRetries(unittest.IsolatedAsyncioTestCase):
+    def make_client(self, **policy):
+        return async_client.AsyncClient(
+            api_key="test-api-key",
+            retry_policy=retries.RetryPolicy(initial_backoff=0, **policy),
+        )
+
+    async def process(self, client, method="POST"):
+        return await client._process_request(
+            method=method,
+            path="/process-request",
+            data=SimpleRequest() if method == "POST" else None,
+            return_type=SimpleResponse,
+        )
+
+    @respx.mock
+    async def test_retries_idempotent_request(self, respx_mock: respx.Router):
+        route = respx_mock.get("/process-request").mock(
+            side_effect=[httpx.Response(503), httpx.Response(200, json={"ok": True})]
+        )
+
+        assert (await self.process(self.make_client(), method="GET")).ok
+        assert route.call_count == 2
+
+    @respx.mock
+    async def test_does_not_resend_post_after_server_error(
+        self, respx_mock: respx.Router
+    ):
+        route = respx_mock.post("/process-request").mock(
+            return_value=httpx.Response(500)
+        )
+
+        with self.assertRaises(errors.APIError):
+            await self.process(self.make_client())
+        assert route.call_count == 1
+
+    @respx.mock
+    async def test_resends_unprocessed_post(self, respx_mock: respx.Router):
+        route = respx_mock.post("/process-request").mock(
+            side_effect=[
+                httpx.ConnectError("refused"),
+                httpx.Response(429, headers={"Retry-After": "0"}),
+                httpx.Response(200, json={"ok": True}),
+            ]
+        )
+
+        assert (await self.process(self.make_client())).ok
+        assert route.call_count == 3
+
+    @respx.mock
+    async def test_timeout_after_retries(self, respx_mock: respx.Router):
+        route = respx_mock.get("/process-request").mock(
+            side_effect=httpx.ReadTimeout("slow")
+        )
+
+        with self.assertRaises(errors.APITimeoutError):
+            await self.process(self.make_client(), method="GET")
+        assert route.call_count == 3
+
+
+class TestAsyncClientBulk(unittest.IsolatedAsyncioTestCase):
+    client = async_client.AsyncClient(
+        api_key="test-api-key", retry_policy=retries.NO_RETRIES
+    )
+
+    agents = [
+        async_client.Agent(
+            session_id="sess_1234",
+            agent_id=f"agent_{i}",
+            moment_id=1,
+            moment_uuid=f"moment_{i}",
+        )
+        for i in range(10)
+    ]
+
+    @respx.mock
+    async def test_add_messages_many(self, respx_mock: respx.Router):
+        in_flight = 0
+        most_in_flight = 0
+
+        async def add_messages(request: httpx.Request) -> httpx.Response:
+            nonlocal in_flight, most_in_flight
+            in_flight += 1
+            most_in_flight = max(most_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if request.url.path.split("/")[-2] == "agent_3":
+                return httpx.Response(404)
+            return httpx.Response(200, json={"moment_id": "2"})
+
+        route = respx_mock.post(
+            url__regex=r"/v1/sessions/sess_1234/agents/agent_\d+/messages"
+        ).mock(side_effect=add_messages)
+
+        results = [
+            item
+            async for item in self.client.add_messages_many(
+                self.agents,
+                messages=[api_types.ContentMessage(content="The bridge is out.")],
+                concurrency=3,
+            )
+        ]
+
+        assert route.call_count == 10
+        assert most_in_flight == 3
+        assert sorted(item.index for item in results) == list(range(10))
+        failed = [item for item in results if not item.ok]
+        assert [item.target.agent_id for item in failed] == ["agent_3"]
+        assert isinstance(failed[0].error, errors.APIError)
+        assert all(item.result.moment_id == "2" for item in results if item.ok)
+        body = json.loads(route.calls[0].request.content)
+        assert body["messages"][0]["content"] == "The bridge is out."
+
+    @respx.mock
+    async def test_generate_text_many_per_target_arguments(
+        self, respx_mock: respx.Router
+    ):
+        route = respx_mock.post(
+            url__regex=r"/v1/sessions/sess_1234/agents/agent_\d+/generate_text"
+        ).mock(return_value=httpx.Response(200, json={"moment_id": "3", "text": "Hi"}))
+
+        targets = [
+            {"session_id": "sess_1234", "agent_id": "agent_0", "cue": "Greet"},
+            self.agents[1],
+        ]
+        results = [
+            item
+            async for item in self.client.generate_text_many(targets, cue="Wave")
+        ]
+
+        assert {item.result.text for item in results} == {"Hi"}
+        cues = {
+            call.request.url.path.split("/")[-2]: json.loads(call.request.content)["cue"]
+            for call in route.calls
+        }
+        assert cues == {"agent_0": "Greet", "agent_1": "Wave"}
+
+    @respx.mock
+    async def test_many_stops_workers_on_break(self, respx_mock: respx.Router):
+        route = respx_mock.post(
+            url__regex=r"/v1/sessions/sess_1234/agents/agent_\d+/messages"
+        ).mock(return_value=httpx.Response(200, json={"moment_id": "2"}))
+
+        stream = self.client.add_messages_many(self.agents, messages=[], concurrency=1)
+        async for _ in stream:
+            break
+        await stream.aclose()
+
+        assert route.call_count < len(self.agents)
+
+    async def test_many_rejects_zero_concurrency(self):
+        with self.assertRaisesRegex(ValueError, "concurrency must be at least 1"):
+            self.client.add_messages_many(self.agents, messages=[], concurrency=0)
+
+
+class TestAsyncClientMessageBuffer(unittest.IsolatedAsyncioTestCase):
+    messages_path = "/v1/sessions/sess_1234/agents/agent_1234/messages"
+    generate_path = "/v1/sessions/sess_1234/agents/agent_1234/generate_text"
+
+    @respx.mock
+    async def test_buffered_messages_go_with_generate(self, respx_mock: respx.Router):
+        messages = respx_mock.post(self.messages_path).mock(
+            return_value=httpx.Response(200, json={"moment_id": "1"})
+        )
+        generate = respx_mock.post(self.generate_path).mock(
+            return_value=httpx.Response(200, json={"moment_id": "2", "text": "Hi"})
+        )
+
+        async with async_client.AsyncClient(api_key="test-api-key") as client:
+            await client.buffer_messages(
+                session_id="sess_1234",
+                agent_id="agent_1234",
+                messages=[api_types.ContentMessage(content="It is snowing.")],
+            )
+            await client.generate_text(session_id="sess_1234", agent_id="agent_1234")
+            await client.buffer_messages(
+                session_id="sess_1234",
+                agent_id="agent_1234",
+                messages=[api_types.ContentMessage(content="Goodbye.")],
+            )
+
+        body = json.loads(generate.calls[0].request.content)
+        assert [m["content"] for m in body["messages"]] == ["It is snowing."]
+        body = json.loads(messages.calls[0].request.content)
+        assert [m["content"] for m in body["messages"]] == ["Goodbye."]
+
+    @respx.mock
+    async def test_exit_on_error_does_not_flush(self, respx_mock: respx.Router):
+        route = respx_mock.post(self.messages_path).mock(return_value=httpx.Response(500))
+
+        with self.assertRaises(KeyError), self.assertWarns(RuntimeWarning):
+            async with async_client.AsyncClient(api_key="test-api-key") as client:
+                await client.buffer_messages(
+                    session_id="sess_1234",
+                    agent_id="agent_1234",
+                    messages=[api_types.ContentMessage(content="Goodbye.")],
+                )
+                raise KeyError("game crashed")
+        assert not route.called
+        assert client.http_client.is_closed
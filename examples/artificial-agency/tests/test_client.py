@@ -1,10 +1,17 @@
+import copy
 import json
+import pickle
+import subprocess
+import sys
 import unittest
+from typing import Literal
+from unittest import mock
 
 import httpx
+import pydantic
 import respx
 
-from artificial_agency import _requests, api_types, client, errors
+from artificial_agency import _requests, _types, api_types, client, errors, retries
 
 
 class SimpleRequest(_requests.APIRequest):
@@ -50,6 +57,33 @@ class TestClientConfiguration(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, "api_key must not be empty"):
             client.Client("")
 
+    def test_connection_pool_options(self):
+        with mock.patch.object(httpx, "Client", wraps=httpx.Client) as http_client:
+            client.Client(
+                "test-api-key",
+                max_connections=500,
+                max_keepalive_connections=200,
+                keepalive_expiry=30.0,
+            )
+
+        kwargs = http_client.call_args.kwargs
+        assert kwargs["limits"] == httpx.Limits(
+            max_connections=500, max_keepalive_connections=200, keepalive_expiry=30.0
+        )
+        assert kwargs["http2"] is False
+
+    def test_context_manager_closes_own_http_client(self):
+        with client.Client("test-api-key") as cl:
+            assert not cl.http_client.is_closed
+        assert cl.http_client.is_closed
+
+    def test_close_leaves_given_http_client_open(self):
+        http_client = httpx.Client(base_url="http://localhost")
+        with client.Client("test-api-key", http_client=http_client):
+            pass
+        assert not http_client.is_closed
+        http_client.close()
+
 
 class TestClientRequestBuilding(unittest.TestCase):
     def test_build_request_keeps_message_type(self):
@@ -101,6 +135,124 @@ class TestClientRequestBuilding(unittest.TestCase):
         self.assertNotIn("messages", body)
         self.assertNotIn("cue", body)
 
+    def test_build_request_json_body(self):
+        cl = client.Client("test-api-key")
+        data = _requests.GenerateTextRequest(
+            messages=(api_types.KVMessage(key="weather", value="snow"),),
+            cue=None,
+            service_id=_types.NotGiven,
+        )
+        req = cl._build_request(method="POST", path="/generate", data=data)
+
+        self.assertEqual("application/json", req.headers["Content-Type"])
+        self.assertEqual(str(len(req.content)), req.headers["Content-Length"])
+        self.assertEqual(
+            {
+                "messages": [
+                    {"message_type": "KVMessage", "key": "weather", "value": "snow"}
+                ],
+                "cue": None,
+            },
+            json.loads(req.content),
+        )
+
+    def test_model_dump_leaves_exclude_alone(self):
+        data = _requests.GenerateTextRequest(cue="Hello", service_id=None)
+        exclude = {"service_id"}
+
+        self.assertEqual({"cue": "Hello"}, data.model_dump(exclude=exclude))
+        self.assertEqual({"service_id"}, exclude)
+
+
+class TestGeneratedModel(unittest.TestCase):
+    def test_literal_fields_are_set(self):
+        message = api_types.KVMessage.model_validate({"key": "hp", "value": "5"})
+
+        self.assertIn("message_type", message.model_fields_set)
+        self.assertEqual(
+            {"message_type": "KVMessage", "key": "hp", "value": "5"},
+            message.model_dump(exclude_unset=True),
+        )
+
+    def test_literal_fields_resolved_per_class(self):
+        class Tagged(_types.GeneratedModel):
+            kind: Literal["tagged"] = "tagged"
+            either: Literal["a", "b"] = "a"
+            name: str
+
+        self.assertEqual((("kind", "tagged"),), Tagged.__literal_fields__)
+        self.assertEqual({"kind", "name"}, Tagged(name="x").model_fields_set)
+
+
+class TestLazyImport(unittest.TestCase):
+    """Guards the cold-start work done by importing the library."""
+
+    def run_python(self, code):
+        return subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout.split()
+
+    def test_api_types_imports_generated_types_on_use(self):
+        loaded = self.run_python(
+            "import sys\n"
+            "from artificial_agency import api_types\n"
+            "prefix = 'artificial_agency.generated_api_types.'\n"
+            "print(*sorted(m for m in sys.modules if m.startswith(prefix)))\n"
+            "api_types.KVMessage\n"
+            "print('KVMessage' in dir(api_types), prefix + 'messages' in sys.modules)"
+        )
+        self.assertEqual(
+            [
+                "artificial_agency.generated_api_types.introspection",
+                "artificial_agency.generated_api_types.ui_config",
+                "True",
+                "True",
+            ],
+            loaded,
+        )
+
+    def test_client_imports_generated_types_on_use(self):
+        loaded = self.run_python(
+            "import sys\n"
+            "from artificial_agency import _requests, api_types, async_client, client\n"
+            "prefix = 'artificial_agency.generated_api_types.'\n"
+            "print(*sorted(m for m in sys.modules if m.startswith(prefix)))\n"
+            "_requests.GenerateTextRequest(cue='Hi').to_json()\n"
+            "print(*sorted(m for m in sys.modules if m.startswith(prefix)))"
+        )
+        self.assertEqual(
+            [
+                "artificial_agency.generated_api_types.introspection",
+                "artificial_agency.generated_api_types.ui_config",
+                "artificial_agency.generated_api_types.introspection",
+                "artificial_agency.generated_api_types.messages",
+                "artificial_agency.generated_api_types.presentation_config",
+                "artificial_agency.generated_api_types.ui_config",
+            ],
+            loaded,
+        )
+
+    def test_validation_imports_on_its_own(self):
+        modes = self.run_python(
+            "from artificial_agency import validation\n"
+            "print(*validation.VALIDATION_MODES)"
+        )
+        self.assertEqual(["strict", "trusted", "lazy"], modes)
+
+    def test_models_are_built_on_first_use(self):
+        complete = self.run_python(
+            "from artificial_agency import api_types, client\n"
+            "print(api_types.TextGenerated.__pydantic_complete__,"
+            " api_types.KVStoreConfig.__pydantic_complete__)\n"
+            "api_types.TextGenerated(moment_id='1', text='Hi')\n"
+            "print(api_types.TextGenerated.__pydantic_complete__)"
+        )
+        self.assertEqual(["False", "False", "True"], complete)
+
+    def test_unknown_attribute(self):
+        with self.assertRaises(AttributeError):
+            api_types.NotAType
+
 
 class TestClientRequests(unittest.IsolatedAsyncioTestCase):
     client = client.Client(api_key="test-api-key")
@@ -200,6 +352,27 @@ class TestClientRequests(unittest.IsolatedAsyncioTestCase):
             assert e.exception.status_code == 500
             assert e.exception.error_type == "server_error"
 
+    @respx.mock
+    def test_warm(self, respx_mock: respx.Router):
+        route = respx_mock.head("/").mock(return_value=httpx.Response(404))
+
+        assert self.client.warm(connections=3) == 3
+        assert route.call_count == 3
+
+    @respx.mock
+    def test_warm_connect_error(self, respx_mock: respx.Router):
+        respx_mock.head("/").mock(side_effect=httpx.ConnectError)
+
+        assert self.client.warm(connections=2) == 0
+
+    @respx.mock
+    def test_warm_no_connections(self, respx_mock: respx.Router):
+        route = respx_mock.head("/").mock(return_value=httpx.Response(404))
+
+        assert self.client.warm(connections=0) == 0
+        assert self.client.warm(connections=-1) == 0
+        assert route.call_count == 0
+
     @respx.mock
     def test_create_session(self, respx_mock: respx.Router):
         route = respx_mock.post("/v1/sessions").mock(
@@ -355,3 +528,460 @@ class TestClientRequests(unittest.IsolatedAsyncioTestCase):
         )
         assert response.moment_id == "1"
         assert response.json_ == {"species": "Felis catus", "hp": 1}
+
+
+class TestClientValidation(unittest.TestCase):
+    function_call = {
+        "moment_id": "1",
+        "function_call": {"id": "call_1", "name": "jump", "args": {"height": 2}},
+    }
+
+    def generate_function_call(self, cl):
+        return cl.generate_function_call(
+            session_id="sess_1234", agent_id="agent_1234", functions=[]
+        )
+
+    def test_invalid_mode(self):
+        with self.assertRaisesRegex(ValueError, "strict, trusted, lazy"):
+            client.Client(api_key="test-api-key", validation="loose")
+
+    @respx.mock
+    def test_trusted_builds_nested_models(self, respx_mock: respx.Router):
+        respx_mock.post(
+            "/v1/sessions/sess_1234/agents/agent_1234/generate_function_call"
+        ).mock(return_value=httpx.Response(200, json=self.function_call))
+        cl = client.Client(api_key="test-api-key", validation="trusted")
+
+        response = self.generate_function_call(cl)
+        assert isinstance(response, api_types.FunctionCallGenerated)
+        assert isinstance(
+            response.function_call, api_types.FunctionCallGenerated.FunctionCall
+        )
+        assert response.function_call.args == {"height": 2}
+
+    @respx.mock
+    def test_trusted_alias_and_list(self, respx_mock: respx.Router):
+        respx_mock.post("/v1/sessions/sess_1234/agents/agent_1234/generate_json").mock(
+            return_value=httpx.Response(200, json={"moment_id": "1", "json": [1]})
+        )
+        respx_mock.get("/v1/services").mock(
+            return_value=httpx.Response(
+                200,
+                json={
+                    "object": "list",
+                    "has_more": False,
+                    "data": [
+                        {
+                            "service_name": "llm-1",
+                            "base_type": "artificial-agency/torque-pocket",
+                            "service_category": "llm",
+                            "description": "",
+                            "fixed_params": {},
+                            "client_params": {},
+                        }
+                    ],
+                },
+            )
+        )
+        cl = client.Client(api_key="test-api-key", validation="trusted")
+
+        response = cl.generate_json(
+            session_id="sess_1234", agent_id="agent_1234", schema={}
+        )
+        assert response.json_ == [1]
+        [service] = cl.list_services()
+        assert service.service_name == "llm-1"
+
+    @respx.mock
+    def test_trusted_does_not_validate(self, respx_mock: respx.Router):
+        respx_mock.post("/process-request").mock(
+            return_value=httpx.Response(200, json={"ok": "not a bool"})
+        )
+        cl = client.Client(api_key="test-api-key", validation="trusted")
+
+        response = cl._process_request(
+            method="POST",
+            path="/process-request",
+            data=SimpleRequest(),
+            return_type=SimpleResponse,
+        )
+        assert response.ok == "not a bool"
+
+    @respx.mock
+    def test_trusted_invalid_json(self, respx_mock: respx.Router):
+        respx_mock.post("/process-request").mock(
+            return_value=httpx.Response(200, content=b"[1, 2")
+        )
+        cl = client.Client(api_key="test-api-key", validation="trusted")
+
+        with self.assertRaises(errors.APIResponseValidationError):
+            cl._process_request(
+                method="POST",
+                path="/process-request",
+                data=SimpleRequest(),
+                return_type=SimpleResponse,
+            )
+
+    @respx.mock
+    def test_lazy_validates_fields_on_read(self, respx_mock: respx.Router):
+        bad_call = dict(self.function_call, moment_id=1)
+        respx_mock.post(
+            "/v1/sessions/sess_1234/agents/agent_1234/generate_function_call"
+        ).mock(return_value=httpx.Response(200, json=bad_call))
+        cl = client.Client(api_key="test-api-key", validation="lazy")
+
+        response = self.generate_function_call(cl)
+        assert response.function_call.name == "jump"
+        with self.assertRaises(errors.APIResponseValidationError) as e:
+            response.moment_id
+        assert e.exception.status_code == 200
+        with self.assertRaises(errors.APIResponseValidationError):
+            response.validated()
+
+    @respx.mock
+    def test_lazy_validated(self, respx_mock: respx.Router):
+        respx_mock.post(
+            "/v1/sessions/sess_1234/agents/agent_1234/generate_function_call"
+        ).mock(return_value=httpx.Response(200, json=self.function_call))
+        cl = client.Client(api_key="test-api-key", validation="lazy")
+
+        response = self.generate_function_call(cl).validated()
+        assert isinstance(response, api_types.FunctionCallGenerated)
+        assert response.function_call.id == "call_1"
+
+    @respx.mock
+    def test_lazy_reads_like_the_model(self, respx_mock: respx.Router):
+        respx_mock.post(
+            "/v1/sessions/sess_1234/agents/agent_1234/generate_function_call"
+        ).mock(return_value=httpx.Response(200, json=self.function_call))
+        cl = client.Client(api_key="test-api-key", validation="lazy")
+
+        response = self.generate_function_call(cl)
+        strict = api_types.FunctionCallGenerated.model_validate(self.function_call)
+        assert response.model_dump(mode="json") == self.function_call
+        assert response == strict and strict == response
+        assert response != api_types.FunctionCallGenerated.model_validate(
+            dict(self.function_call, moment_id="moment_2")
+        )
+        for copied in (
+            copy.copy(response),
+            copy.deepcopy(response),
+            pickle.loads(pickle.dumps(response)),
+        ):
+            assert copied.function_call.id == "call_1"
+            assert copied.validated() == response.validated()
+        with self.assertRaises(AttributeError):
+            response.no_such_field
+
+    @respx.mock
+    def test_lazy_is_not_an_instance_of_the_model(self, respx_mock: respx.Router):
+        respx_mock.post(
+            "/v1/sessions/sess_1234/agents/agent_1234/generate_function_call"
+        ).mock(return_value=httpx.Response(200, json=self.function_call))
+        cl = client.Client(api_key="test-api-key", validation="lazy")
+
+        class Wrap(pydantic.BaseModel):
+            call: api_types.FunctionCallGenerated
+
+        response = self.generate_function_call(cl)
+        assert not isinstance(response, api_types.FunctionCallGenerated)
+        with self.assertRaises(pydantic.ValidationError):
+            Wrap(call=response)
+        with self.assertRaises(pydantic.ValidationError):
+            api_types.FunctionCallGenerated.model_validate(response)
+        wrapped = Wrap(call=response.validated())
+        assert wrapped.model_dump(mode="json") == {"call": self.function_call}
+
+    @respx.mock
+    def test_with_validation(self, respx_mock: respx.Router):
+        respx_mock.post("/process-request").mock(
+            return_value=httpx.Response(200, json={"ok": "not a bool"})
+        )
+        cl = client.Client(api_key="test-api-key")
+        trusted = cl.with_validation("trusted")
+        assert trusted.validation == "trusted"
+        assert cl.validation == "strict"
+        assert trusted.http_client is cl.http_client
+
+        with trusted:
+            pass
+        assert not cl.http_client.is_closed
+        with self.assertRaises(errors.APIResponseValidationError):
+            cl._process_request(
+                method="POST",
+                path="/process-request",
+                data=SimpleRequest(),
+                return_type=SimpleResponse,
+            )
+
+
+class TestClientRetries(unittest.TestCase):
+    def make_client(self, **policy):
+        return client.Client(
+            api_key="test-api-key",
+            retry_policy=retries.RetryPolicy(initial_backoff=0, **policy),
+        )
+
+    def process(self, cl, method="POST"):
+        return cl._process_request(
+            method=method,
+            path="/process-request",
+            data=SimpleRequest() if method == "POST" else None,
+            return_type=SimpleResponse,
+        )
+
+    @respx.mock
+    def test_retries_idempotent_request(self, respx_mock: respx.Router):
+        route = respx_mock.get("/process-request").mock(
+            side_effect=[httpx.Response(503), httpx.Response(200, json={"ok": True})]
+        )
+
+        assert self.process(self.make_client(), method="GET").ok
+        assert route.call_count == 2
+
+    @respx.mock
+    def test_does_not_resend_post_after_server_error(self, respx_mock: respx.Router):
+        route = respx_mock.post("/process-request").mock(
+            return_value=httpx.Response(500)
+        )
+
+        with self.assertRaises(errors.APIError):
+            self.process(self.make_client())
+        assert route.call_count == 1
+
+    @respx.mock
+    def test_resends_post_when_opted_in(self, respx_mock: respx.Router):
+        route = respx_mock.post("/process-request").mock(
+            side_effect=[httpx.Response(500), httpx.Response(200, json={"ok": True})]
+        )
+
+        assert self.process(self.make_client(retry_non_idempotent=True)).ok
+        assert route.call_count == 2
+
+    @respx.mock
+    def test_resends_unprocessed_post(self, respx_mock: respx.Router):
+        route = respx_mock.post("/process-request").mock(
+            side_effect=[
+                httpx.ConnectError("refused"),
+                httpx.Response(429),
+                httpx.Response(200, json={"ok": True}),
+            ]
+        )
+
+        assert self.process(self.make_client()).ok
+        assert route.call_count == 3
+
+    @respx.mock
+    def test_retries_error_type(self, respx_mock: respx.Router):
+        not_ready = {
+            "error": {"type": "not_ready", "message": "Not ready.", "trace": "1234"}
+        }
+        route = respx_mock.get("/process-request").mock(
+            side_effect=[
+                httpx.Response(409, json=not_ready),
+                httpx.Response(200, json={"ok": True}),
+            ]
+        )
+
+        assert self.process(self.make_client(), method="GET").ok
+        assert route.call_count == 2
+
+    @respx.mock
+    def test_max_retries(self, respx_mock: respx.Router):
+        route = respx_mock.get("/process-request").mock(
+            return_value=httpx.Response(503)
+        )
+
+        with self.assertRaises(errors.APIError):
+            self.process(self.make_client(max_retries=3), method="GET")
+        assert route.call_count == 4
+
+    @respx.mock
+    def test_retry_after(self, respx_mock: respx.Router):
+        respx_mock.get("/process-request").mock(
+            side_effect=[
+                httpx.Response(503, headers={"Retry-After": "2"}),
+                httpx.Response(200, json={"ok": True}),
+            ]
+        )
+
+        with mock.patch("time.sleep") as sleep:
+            self.process(self.make_client(), method="GET")
+        sleep.assert_called_once_with(2.0)
+
+    @respx.mock
+    def test_retry_after_too_long(self, respx_mock: respx.Router):
+        route = respx_mock.get("/process-request").mock(
+            return_value=httpx.Response(503, headers={"Retry-After": "3600"})
+        )
+
+        with self.assertRaises(errors.APIError):
+            self.process(self.make_client(), method="GET")
+        assert route.call_count == 1
+
+    @respx.mock
+    def test_retry_budget(self, respx_mock: respx.Router):
+        route = respx_mock.get("/process-request").mock(
+            return_value=httpx.Response(503)
+        )
+        cl = self.make_client(
+            budget_ratio=0, budget_min_per_second=0, budget_max_tokens=2
+        )
+
+        for _ in range(3):
+            with self.assertRaises(errors.APIError):
+                self.process(cl, method="GET")
+        # two retries for the first request, none left for the others
+        assert route.call_count == 5
+
+    @respx.mock
+    def test_timeout_after_retries(self, respx_mock: respx.Router):
+        route = respx_mock.get("/process-request").mock(
+            side_effect=httpx.ReadTimeout("slow")
+        )
+
+        with self.assertRaises(errors.APITimeoutError):
+            self.process(self.make_client(), method="GET")
+        assert route.call_count == 3
+
+    @respx.mock
+    def test_no_retries_by_default(self, respx_mock: respx.Router):
+        route = respx_mock.get("/process-request").mock(
+            return_value=httpx.Response(503)
+        )
+        cl = client.Client(api_key="test-api-key")
+
+        with self.assertRaises(errors.APIError):
+            self.process(cl, method="GET")
+        assert route.call_count == 1
+
+    def test_parse_retry_after(self):
+        assert retries.parse_retry_after("1.5") == 1.5
+        assert retries.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+        assert retries.parse_retry_after("soon") is None
+        assert retries.parse_retry_after(None) is None
+
+
+class TestClientMessageBuffer(unittest.TestCase):
+    messages_path = "/v1/sessions/sess_1234/agents/agent_1234/messages"
+    generate_path = "/v1/sessions/sess_1234/agents/agent_1234/generate_text"
+
+    def make_client(self, **kwargs):
+        return client.Client(
+            api_key="test-api-key", retry_policy=retries.NO_RETRIES, **kwargs
+        )
+
+    def buffer(self, cl, *contents):
+        return cl.buffer_messages(
+            session_id="sess_1234",
+            agent_id="agent_1234",
+            messages=[api_types.ContentMessage(content=c) for c in contents],
+        )
+
+    @staticmethod
+    def sent_contents(route, call=-1):
+        body = json.loads(route.calls[call].request.content)
+        return [m["content"] for m in body["messages"]]
+
+    @respx.mock
+    def test_buffered_messages_go_with_generate(self, respx_mock: respx.Router):
+        messages = respx_mock.post(self.messages_path)
+        generate = respx_mock.post(self.generate_path).mock(
+            return_value=httpx.Response(200, json={"moment_id": "1", "text": "Hi"})
+        )
+        cl = self.make_client()
+
+        assert self.buffer(cl, "It is snowing.", "The well froze.") is None
+        cl.generate_text(
+            session_id="sess_1234",
+            agent_id="agent_1234",
+            messages=[api_types.ContentMessage(content="What now?")],
+        )
+        cl.generate_text(session_id="sess_1234", agent_id="agent_1234")
+
+        assert not messages.called
+        assert self.sent_contents(generate, 0) == [
+            "It is snowing.",
+            "The well froze.",
+            "What now?",
+        ]
+        assert "messages" not in json.loads(generate.calls[1].request.content)
+
+    @respx.mock
+    def test_buffer_size_limit(self, respx_mock: respx.Router):
+        route = respx_mock.post(self.messages_path).mock(
+            return_value=httpx.Response(200, json={"moment_id": "1"})
+        )
+        cl = self.make_client(message_buffer_size=3)
+
+        assert self.buffer(cl, "one", "two") is None
+        assert self.buffer(cl, "three").moment_id == "1"
+        assert self.sent_contents(route) == ["one", "two", "three"]
+        assert len(cl._message_buffer) == 0
+
+    @respx.mock
+    def test_buffer_kept_when_generate_fails(self, respx_mock: respx.Router):
+        generate = respx_mock.post(self.generate_path).mock(
+            side_effect=[
+                httpx.Response(500),
+                httpx.Response(200, json={"moment_id": "1", "text": "Hi"}),
+            ]
+        )
+        cl = self.make_client()
+        self.buffer(cl, "It is snowing.")
+
+        with self.assertRaises(errors.APIError):
+            cl.generate_text(session_id="sess_1234", agent_id="agent_1234")
+        cl.generate_text(session_id="sess_1234", agent_id="agent_1234")
+
+        assert self.sent_contents(generate, 1) == ["It is snowing."]
+
+    @respx.mock
+    def test_flush_due_messages(self, respx_mock: respx.Router):
+        route = respx_mock.post(self.messages_path).mock(
+            return_value=httpx.Response(200, json={"moment_id": "1"})
+        )
+        cl = self.make_client(message_buffer_max_age=5.0)
+
+        with mock.patch("time.monotonic", return_value=100.0):
+            self.buffer(cl, "It is snowing.")
+        with mock.patch("time.monotonic", return_value=104.0):
+            assert cl.flush_due_messages() == []
+        with mock.patch("time.monotonic", return_value=105.0):
+            assert len(cl.flush_due_messages()) == 1
+
+        assert self.sent_contents(route) == ["It is snowing."]
+
+    @respx.mock
+    def test_close_flushes_messages(self, respx_mock: respx.Router):
+        route = respx_mock.post(self.messages_path).mock(
+            return_value=httpx.Response(200, json={"moment_id": "1"})
+        )
+
+        with self.make_client() as cl:
+            self.buffer(cl, "Goodbye.")
+
+        assert self.sent_contents(route) == ["Goodbye."]
+
+    @respx.mock
+    def test_close_closes_pool_when_flush_fails(self, respx_mock: respx.Router):
+        respx_mock.post(self.messages_path).mock(return_value=httpx.Response(500))
+        cl = self.make_client()
+        self.buffer(cl, "Goodbye.")
+
+        with self.assertRaises(errors.APIError):
+            cl.close()
+        assert cl.http_client.is_closed
+
+    @respx.mock
+    def test_exit_on_error_does_not_flush(self, respx_mock: respx.Router):
+        route = respx_mock.post(self.messages_path).mock(
+            return_value=httpx.Response(200, json={"moment_id": "1"})
+        )
+
+        with self.assertRaises(KeyError), self.assertWarns(RuntimeWarning):
+            with self.make_client() as cl:
+                self.buffer(cl, "Goodbye.")
+                raise KeyError("game crashed")
+        assert not route.called
+        assert cl.http_client.is_closed
@@ -8,104 +8,2698 @@ This script acts as a local HTTP proxy that:
 2. Makes HTTPS requests to external APIs
 3. Returns results to Love2D
 
+It can also act as a typed Artificial Agency facade: the proxy holds the API
+key and a pooled AsyncClient, and Love2D calls compact endpoints such as
+POST /agents/{id}/generate_text instead of building API requests itself.
+The facade needs the artificial_agency package
+(pip install -e examples/artificial-agency) and an API key.
+
 Usage:
-    python http_proxy.py
+    python http_proxy.py [port] [--max-request-bytes N] [--max-response-bytes N]
+                         [--spool-threshold-bytes N] [--api-key KEY] [--api-base-url URL]
+                         [--coalesce-window-ms N] [--coalesce-max-messages N]
+                         [--max-upstream N] [--max-queue N] [--max-queue-wait S]
+                         [--max-queue-timeout S]
+                         [--idempotency-ttl S] [--idempotency-max-entries N]
+                         [--slow-threshold-ms N] [--slow-buffer-size N] [--slow-dump-dir DIR]
+                         [--trace] [--trace-buffer-size N] [--profile]
+                         [--write-behind DB_PATH] [--write-behind-max-messages N]
+                         [--write-behind-workers N]
+                         [--client-max-active N] [--client-weight CLIENT=WEIGHT ...]
+                         [--max-templates N]
+                         [--shared-cache PATH] [--cache-max-bytes N] [--cache-ttl S]
+                         [--capture PATH]
 
 Then in Love2D, make requests to: http://localhost:8080/proxy
+
+Envelopes and responses are JSON by default. Sending Content-Type:
+application/msgpack (or Accept: application/msgpack) switches that direction
+to MessagePack, which is cheaper for Love2D to build and parse.
+
+A "fields" list in the envelope (or ?fields=a,b on any endpoint) trims a
+successful JSON reply down to a flat object holding just those paths, e.g.
+["text", "moment_id", "function_call.args"].
+
+POST /chain takes {"steps": [envelope, ...]} and runs them in order in one
+round trip; later steps can use earlier responses through references such as
+"{{$[0].id}}" in their url, headers or body.
+
+POST /templates/{name} registers an envelope template (url with {param}
+placeholders, headers, static body); POST /call/{name} with {"params": {...},
+"body": {...}} then sends it with only the parts that change.
+
+With --write-behind, an add_messages envelope carrying "write_behind": true is
+stored in a local SQLite queue and acknowledged with 202 straight away; the
+proxy delivers it in the background, in order per agent, with retries.
 """
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import urllib.request
 import urllib.parse
+import argparse
+import asyncio
+import http.client
+import collections
+import contextlib
+import gzip
+import hashlib
+import heapq
+import inspect
+import io
+import itertools
+import math
 import json
+import os
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
+
+# The agent facade is optional; plain proxying works with the standard library alone
+try:
+    import httpx
+    import pydantic
+    from artificial_agency import async_client as aa_async_client
+    from artificial_agency import constants as aa_constants
+    from artificial_agency import errors as aa_errors
+except ImportError:
+    aa_async_client = None
+
+# Size limits keep one oversized upload or upstream reply from exhausting memory.
+# Requests above MAX_REQUEST_BYTES are rejected with 413 before the body is read,
+# upstream responses above MAX_RESPONSE_BYTES are replaced with a 502.
+MAX_REQUEST_BYTES = 8 * 1024 * 1024
+MAX_RESPONSE_BYTES = 32 * 1024 * 1024
+
+# Bodies larger than this spill from memory to a temporary file on disk
+SPOOL_THRESHOLD_BYTES = 1024 * 1024
+
+# Bodies are copied between sockets and spool files in chunks of this size
+COPY_CHUNK_BYTES = 64 * 1024
+
+# Agents whose session the facade remembers; the least recently used are forgotten
+# and then need session_id in their requests again
+FACADE_MAX_AGENTS = 4096
+
+# Pending connections the listening socket holds before new ones are refused;
+# the socketserver default of 5 drops connections when many game clients connect at once
+LISTEN_BACKLOG = 128
+
+# add_messages coalescing: hold messages for an agent up to this long (0 disables)
+# and flush early once a batch reaches this many messages
+COALESCE_WINDOW_MS = 0
+COALESCE_MAX_MESSAGES = 64
+
+# Admission control: at most MAX_UPSTREAM calls run upstream at once (0 = no limit).
+# Extra requests queue, and are shed with 503 once the queue holds MAX_QUEUE
+# requests or the estimated wait exceeds MAX_QUEUE_WAIT seconds. A queued request
+# that still has no slot after MAX_QUEUE_TIMEOUT seconds (e.g. the API stalled) is
+# shed with 503 as well.
+MAX_UPSTREAM = 0
+MAX_QUEUE = 32
+MAX_QUEUE_WAIT = 10.0
+MAX_QUEUE_TIMEOUT = 30.0
+
+# Priorities from the X-Proxy-Priority header. Lower priorities get a smaller share
+# of the queue limits, so they are shed first and always served last.
+PRIORITY_SHARE = {'high': 1.0, 'normal': 0.75, 'low': 0.5}
+PRIORITY_RANK = {'high': 0, 'normal': 1, 'low': 2}
+DEFAULT_PRIORITY = 'normal'
+
+# Fair queuing: upstream slots are shared between clients, identified by the
+# X-Proxy-Client header or else the source address. Clients beyond
+# CLIENT_MAX_TRACKED share one CLIENT_OVERFLOW bucket; the write-behind queue
+# drains as its own client.
+DEFAULT_CLIENT = 'default'
+WRITE_BEHIND_CLIENT = 'write-behind'
+CLIENT_MAX_TRACKED = 256
+CLIENT_OVERFLOW = 'other'
+
+# Idempotency-Key replay: completed responses are kept for IDEMPOTENCY_TTL seconds
+# (0 disables), at most IDEMPOTENCY_MAX_ENTRIES of them, each up to
+# IDEMPOTENCY_MAX_RESPONSE_BYTES. Duplicates of an in-flight request wait for
+# it for up to IDEMPOTENCY_WAIT_SECONDS.
+IDEMPOTENCY_TTL = 600
+IDEMPOTENCY_MAX_ENTRIES = 512
+IDEMPOTENCY_MAX_RESPONSE_BYTES = 256 * 1024
+IDEMPOTENCY_WAIT_SECONDS = 60
+# With a shared cache, the first process to see a key claims it there; other processes
+# poll the claim every IDEMPOTENCY_POLL_SECONDS, and a claim whose process died
+# without finishing lapses after IDEMPOTENCY_CLAIM_SECONDS
+IDEMPOTENCY_POLL_SECONDS = 0.1
+IDEMPOTENCY_CLAIM_SECONDS = 120
+
+# Slow-request flight recorder: requests slower than SLOW_THRESHOLD_MS are kept
+# in a ring buffer of SLOW_BUFFER_SIZE entries for GET /debug/slow or a signal dump
+SLOW_THRESHOLD_MS = 2000
+SLOW_BUFFER_SIZE = 100
+SLOW_HEADER_VALUE_CHARS = 200
+REDACTED_HEADERS = ('authorization', 'proxy-authorization', 'cookie', 'x-api-key')
+
+# Chrome trace export: with --trace, the last TRACE_BUFFER_SIZE requests are kept
+# and GET /debug/trace?seconds=N exports those from the last N seconds
+TRACE_BUFFER_SIZE = 5000
+TRACE_DEFAULT_SECONDS = 60
+
+# Trace span name for the phase that ends at each request mark
+TRACE_PHASES = {
+    'body_read': 'read request',
+    'admitted': 'queued',
+    'connected': 'connecting',
+    'request_sent': 'sending',
+    'upstream_headers': 'upstream wait',
+    'upstream_done': 'upstream body',
+    'batch_done': 'coalesced batch',
+    'facade_done': 'agent api call',
+    'sent': 'relaying',
+}
+
+# On-demand sampling profiler: with --profile, GET /debug/profile?seconds=N samples
+# every thread's stack each PROFILE_INTERVAL_MS for N seconds (at most PROFILE_MAX_SECONDS)
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 120
+PROFILE_INTERVAL_MS = 5
+
+# Write-behind queue for fire-and-forget add_messages envelopes ("write_behind": true):
+# at most WRITE_BEHIND_MAX_MESSAGES messages per drained call, WRITE_BEHIND_WORKERS
+# agents drained at once, failed calls retried after WRITE_BEHIND_RETRY_BASE seconds,
+# doubling up to WRITE_BEHIND_RETRY_MAX
+WRITE_BEHIND_MAX_MESSAGES = 64
+WRITE_BEHIND_WORKERS = 2
+WRITE_BEHIND_RETRY_BASE = 1.0
+WRITE_BEHIND_RETRY_MAX = 60.0
+
+# Per-client series on GET /metrics: (name, Prometheus type, help)
+CLIENT_METRICS = (
+    ('weight', 'gauge', "Fair-queuing weight"),
+    ('active', 'gauge', "Upstream calls in progress"),
+    ('queued', 'gauge', "Requests waiting for an upstream slot"),
+    ('admitted_total', 'counter', "Requests given an upstream slot"),
+    ('shed_total', 'counter', "Requests rejected with 503"),
+    ('upstream_seconds_total', 'counter', "Upstream time used"),
+    ('avg_upstream_seconds', 'gauge', "Moving average upstream call duration"),
+)
+
+# Request chains: POST /chain runs up to CHAIN_MAX_STEPS envelopes in order
+CHAIN_MAX_STEPS = 16
+
+# Registered request templates: at most TEMPLATE_MAX_COUNT names are kept (0 disables)
+TEMPLATE_MAX_COUNT = 256
+
+# Shared response cache (--shared-cache PATH): a memory-mapped SQLite file that
+# every proxy process on the host can use. GET envelopes are cached for
+# CACHE_TTL seconds unless Cache-Control says otherwise, the file is kept under
+# CACHE_MAX_BYTES, and Idempotency-Key replays are shared through it too.
+CACHE_TTL = 30
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Last-use times are only rewritten this often, so hot entries do not turn reads into writes
+CACHE_TOUCH_SECONDS = 1.0
+
+# Traffic capture (--capture PATH): one JSON line per POST with its arrival time,
+# the proxy headers below and the envelope with secrets redacted; gzip when PATH
+# ends in .gz. An existing file is overwritten, since arrival times are relative to
+# the start of the run. Lines are flushed at least every CAPTURE_FLUSH_SECONDS.
+CAPTURE_HEADERS = ('X-Proxy-Client', 'X-Proxy-Priority', 'Idempotency-Key', 'Accept')
+CAPTURE_REDACTED_KEYS = frozenset(REDACTED_HEADERS) | {'api_key', 'password', 'secret', 'token', 'access_token'}
+CAPTURE_FLUSH_SECONDS = 1.0
+# Envelope headers the proxy fills in while forwarding; recomputed on replay
+CAPTURE_DROPPED_KEYS = frozenset({'content-length'})
+
+# Content types that select MessagePack instead of JSON
+MSGPACK_CONTENT_TYPES = ('application/msgpack', 'application/x-msgpack')
+# Deepest array/map nesting accepted in a MessagePack request body
+MSGPACK_MAX_DEPTH = 64
+
+# Upstream add_messages endpoint, used to recognise coalescable /proxy envelopes
+ADD_MESSAGES_PATH = re.compile(r'/v1/sessions/[^/]+/agents/[^/]+/messages/?$')
+
+
+class BodyTooLarge(Exception):
+    """Raised when a body grows past its configured size limit."""
+
+
+def _copy_limited(source, dest, limit, length=None):
+    """Copy up to `length` bytes (or until EOF) from source to dest in chunks.
+
+    Raises BodyTooLarge as soon as more than `limit` bytes have been seen, so
+    an oversized body never has to be held in full.
+    Returns the number of bytes copied.
+    """
+    copied = 0
+    while length is None or copied < length:
+        want = COPY_CHUNK_BYTES if length is None else min(COPY_CHUNK_BYTES, length - copied)
+        chunk = source.read(want)
+        if not chunk:
+            break
+        copied += len(chunk)
+        if copied > limit:
+            raise BodyTooLarge(f"Body exceeds {limit} bytes")
+        dest.write(chunk)
+    return copied
+
+
+def _spool():
+    """Create a buffer that stays in memory until SPOOL_THRESHOLD_BYTES, then moves to disk."""
+    return tempfile.SpooledTemporaryFile(max_size=ProxyHandler.spool_threshold_bytes)
+
+
+def msgpack_dumps(value):
+    """Encode a JSON-compatible value as MessagePack bytes"""
+    out = bytearray()
+    _msgpack_pack(value, out)
+    return bytes(out)
+
+
+def _msgpack_pack_length(out, length, fix_base, fix_max, code16, code32, code8=None):
+    if length <= fix_max:
+        out.append(fix_base + length)
+    elif code8 is not None and length < 0x100:
+        out += bytes((code8, length))
+    elif length < 0x10000:
+        out.append(code16)
+        out += struct.pack('>H', length)
+    else:
+        out.append(code32)
+        out += struct.pack('>I', length)
+
+
+def _msgpack_pack(value, out):
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -32 <= value < 0:
+            out.append(value & 0xff)
+        elif 0 <= value < 2 ** 64:
+            for code, fmt, limit in ((0xcc, '>B', 2 ** 8), (0xcd, '>H', 2 ** 16),
+                                     (0xce, '>I', 2 ** 32), (0xcf, '>Q', 2 ** 64)):
+                if value < limit:
+                    out.append(code)
+                    out += struct.pack(fmt, value)
+                    break
+        elif -2 ** 63 <= value < 0:
+            for code, fmt, limit in ((0xd0, '>b', 2 ** 7), (0xd1, '>h', 2 ** 15),
+                                     (0xd2, '>i', 2 ** 31), (0xd3, '>q', 2 ** 63)):
+                if value >= -limit:
+                    out.append(code)
+                    out += struct.pack(fmt, value)
+                    break
+        else:
+            out.append(0xcb)
+            out += struct.pack('>d', float(value))
+    elif isinstance(value, float):
+        out.append(0xcb)
+        out += struct.pack('>d', value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        _msgpack_pack_length(out, len(data), 0xa0, 31, 0xda, 0xdb, code8=0xd9)
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        _msgpack_pack_length(out, len(value), 0xc4, -1, 0xc5, 0xc6, code8=0xc4)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        _msgpack_pack_length(out, len(value), 0x90, 15, 0xdc, 0xdd)
+        for item in value:
+            _msgpack_pack(item, out)
+    elif isinstance(value, dict):
+        _msgpack_pack_length(out, len(value), 0x80, 15, 0xde, 0xdf)
+        for key, item in value.items():
+            _msgpack_pack(key, out)
+            _msgpack_pack(item, out)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__} as MessagePack")
+
+
+def msgpack_loads(data):
+    """Decode MessagePack bytes; raises ValueError on malformed input"""
+    try:
+        value, _ = _msgpack_unpack(data, 0, MSGPACK_MAX_DEPTH)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError, RecursionError) as e:
+        raise ValueError(f"Invalid MessagePack: {e}")
+    return value
+
+
+# Fixed-width MessagePack scalars: type code -> struct format
+_MSGPACK_SCALARS = {
+    0xca: '>f', 0xcb: '>d',
+    0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+    0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+}
+# Variable-length MessagePack types: type code -> (kind, length format)
+_MSGPACK_SIZED = {
+    0xc4: ('bin', '>B'), 0xc5: ('bin', '>H'), 0xc6: ('bin', '>I'),
+    0xd9: ('str', '>B'), 0xda: ('str', '>H'), 0xdb: ('str', '>I'),
+    0xdc: ('array', '>H'), 0xdd: ('array', '>I'),
+    0xde: ('map', '>H'), 0xdf: ('map', '>I'),
+}
+
+
+def _msgpack_unpack(data, pos, depth):
+    code = data[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if code == 0xc0:
+        return None, pos
+    if code in (0xc2, 0xc3):
+        return code == 0xc3, pos
+    if code in _MSGPACK_SCALARS:
+        fmt = _MSGPACK_SCALARS[code]
+        return struct.unpack_from(fmt, data, pos)[0], pos + struct.calcsize(fmt)
+
+    if code < 0x90:
+        kind, length = 'map', code - 0x80
+    elif code < 0xa0:
+        kind, length = 'array', code - 0x90
+    elif code < 0xc0:
+        kind, length = 'str', code - 0xa0
+    elif code in _MSGPACK_SIZED:
+        kind, fmt = _MSGPACK_SIZED[code]
+        length = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+    else:
+        raise ValueError(f"unsupported type 0x{code:02x}")
+
+    if depth <= 0:
+        raise ValueError("nested too deeply")
+    if kind in ('str', 'bin'):
+        chunk = bytes(data[pos:pos + length])
+        if len(chunk) != length:
+            raise IndexError("truncated data")
+        return (chunk.decode('utf-8') if kind == 'str' else chunk), pos + length
+    if kind == 'array':
+        items = []
+        for _ in range(length):
+            item, pos = _msgpack_unpack(data, pos, depth - 1)
+            items.append(item)
+        return items, pos
+    result = {}
+    for _ in range(length):
+        key, pos = _msgpack_unpack(data, pos, depth - 1)
+        result[key], pos = _msgpack_unpack(data, pos, depth - 1)
+    return result, pos
+
+
+class Overloaded(Exception):
+    """Raised when admission control sheds a request; carries a Retry-After hint."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Proxy overloaded, retry in {retry_after} s")
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self):
+        self.granted = False
+
+
+class _ClientState:
+    """Queue, deficit and counters for one client under fair queuing."""
+
+    def __init__(self, weight):
+        self.weight = weight
+        # Heap of (priority rank, arrival order, _Waiter)
+        self.queue = []
+        self.deficit = 0.0
+        # Whether this client already got its quantum for the current visit
+        self.topped_up = False
+        self.active = 0
+        self.admitted = 0
+        self.shed = 0
+        self.upstream_seconds = 0.0
+        # Moving average of this client's upstream call duration: its cost per request.
+        # None until its first call finishes; the global average stands in until then
+        self.service_seconds = None
+
+
+class AdmissionController:
+    """Bound concurrent upstream calls, share them fairly and shed load.
+
+    Requests beyond `max_active` wait in per-client queues, ordered by priority
+    within each client. Free slots go to clients by deficit round-robin: each
+    visit adds a quantum of upstream time (scaled by the client's weight) and a
+    request runs once its client's deficit covers that client's average call
+    duration, so every client gets a fair share of upstream time however many
+    requests it sends. `client_max_active` optionally caps the slots one client
+    holds at once.
+
+    A new request is rejected immediately when the queue is already too deep or
+    its estimated wait is too long; both limits shrink for lower priorities, so
+    low priority traffic goes first, and a client's own backlog counts against
+    it, so a noisy client is shed before quiet ones. A queued request that is
+    not granted a slot within `queue_timeout` seconds is shed too.
+    """
+
+    # Starting guess for upstream call duration, refined by a moving average
+    INITIAL_SERVICE_SECONDS = 1.0
+
+    def __init__(self, max_active, max_queue, max_wait, client_max_active=0, client_weights=None,
+                 queue_timeout=MAX_QUEUE_TIMEOUT):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.queue_timeout = queue_timeout
+        self.client_max_active = client_max_active
+        self.client_weights = client_weights or {}
+        self.active = 0
+        self.admitted = 0
+        self.shed = 0
+        self.service_seconds = self.INITIAL_SERVICE_SECONDS
+        self._cond = threading.Condition()
+        # client id -> _ClientState
+        self._clients = {}
+        # Clients with queued requests, in round-robin order
+        self._round = collections.deque()
+        self._queued = 0
+        self._order = itertools.count()
+
+    def estimated_wait(self, ahead):
+        """Seconds a request with `ahead` requests in front of it can expect to wait"""
+        return (ahead + 1) * self.service_seconds / self.max_active
+
+    def _client(self, client):
+        """(client id, _ClientState) to account a request to, creating it on first use"""
+        if client not in self._clients and len(self._clients) >= CLIENT_MAX_TRACKED:
+            # Unbounded client ids (e.g. a header per request) share one bucket
+            client = CLIENT_OVERFLOW
+        state = self._clients.get(client)
+        if state is None:
+            state = self._clients[client] = _ClientState(self.client_weights.get(client, 1.0))
+        return client, state
+
+    def _cost(self, state):
+        """Upstream seconds a client's next request is expected to take"""
+        return self.service_seconds if state.service_seconds is None else state.service_seconds
+
+    def _at_quota(self, state):
+        return 0 < self.client_max_active <= state.active
+
+    def _admit(self, priority, client):
+        rank = PRIORITY_RANK[priority]
+        share = PRIORITY_SHARE[priority]
+        with self._cond:
+            client, state = self._client(client)
+            if self.active < self.max_active and not self._queued and not self._at_quota(state):
+                self._start(state)
+                return state
+
+            # Under round-robin a request waits behind its own client's backlog,
+            # interleaved with one request from each other waiting client
+            own = sum(1 for entry in state.queue if entry[0] <= rank)
+            wait = self.estimated_wait(own * max(1, len(self._round)))
+            if self._queued >= self.max_queue * share or wait > self.max_wait * share:
+                self.shed += 1
+                state.shed += 1
+                raise Overloaded(max(1, math.ceil(wait)))
+
+            waiter = _Waiter()
+            heapq.heappush(state.queue, (rank, next(self._order), waiter))
+            self._queued += 1
+            if len(state.queue) == 1:
+                self._round.append(client)
+            self._grant()
+            deadline = time.monotonic() + self.queue_timeout
+            while not waiter.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._abandon(client, state, waiter)
+                    raise Overloaded(max(1, math.ceil(self.estimated_wait(self._queued))))
+                self._cond.wait(remaining)
+            return state
+
+    def _abandon(self, client, state, waiter):
+        """Take a request that timed out of its client's queue"""
+        state.queue = [entry for entry in state.queue if entry[2] is not waiter]
+        heapq.heapify(state.queue)
+        self._queued -= 1
+        self.shed += 1
+        state.shed += 1
+        if not state.queue:
+            state.deficit = 0.0
+            state.topped_up = False
+            self._round.remove(client)
+
+    def _start(self, state):
+        self.active += 1
+        self.admitted += 1
+        state.active += 1
+        state.admitted += 1
+
+    def _grant(self):
+        """Hand free slots to waiting clients in deficit round-robin order"""
+        granted = False
+        while self.active < self.max_active and self._round:
+            eligible = [c for c in self._round if not self._at_quota(self._clients[c])]
+            if not eligible:
+                break
+            while True:
+                client = self._round[0]
+                state = self._clients[client]
+                if self._at_quota(state):
+                    state.topped_up = False
+                    self._round.rotate(-1)
+                    continue
+                if not state.topped_up:
+                    state.deficit += self.service_seconds * state.weight
+                    state.topped_up = True
+                if state.deficit >= self._cost(state):
+                    break
+                state.topped_up = False
+                self._round.rotate(-1)
+
+            state.deficit -= self._cost(state)
+            heapq.heappop(state.queue)[2].granted = True
+            self._queued -= 1
+            self._start(state)
+            granted = True
+            if not state.queue:
+                # Idle clients do not bank credit
+                state.deficit = 0.0
+                state.topped_up = False
+                self._round.popleft()
+        if granted:
+            self._cond.notify_all()
+
+    def _release(self, state, duration):
+        with self._cond:
+            state.service_seconds = 0.8 * self._cost(state) + 0.2 * duration
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * duration
+            state.upstream_seconds += duration
+            state.active -= 1
+            self.active -= 1
+            self._grant()
+
+    @contextlib.contextmanager
+    def slot(self, priority=DEFAULT_PRIORITY, client=DEFAULT_CLIENT):
+        """Hold one upstream slot for the duration of the block; raises Overloaded"""
+        state = self._admit(priority, client)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(state, time.monotonic() - started)
+
+    def stats(self):
+        with self._cond:
+            return {"active": self.active, "queued": self._queued,
+                    "admitted": self.admitted, "shed": self.shed,
+                    "avg_upstream_seconds": round(self.service_seconds, 3)}
+
+    def client_stats(self):
+        """Per-client counters for /metrics"""
+        with self._cond:
+            return {client: {"weight": state.weight, "active": state.active,
+                             "queued": len(state.queue), "admitted": state.admitted,
+                             "shed": state.shed, "upstream_seconds": state.upstream_seconds,
+                             "avg_upstream_seconds": self._cost(state)}
+                    for client, state in self._clients.items()}
+
+
+def _upstream_slot(admission, priority, client=None):
+    """Admission slot when admission control is enabled, otherwise a no-op"""
+    if admission is None:
+        return contextlib.nullcontext()
+    return admission.slot(priority, client or DEFAULT_CLIENT)
+
+
+class SharedCache:
+    """Size-bounded key/value cache in a memory-mapped SQLite file shared between proxy processes.
+
+    Any number of proxy processes can open the same file. SQLite's file locks
+    serialise writers across processes and WAL lets readers run alongside
+    them; with mmap the pages are shared through the OS page cache rather than
+    copied per process, so every process sees the same hit rate. Entries expire
+    after their TTL, and once the file holds more than `max_bytes` of values the
+    least recently used entries are evicted. Cache errors (e.g. a lock held too
+    long) count as misses and never fail a request.
+    """
+
+    def __init__(self, path, max_bytes, default_ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(f'PRAGMA mmap_size={2 * max_bytes}')
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cache_used ON cache (used);
+        """)
+
+    def get(self, key):
+        """Cached bytes for `key`, or None when missing or expired"""
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._db.execute('SELECT value, expires, used FROM cache WHERE key = ?',
+                                       (key,)).fetchone()
+                if row is None or row[1] <= now:
+                    self.misses += 1
+                    return None
+                if now - row[2] > CACHE_TOUCH_SECONDS:
+                    self._db.execute('UPDATE cache SET used = ? WHERE key = ?', (now, key))
+            except sqlite3.Error:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, key, value, ttl):
+        """Store `value` for `ttl` seconds, evicting least recently used entries to stay in bounds.
+
+        Returns whether the value was stored.
+        """
+        return self._store(key, value, ttl, replace=True) is None
+
+    def add(self, key, value, ttl):
+        """Store `value` only if `key` has no live entry; returns None if stored, else the current value.
+
+        The check and the insert are one transaction, so of several processes
+        adding the same key exactly one succeeds.
+        """
+        return self._store(key, value, ttl, replace=False)
+
+    def _store(self, key, value, ttl, replace):
+        if len(value) > self.max_bytes // 4:
+            return value
+        now = time.time()
+        with self._lock:
+            try:
+                # IMMEDIATE takes the write lock up front, so the size check and
+                # eviction see a consistent file across processes
+                self._db.execute('BEGIN IMMEDIATE')
+                try:
+                    row = None
+                    if not replace:
+                        row = self._db.execute('SELECT value FROM cache WHERE key = ? AND expires > ?',
+                                               (key, now)).fetchone()
+                    if row is None:
+                        self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                                         (key, value, len(value), now + ttl, now))
+                        self._evict(now)
+                    self._db.execute('COMMIT')
+                except BaseException:
+                    self._db.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error:
+                # Treated like a miss: the caller goes ahead as if it had stored the value
+                return None
+            return None if row is None else bytes(row[0])
+
+    def delete(self, key):
+        with self._lock:
+            try:
+                self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            except sqlite3.Error:
+                pass
+
+    def _evict(self, now):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        total -= self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cache WHERE expires <= ?',
+                                  (now,)).fetchone()[0]
+        self.evicted += self._db.execute('DELETE FROM cache WHERE expires <= ?', (now,)).rowcount
+        doomed = []
+        for key, size in self._db.execute('SELECT key, size FROM cache ORDER BY used'):
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        self._db.executemany('DELETE FROM cache WHERE key = ?', doomed)
+        self.evicted += len(doomed)
+
+    def stats(self):
+        with self._lock:
+            try:
+                entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+            except sqlite3.Error:
+                entries = size = None
+        return {"entries": entries, "bytes": size, "hits": self.hits, "misses": self.misses,
+                "evicted": self.evicted}
+
+
+def _cache_ttl(headers, default):
+    """Seconds a response may be cached, from its Cache-Control header or the default"""
+    cache_control = next((v for h, v in headers.items() if h.lower() == 'cache-control'), '').lower()
+    if any(directive in cache_control for directive in ('no-store', 'no-cache', 'private')):
+        return 0
+    match = re.search(r'max-age=(\d+)', cache_control)
+    return int(match.group(1)) if match else default
+
+
+class _IdempotencyEntry:
+    def __init__(self, digest, remote=False):
+        self.digest = digest
+        self.created = time.monotonic()
+        self.done = threading.Event()
+        # Raw HTTP response bytes once completed; None if the owner gave up
+        self.response = None
+        # Whether another proxy process owns the key, so completion shows up in the shared cache
+        self.remote = remote
+
+
+class IdempotencyStore:
+    """Bounded, TTL-evicted map of idempotency keys to in-flight or completed responses.
+
+    The first request for a key owns it and runs normally. Duplicates wait for
+    the owner and replay its stored response instead of repeating the upstream
+    side effect. If the owner's response is not worth keeping (a 5xx, 429 or
+    an oversized body) the key is released and the next duplicate runs again.
+
+    Only completed entries are evicted: dropping an in-flight one would let a
+    retry run the call a second time. When every entry is in flight, new keys
+    are refused with Overloaded.
+
+    With a SharedCache the owner also claims the key there before running, so
+    a duplicate that reaches another proxy process waits for (or replays) the
+    owner's response instead of running the call again.
+    """
+
+    def __init__(self, ttl, max_entries, shared=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Optional SharedCache, so keys are claimed and replayed across proxy processes
+        self.shared = shared
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def _evict(self):
+        now = time.monotonic()
+        # Entries to drop beyond the expired ones, leaving room for one new key
+        excess = len(self._entries) - self.max_entries + 1
+        for key, entry in list(self._entries.items()):
+            if not entry.done.is_set():
+                continue
+            if excess <= 0 and now - entry.created < self.ttl:
+                break  # Entries are oldest first, so the rest are fresh too
+            del self._entries[key]
+            excess -= 1
+
+    def begin(self, key, digest):
+        """Return (entry, owner); owner is True when the caller should run the request.
+
+        Raises Overloaded when the store is full of in-flight requests.
+        """
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry, False
+            if len(self._entries) >= self.max_entries:
+                raise Overloaded(1)
+            if self.shared is not None:
+                stored = self.shared.add(self._shared_key(key), self._pending_row(digest),
+                                         IDEMPOTENCY_CLAIM_SECONDS)
+                if stored is not None:
+                    entry = self._from_row(stored)
+                    if entry.remote:
+                        # Still running in another proxy process; the caller waits for it
+                        return entry, False
+                    # Completed by another proxy process: replay its response
+                    self._entries[key] = entry
+                    return entry, False
+            entry = _IdempotencyEntry(digest)
+            self._entries[key] = entry
+            return entry, True
+
+    def wait(self, key, entry, timeout):
+        """Wait up to `timeout` seconds for the owner of `entry` to finish; False on timeout.
+
+        Afterwards entry.response holds the response to replay, or None when the
+        owner gave up and the caller should try to take the key over.
+        """
+        if not entry.remote:
+            return entry.done.wait(timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            stored = self.shared.get(self._shared_key(key))
+            if stored is None:
+                return True
+            current = self._from_row(stored)
+            if not current.remote:
+                entry.response = current.response
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+    # Shared cache rows: b"pending\n<digest>\n" while the owner runs, then b"done\n<digest>\n<response>"
+    @staticmethod
+    def _pending_row(digest):
+        return b'pending\n' + digest.encode('ascii') + b'\n'
+
+    @staticmethod
+    def _from_row(row):
+        state, _, rest = row.partition(b'\n')
+        digest, _, response = rest.partition(b'\n')
+        entry = _IdempotencyEntry(digest.decode('ascii'), remote=state == b'pending')
+        if not entry.remote:
+            entry.response = response
+            entry.done.set()
+        return entry
+
+    @staticmethod
+    def _shared_key(key):
+        # Hashed so the credential in the key is not written to the cache file
+        return 'idempotency:' + hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+    def complete(self, key, entry, response):
+        entry.response = response
+        entry.done.set()
+        if self.shared is not None:
+            row = b'done\n' + entry.digest.encode('ascii') + b'\n' + response
+            if not self.shared.put(self._shared_key(key), row, self.ttl):
+                # Too large to share: release the claim so other processes do not wait on it
+                self.shared.delete(self._shared_key(key))
+
+    def abandon(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.done.set()
+        if self.shared is not None:
+            self.shared.delete(self._shared_key(key))
+
+
+class _TeeWriter:
+    """Write-through wrapper that keeps a copy of everything written, up to a limit."""
+
+    def __init__(self, wrapped, limit):
+        self.wrapped = wrapped
+        self.limit = limit
+        self.captured = bytearray()
+        self.overflow = False
+
+    def write(self, data):
+        if not self.overflow:
+            if len(self.captured) + len(data) > self.limit:
+                self.overflow = True
+                self.captured = bytearray()
+            else:
+                self.captured += data
+        return self.wrapped.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+
+def _safe_headers(headers):
+    """Copy headers for diagnostics with secrets redacted and long values truncated"""
+    if not headers:
+        return {}
+    safe = {}
+    for name, value in headers.items():
+        if name.lower() in REDACTED_HEADERS:
+            safe[name] = '<redacted>'
+        else:
+            safe[name] = str(value)[:SLOW_HEADER_VALUE_CHARS]
+    return safe
+
+
+def redact_secrets(value):
+    """Copy a decoded envelope with credential headers and secret-looking fields replaced"""
+    if isinstance(value, dict):
+        return {key: '<redacted>' if str(key).lower() in CAPTURE_REDACTED_KEYS else redact_secrets(item)
+                for key, item in value.items() if str(key).lower() not in CAPTURE_DROPPED_KEYS}
+    if isinstance(value, list):
+        return [redact_secrets(item) for item in value]
+    return value
+
+
+class TrafficCapture:
+    """Write every proxied POST to a JSON lines file for later replay with proxy_replay.py.
+
+    Each line holds the arrival time relative to the start of the capture, the
+    path, the proxy headers that shape handling, the envelope with secrets
+    redacted, and the status and duration the proxy saw. The file is truncated
+    on open, since lines from an earlier run would interleave with this one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        opener = gzip.open if path.endswith('.gz') else open
+        self._file = opener(path, 'wt', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._flushed = time.monotonic()
+
+    def observe(self, handler, payload):
+        received = handler.marks[0][1]
+        record = {
+            "t": round(received - self._origin, 6),
+            "path": handler.path,
+            "headers": {h: handler.headers[h] for h in CAPTURE_HEADERS if h in handler.headers},
+            "payload": redact_secrets(payload),
+            "status": handler.response_status,
+            "ms": round((handler.marks[-1][1] - received) * 1000, 3),
+        }
+        line = json.dumps(record, separators=(',', ':'), default=self._encode_extra) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+            if time.monotonic() - self._flushed >= CAPTURE_FLUSH_SECONDS:
+                self._file.flush()
+                self._flushed = time.monotonic()
+
+    @staticmethod
+    def _encode_extra(value):
+        # MessagePack envelopes can carry raw bytes
+        return value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class SlowRequestRecorder:
+    """Ring buffer of the requests that took longer than a latency threshold.
+
+    Handlers always collect a handful of timestamps; observe() only keeps a
+    reference to that raw data when a request turns out to be slow, and all
+    formatting is deferred until someone asks for a dump.
+    """
+
+    def __init__(self, threshold, capacity):
+        self.threshold = threshold
+        self._records = collections.deque(maxlen=capacity)
+
+    def observe(self, handler, total):
+        if total < self.threshold:
+            return
+        self._records.append((
+            time.time(), total, handler.command, handler.path, handler.marks,
+            handler.response_status, handler.upstream_status,
+            int(handler.headers.get('Content-Length', 0) or 0), handler.response_bytes,
+            handler.headers, handler.target_url, handler.target_headers,
+        ))
+
+    def dump(self):
+        """Format the recorded requests, oldest first"""
+        records = []
+        for (at, total, method, path, marks, status, upstream_status, request_bytes,
+             response_bytes, headers, target_url, target_headers) in list(self._records):
+            start = marks[0][1]
+            records.append({
+                "at": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(at)),
+                "method": method,
+                "path": path,
+                "target": target_url,
+                "status": status,
+                "upstream_status": upstream_status,
+                "request_bytes": request_bytes,
+                "response_bytes": response_bytes,
+                "total_ms": round(total * 1000, 1),
+                "phases_ms": {name: round((t - start) * 1000, 1) for name, t in marks},
+                "headers": _safe_headers(headers),
+                "upstream_headers": _safe_headers(target_headers),
+            })
+        return {"threshold_ms": round(self.threshold * 1000), "records": records}
+
+    def write(self, directory):
+        """Write a dump to a timestamped JSON file in `directory`; returns its path"""
+        path = os.path.join(directory, time.strftime('slow_requests_%Y%m%d_%H%M%S.json'))
+        with open(path, 'w') as f:
+            json.dump(self.dump(), f, indent=2)
+        return path
+
+
+# The handler serving the current thread's request, so upstream connections can mark it
+_request_context = threading.local()
+
+
+def _mark_current(name):
+    handler = getattr(_request_context, 'handler', None)
+    if handler is not None:
+        handler._mark(name)
+
+
+class _TracedHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection that marks when it has connected and when the request is sent"""
+
+    def connect(self):
+        super().connect()
+        _mark_current('connected')
+
+    def getresponse(self):
+        _mark_current('request_sent')
+        return super().getresponse()
+
+
+class _TracedHTTPSConnection(http.client.HTTPSConnection):
+    def connect(self):
+        super().connect()
+        _mark_current('connected')
+
+    def getresponse(self):
+        _mark_current('request_sent')
+        return super().getresponse()
+
+
+class _TracedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_TracedHTTPConnection, req)
+
+
+class _TracedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_TracedHTTPSConnection, req, context=self._context)
+
+
+# urllib opener whose connections report their connect/send phases
+_OPENER = urllib.request.build_opener(_TracedHTTPHandler, _TracedHTTPSHandler)
+
+
+class TraceRecorder:
+    """Keep recent request timelines and export them as Chrome trace events.
+
+    Spans are built from the same marks the flight recorder uses, one row per
+    handler thread, so overlapping requests and queueing show up side by side
+    in about:tracing or Perfetto.
+    """
+
+    def __init__(self, capacity):
+        self._origin = time.perf_counter()
+        self._records = collections.deque(maxlen=capacity)
+
+    def observe(self, handler):
+        self._records.append((threading.get_ident(), threading.current_thread().name,
+                              handler.command, handler.path, handler.target_url,
+                              handler.response_status, handler.marks))
+
+    def export(self, seconds):
+        """Chrome trace event JSON for requests that finished in the last `seconds`"""
+        cutoff = time.perf_counter() - seconds
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for tid, thread_name, method, path, target, status, marks in list(self._records):
+            if marks[-1][1] < cutoff:
+                continue
+            threads[tid] = thread_name
+            start, end = marks[0][1], marks[-1][1]
+            events.append({
+                "name": f"{method} {path}", "cat": "request", "ph": "X",
+                "ts": self._micros(start), "dur": self._micros(end) - self._micros(start),
+                "pid": pid, "tid": tid,
+                "args": {"target": target, "status": status},
+            })
+            for (_, begin), (name, finish) in zip(marks, marks[1:]):
+                events.append({
+                    "name": TRACE_PHASES.get(name, name), "cat": "phase", "ph": "X",
+                    "ts": self._micros(begin), "dur": self._micros(finish) - self._micros(begin),
+                    "pid": pid, "tid": tid,
+                })
+        for tid, thread_name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                           "args": {"name": thread_name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def _micros(self, t):
+        return int((t - self._origin) * 1_000_000)
+
+
+# Only one profile runs at a time; overlapping captures would sample each other
+_profile_lock = threading.Lock()
+
+
+# ThreadingHTTPServer names each handler thread "Thread-N (target)"; drop the N so
+# all handler threads merge into one flamegraph root
+_NUMBERED_THREAD = re.compile(r'^Thread-\d+ \((.+)\)$')
+
+
+def _thread_label(name):
+    match = _NUMBERED_THREAD.match(name)
+    return match.group(1) if match else name
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds, interval):
+    """Sample all other threads' stacks for `seconds`; returns collapsed-stack lines.
+
+    Each line is "thread;outer;...;inner count", the input flamegraph.pl and
+    speedscope expect. Sampling only reads sys._current_frames(), so the
+    threads being profiled are not slowed down beyond the GIL hand-offs.
+    """
+    own = threading.get_ident()
+    counts = collections.Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(_thread_label(names.get(ident, f"thread-{ident}")))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return [f"{stack} {count}" for stack, count in counts.most_common()]
+
+
+# One step of a field path: a [index] or a key between dots
+_FIELD_PATH_STEP = re.compile(r'\[(\d+)\]|([^.\[\]]+)')
+
+
+def _lookup_field(value, path):
+    """Follow a dotted path such as "$.function_call.args" or "items[0].name"; None if missing"""
+    if path.startswith('$'):
+        path = path[1:]
+    for index, key in _FIELD_PATH_STEP.findall(path):
+        if key:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        else:
+            if not isinstance(value, list) or int(index) >= len(value):
+                return None
+            value = value[int(index)]
+    return value
+
+
+def project_fields(value, paths):
+    """Build a flat object mapping each requested path to its value (None when missing)"""
+    return {path: _lookup_field(value, path) for path in paths}
+
+
+# A reference to an earlier chain step's response, e.g. {{$[0].id}} or {{$[2].function_call.args}}
+CHAIN_REFERENCE = re.compile(r'\{\{\s*\$\[(\d+)\]((?:\.[^.\[\]{}\s]+|\[\d+\])*)\s*\}\}')
+
+
+class ChainReferenceError(Exception):
+    """A chain step refers to a step or field that does not exist."""
+
+
+def _resolve_reference(match, results):
+    index = int(match.group(1))
+    if index >= len(results):
+        raise ChainReferenceError(f"{match.group(0)} refers to step {index}, which has not run yet")
+    value = _lookup_field(results[index], match.group(2))
+    if value is None:
+        raise ChainReferenceError(f"{match.group(0)} is not in the response of step {index}")
+    return value
+
+
+def substitute_references(value, results):
+    """Replace {{$[N].path}} references in a step with values from earlier step responses.
+
+    A string that is exactly one reference takes the referenced value as is
+    (numbers and objects keep their type); references inside longer strings
+    are formatted into the text. Raises ChainReferenceError for missing values.
+    """
+    if isinstance(value, str):
+        whole = CHAIN_REFERENCE.fullmatch(value.strip())
+        if whole:
+            return _resolve_reference(whole, results)
+
+        def format_reference(match):
+            resolved = _resolve_reference(match, results)
+            return resolved if isinstance(resolved, str) else json.dumps(resolved)
+
+        return CHAIN_REFERENCE.sub(format_reference, value)
+    if isinstance(value, dict):
+        return {key: substitute_references(item, results) for key, item in value.items()}
+    if isinstance(value, list):
+        return [substitute_references(item, results) for item in value]
+    return value
+
+
+# {param} placeholders in a template's url and header values
+TEMPLATE_PLACEHOLDER = re.compile(r'\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+
+def _merge_body(base, extra):
+    """Deep-merge a call's body fragment over a template's static body; the call wins"""
+    if isinstance(base, dict) and isinstance(extra, dict):
+        merged = dict(base)
+        for key, value in extra.items():
+            merged[key] = _merge_body(base.get(key), value)
+        return merged
+    return base if extra is None else extra
+
+
+class TemplateStore:
+    """Named envelope templates that Love2D registers once and then calls with only the changing parts.
+
+    A template holds the url (with {param} placeholders), method, headers,
+    static body and optional fields/write_behind. Templates live in memory, so
+    after a proxy restart calls get 404 and the client registers them again.
+    """
+
+    def __init__(self, max_templates):
+        self.max_templates = max_templates
+        self._lock = threading.Lock()
+        self._templates = {}
+
+    def register(self, name, template):
+        """Store or replace a template; raises ValueError when it is malformed or the store is full"""
+        if not isinstance(template.get('url'), str) or not template['url']:
+            raise ValueError("Template needs a 'url'")
+        if not isinstance(template.get('headers', {}), dict):
+            raise ValueError("Template 'headers' must be an object")
+        body = template.get('body')
+        if isinstance(body, str) and body:
+            # Parse JSON text once so call bodies can be merged into it
+            try:
+                body = json.loads(body)
+            except ValueError:
+                raise ValueError("Template 'body' must be JSON") from None
+        with self._lock:
+            if name not in self._templates and len(self._templates) >= self.max_templates:
+                raise ValueError(f"At most {self.max_templates} templates can be registered")
+            self._templates[name] = {
+                "url": template['url'],
+                "method": template.get('method', 'POST'),
+                "headers": template.get('headers', {}),
+                "body": body,
+                "fields": template.get('fields'),
+                "write_behind": template.get('write_behind', False),
+            }
+
+    def expand(self, name, call):
+        """Build a /proxy envelope from a template and a call's params, body, fields and write_behind.
+
+        Raises KeyError for an unknown template and ValueError for a missing parameter.
+        """
+        with self._lock:
+            template = self._templates[name]
+        params = call.get('params') or {}
+
+        def fill(text, quote):
+            def replace(match):
+                if match.group(1) not in params:
+                    raise ValueError(f"Template '{name}' needs parameter '{match.group(1)}'")
+                value = str(params[match.group(1)])
+                return urllib.parse.quote(value, safe='') if quote else value
+            return TEMPLATE_PLACEHOLDER.sub(replace, text)
+
+        return {
+            "url": fill(template['url'], quote=True),
+            "method": template['method'],
+            "headers": {key: fill(value, quote=False) if isinstance(value, str) else value
+                        for key, value in template['headers'].items()},
+            "body": _merge_body(template['body'], call.get('body')),
+            "fields": call.get('fields', template['fields']),
+            "write_behind": call.get('write_behind', template['write_behind']),
+        }
+
+
+class _MessageBatch:
+    """Messages collected for one agent, waiting to be sent as a single call."""
+
+    def __init__(self, send, seq):
+        self.send = send
+        self.seq = seq
+        self.messages = []
+        self.closed = False
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MessageCoalescer:
+    """Merge add_messages submissions for the same agent into one upstream call.
+
+    The first submitter for an agent becomes the batch leader: it waits up to
+    `window` seconds (or until `max_messages` have been collected), then sends
+    every collected message, in arrival order, with its own `send` function.
+    All submitters receive the same result, so each caller still gets the
+    moment_id of the call that carried its messages. Batches for one agent are
+    numbered and sent strictly in that order.
+    """
+
+    def __init__(self, window, max_messages):
+        self.window = window
+        self.max_messages = max_messages
+        self._lock = threading.Condition()
+        # key -> open _MessageBatch still accepting messages
+        self._batches = {}
+        # key -> [next batch number to hand out, next batch number allowed to send]
+        self._sequence = {}
+
+    def submit(self, key, messages, send):
+        """Queue messages under `key` and block until their batch has been sent.
+
+        `send(messages)` performs the upstream call and returns its result.
+        Returns that result, or raises the exception `send` raised.
+        """
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                sequence = self._sequence.setdefault(key, [0, 0])
+                batch = _MessageBatch(send, sequence[0])
+                sequence[0] += 1
+                self._batches[key] = batch
+            batch.messages.extend(messages)
+            if len(batch.messages) >= self.max_messages:
+                # Full: later submitters start the next batch
+                self._close(key, batch)
+
+        if not leader:
+            batch.done.wait()
+        else:
+            self._flush(key, batch)
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.result
+
+    def _close(self, key, batch):
+        if not batch.closed:
+            batch.closed = True
+            del self._batches[key]
+            self._lock.notify_all()
+
+    def _flush(self, key, batch):
+        deadline = time.monotonic() + self.window
+        with self._lock:
+            while not batch.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._close(key, batch)
+                    break
+                self._lock.wait(remaining)
+
+            # Wait for earlier batches for this agent to finish sending
+            sequence = self._sequence[key]
+            while sequence[1] != batch.seq:
+                self._lock.wait()
+
+        try:
+            batch.result = batch.send(batch.messages)
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._lock:
+                sequence[1] += 1
+                if sequence[0] == sequence[1]:
+                    # Nothing pending for this agent; forget it
+                    del self._sequence[key]
+                self._lock.notify_all()
+            batch.done.set()
+
+
+class WriteBehindQueue:
+    """Durable queue for add_messages envelopes the game does not wait on.
+
+    Envelopes are committed to SQLite before the game gets its 202, so they
+    survive network drops and proxy restarts. Worker threads drain them per
+    target URL (one session/agent pair), oldest first and never two calls for
+    the same agent at once, merging consecutive envelopes with the same headers
+    into one add_messages call. Network errors, 408, 429 and 5xx are retried
+    with backoff and hold back the agent's later messages; other 4xx replies,
+    and envelopes that cannot be sent at all, will never succeed, so those
+    move to the `failed` table (with status 0 when nothing was sent).
+    Delivery is at least once: a call in flight when the proxy dies is resent.
+    """
+
+    def __init__(self, path, max_messages, workers, admission=None):
+        self.path = path
+        self.max_messages = max_messages
+        self.admission = admission
+        self.sent = 0
+        self.failed = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS pending (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                headers TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pending_url ON pending (url, id);
+            CREATE TABLE IF NOT EXISTS failed (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                headers TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                response TEXT NOT NULL,
+                failed REAL NOT NULL
+            );
+        """)
+        self._lock = threading.Condition()
+        # URLs a worker is currently sending
+        self._busy = set()
+        # URL -> (consecutive failures, time.monotonic() of the next attempt)
+        self._backoff = {}
+        for i in range(workers):
+            threading.Thread(target=self._drain, name=f"write-behind-{i}", daemon=True).start()
+
+    def enqueue(self, url, headers, messages):
+        """Durably store an add_messages call; returns its queue id.
+
+        Raises ValueError for a URL or headers that could never be sent.
+        """
+        split = urllib.parse.urlsplit(url)
+        if split.scheme not in ('http', 'https') or not split.hostname:
+            raise ValueError("write_behind needs an absolute http(s) 'url'")
+        if not isinstance(headers, dict) or not all(isinstance(k, str) and isinstance(v, str)
+                                                    for k, v in headers.items()):
+            raise ValueError("write_behind 'headers' must map names to strings")
+        headers = {k: v for k, v in headers.items() if k.lower() != 'content-length'}
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    'INSERT INTO pending (url, headers, messages, created) VALUES (?, ?, ?, ?)',
+                    (url, json.dumps(headers, sort_keys=True), json.dumps(messages), time.time()))
+            self._lock.notify()
+            return cursor.lastrowid
+
+    def stats(self):
+        with self._lock:
+            pending, oldest = self._db.execute('SELECT COUNT(*), MIN(created) FROM pending').fetchone()
+        return {"pending": pending, "sent": self.sent, "failed": self.failed,
+                "oldest_age": round(time.time() - oldest, 3) if oldest else 0,
+                "retrying_agents": len(self._backoff)}
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                work = self._next()
+                while work is None:
+                    self._lock.wait(self._idle_timeout())
+                    work = self._next()
+            url, headers, ids, messages = work
+            try:
+                status, retry_after, response = self._send(url, headers, messages)
+            except Overloaded as e:
+                status, retry_after, response = None, e.retry_after, str(e)
+            except (OSError, http.client.HTTPException) as e:
+                status, retry_after, response = None, None, str(e)
+            except Exception as e:
+                # Not a network failure, so resending will not help (e.g. a malformed URL)
+                status, retry_after, response = 0, None, f"{type(e).__name__}: {e}"
+            with self._lock:
+                try:
+                    self._finish(url, ids, status, retry_after, response)
+                finally:
+                    self._busy.discard(url)
+                    self._lock.notify_all()
+
+    def _next(self):
+        """Claim the oldest batch for an agent that is neither busy nor backing off"""
+        now = time.monotonic()
+        for (url,) in self._db.execute('SELECT url FROM pending GROUP BY url ORDER BY MIN(id)').fetchall():
+            if url in self._busy or self._backoff.get(url, (0, 0))[1] > now:
+                continue
+            rows = self._db.execute('SELECT id, headers, messages FROM pending WHERE url = ? '
+                                    'ORDER BY id LIMIT ?', (url, self.max_messages)).fetchall()
+            ids, messages = [], []
+            for row_id, headers, row_messages in rows:
+                row_messages = json.loads(row_messages)
+                if ids and (headers != rows[0][1]
+                            or len(messages) + len(row_messages) > self.max_messages):
+                    break
+                ids.append(row_id)
+                messages.extend(row_messages)
+            self._busy.add(url)
+            return url, rows[0][1], ids, messages
+        return None
+
+    def _idle_timeout(self):
+        retry_times = [at for url, (_, at) in self._backoff.items() if url not in self._busy]
+        if not retry_times:
+            return None
+        return max(0.05, min(retry_times) - time.monotonic())
+
+    def _send(self, url, headers, messages):
+        data = json.dumps({"messages": messages}).encode('utf-8')
+        headers = json.loads(headers)
+        headers['Content-Length'] = str(len(data))
+        req = urllib.request.Request(url, data=data, headers=headers, method='POST')
+        with _upstream_slot(self.admission, 'low', WRITE_BEHIND_CLIENT):
+            try:
+                with _OPENER.open(req, timeout=30) as response:
+                    response.read()
+                    return response.getcode(), None, ''
+            except urllib.error.HTTPError as e:
+                return e.code, e.headers.get('Retry-After'), e.read(COPY_CHUNK_BYTES).decode('utf-8', 'replace')
+
+    def _finish(self, url, ids, status, retry_after, response):
+        marks = ','.join('?' * len(ids))
+        if status is not None and 200 <= status < 300:
+            with self._db:
+                self._db.execute(f'DELETE FROM pending WHERE id IN ({marks})', ids)
+            self.sent += len(ids)
+            self._backoff.pop(url, None)
+        elif status == 0 or (status is not None and 400 <= status < 500 and status not in (408, 429)):
+            with self._db:
+                self._db.execute(f'INSERT INTO failed SELECT id, url, headers, messages, ?, ?, ? '
+                                 f'FROM pending WHERE id IN ({marks})', [status, response, time.time(), *ids])
+                self._db.execute(f'DELETE FROM pending WHERE id IN ({marks})', ids)
+            self.failed += len(ids)
+            if status == 0:
+                # The agent's later envelopes likely fail the same way; do not spin through them
+                if self._db.execute('SELECT 1 FROM pending WHERE url = ? LIMIT 1', (url,)).fetchone():
+                    self._back_off(url, None)
+                else:
+                    self._backoff.pop(url, None)
+                print(f"[HTTP Proxy] Write-behind call to {url} could not be sent ({response}); "
+                      f"moved {len(ids)} envelope(s) to the failed table")
+            else:
+                self._backoff.pop(url, None)
+                print(f"[HTTP Proxy] Write-behind call to {url} rejected with {status}; "
+                      f"moved {len(ids)} envelope(s) to the failed table")
+        else:
+            with self._db:
+                self._db.execute(f'UPDATE pending SET attempts = attempts + 1 WHERE id IN ({marks})', ids)
+            self._back_off(url, retry_after)
+
+    def _back_off(self, url, retry_after):
+        failures = self._backoff.get(url, (0, 0))[0] + 1
+        delay = min(WRITE_BEHIND_RETRY_BASE * 2 ** (failures - 1), WRITE_BEHIND_RETRY_MAX)
+        delay *= random.uniform(0.5, 1.0)
+        if retry_after is not None and str(retry_after).isdigit():
+            delay = max(delay, int(retry_after))
+        self._backoff[url] = (failures, time.monotonic() + delay)
+
+
+class FacadeError(Exception):
+    """A facade failure that maps onto an HTTP status and an API-style error body."""
+
+    def __init__(self, status_code, error_type, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_type = error_type
+
+
+class AgentFacade:
+    """Typed Artificial Agency calls on one shared, pooled AsyncClient.
+
+    The client lives on a private asyncio loop in a background thread so the
+    threaded HTTP handlers can share its connection pool. The facade remembers
+    which session each agent belongs to, so Love2D only needs the agent id.
+    """
+
+    def __init__(self, api_key, base_url, coalescer=None, admission=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        # Optional MessageCoalescer that merges add_messages calls per agent
+        self.coalescer = coalescer
+        # Optional AdmissionController shared with the raw proxy path
+        self.admission = admission
+        self._loop = None
+        self._client = None
+        self._start_lock = threading.Lock()
+        # agent_id -> session_id for agents created through the facade, least recently used first
+        self._agent_sessions = collections.OrderedDict()
+        self._sessions_lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="agent-facade", daemon=True).start()
+            self._client = aa_async_client.AsyncClient(self.api_key, base_url=self.base_url)
+            self._loop = loop
+
+    def _call(self, method, priority, client, kwargs):
+        """Run an AsyncClient coroutine on the facade loop and wait for its result"""
+        self._ensure_started()
+        bound = getattr(self._client, method)
+        try:
+            inspect.signature(bound).bind(**kwargs)
+        except TypeError as e:
+            raise FacadeError(400, "invalid_request", f"{method}: {e}")
+        coro = bound(**kwargs)
+        try:
+            with _upstream_slot(self.admission, priority, client):
+                future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+                return future.result()
+        except Overloaded:
+            coro.close()
+            raise
+        except pydantic.ValidationError as e:
+            raise FacadeError(400, "invalid_request", str(e))
+        except aa_errors.APIError as e:
+            # The client formats the API's error type enum as "APIErrorType.not_found"
+            raise FacadeError(e.status_code, e.error_type.rpartition('.')[2], str(e))
+        except httpx.HTTPError as e:
+            raise FacadeError(502, "upstream_error", f"{type(e).__name__}: {e}")
+
+    def _remember_agent(self, agent_id, session_id):
+        with self._sessions_lock:
+            self._agent_sessions[agent_id] = session_id
+            self._agent_sessions.move_to_end(agent_id)
+            while len(self._agent_sessions) > FACADE_MAX_AGENTS:
+                self._agent_sessions.popitem(last=False)
+
+    def _session_for(self, agent_id, payload):
+        session_id = payload.get('session_id')
+        if session_id is not None and not isinstance(session_id, str):
+            raise FacadeError(400, "invalid_request", "'session_id' must be a string")
+        if not session_id:
+            with self._sessions_lock:
+                session_id = self._agent_sessions.get(agent_id)
+                if session_id:
+                    self._agent_sessions.move_to_end(agent_id)
+        if not session_id:
+            raise FacadeError(404, "not_found", f"Unknown agent '{agent_id}'; pass session_id")
+        return session_id
+
+    def create_session(self, payload, priority=DEFAULT_PRIORITY, client=DEFAULT_CLIENT):
+        session = self._call('create_session', priority, client, payload)
+        return {"session_id": session.id, "expires_at": session.expires_at,
+                "max_requests": session.max_requests}
+
+    def create_agent(self, session_id, payload, priority=DEFAULT_PRIORITY, client=DEFAULT_CLIENT):
+        agent = self._call('create_agent', priority, client, dict(payload, session_id=session_id))
+        self._remember_agent(agent.agent_id, agent.session_id)
+        return {"agent_id": agent.agent_id, "session_id": agent.session_id,
+                "moment_id": agent.moment_id}
+
+    def add_messages(self, agent_id, payload, priority=DEFAULT_PRIORITY, client=DEFAULT_CLIENT):
+        session_id = self._session_for(agent_id, payload)
+        messages = payload.get('messages', [])
+        if not isinstance(messages, list):
+            raise FacadeError(400, "invalid_request", "'messages' must be a list")
+
+        def send(batch):
+            return self._call('add_messages', priority, client,
+                              {"session_id": session_id, "agent_id": agent_id, "messages": batch})
+
+        if self.coalescer is not None:
+            result = self.coalescer.submit(agent_id, messages, send)
+        else:
+            result = send(messages)
+        return {"moment_id": result.moment_id}
+
+    def generate(self, kind, agent_id, payload, priority=DEFAULT_PRIORITY, client=DEFAULT_CLIENT):
+        session_id = self._session_for(agent_id, payload)
+        kwargs = dict(payload, session_id=session_id, agent_id=agent_id)
+        result = self._call(f'generate_{kind}', priority, client, kwargs)
+        if kind == 'text':
+            return {"moment_id": result.moment_id, "text": result.text}
+        if kind == 'json':
+            return {"moment_id": result.moment_id, "json": result.json_}
+        return {"moment_id": result.moment_id,
+                "function_call": result.function_call.model_dump()}
+
+
+# Template routes: POST /templates/{name} registers, POST /call/{name} invokes
+TEMPLATE_REGISTER_ROUTE = re.compile(r'^/templates/([A-Za-z0-9_.-]{1,64})/?$')
+TEMPLATE_CALL_ROUTE = re.compile(r'^/call/([A-Za-z0-9_.-]{1,64})/?$')
+
+# Facade routes: POST /sessions, POST /sessions/{id}/agents, POST /agents/{id}/<action>
+FACADE_SESSION_ROUTE = re.compile(r'^/sessions/?$')
+FACADE_AGENT_CREATE_ROUTE = re.compile(r'^/sessions/([^/]+)/agents/?$')
+FACADE_AGENT_ROUTE = re.compile(
+    r'^/agents/([^/]+)/(messages|generate_text|generate_json|generate_function_call)/?$')
+
 
 class ProxyHandler(BaseHTTPRequestHandler):
+    # Limits are class attributes so run() can apply command line overrides
+    max_request_bytes = MAX_REQUEST_BYTES
+    max_response_bytes = MAX_RESPONSE_BYTES
+    spool_threshold_bytes = SPOOL_THRESHOLD_BYTES
+
+    # Shared AgentFacade, or None when the facade is not configured
+    facade = None
+
+    # Shared MessageCoalescer for add_messages envelopes, or None when disabled
+    coalescer = None
+
+    # Shared AdmissionController for upstream calls, or None for no limit
+    admission = None
+
+    # Shared IdempotencyStore, or None when Idempotency-Key is ignored
+    idempotency = None
+
+    # Field paths requested for the current request's reply, or None for the full body
+    projection = None
+
+    # SHA-256 of the current request body, used to detect reused idempotency keys
+    body_digest = None
+
+    # Shared SlowRequestRecorder, or None when disabled
+    slow_recorder = None
+
+    # Shared TraceRecorder, or None unless --trace is given
+    tracer = None
+
+    # Whether GET /debug/profile is served (--profile); off by default since the proxy
+    # listens on every interface and a profile exposes every thread's stack
+    profiling = False
+
+    # Shared WriteBehindQueue, or None when write_behind envelopes are sent synchronously
+    write_behind = None
+
+    # Shared TemplateStore, or None when templates are disabled
+    templates = None
+
+    # SharedCache for GET envelopes (and idempotency replays), or None when disabled
+    cache = None
+
+    # Shared TrafficCapture, or None unless --capture is given
+    capture = None
+
+    # Decoded body of the current request, kept for traffic capture
+    payload = None
+
+    # Per-request diagnostics, reset at the start of every POST
+    marks = None
+    response_status = None
+    upstream_status = None
+    response_bytes = 0
+    target_url = None
+    target_headers = None
+
+    def _mark(self, name):
+        """Timestamp a phase of the current request for the flight recorder"""
+        self.marks.append((name, time.perf_counter()))
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+
+    @property
+    def priority(self):
+        """Admission priority from the X-Proxy-Priority header (high, normal or low)"""
+        value = self.headers.get('X-Proxy-Priority', DEFAULT_PRIORITY).strip().lower()
+        return value if value in PRIORITY_RANK else DEFAULT_PRIORITY
+
+    @property
+    def client_id(self):
+        """Fair-queuing client from the X-Proxy-Client header, else the source address"""
+        return self.headers.get('X-Proxy-Client', '').strip()[:64] or self.client_address[0]
+
+    def _send_overloaded(self, e):
+        self._send_payload(503, {"error": {"type": "overloaded", "message": str(e)}},
+                           headers={'Retry-After': str(e.retry_after)})
+
+    def _is_msgpack(self, header):
+        value = self.headers.get(header, '')
+        return any(t in value for t in MSGPACK_CONTENT_TYPES)
+
+    def _read_payload(self):
+        """Read the request body within the size limit and decode it.
+
+        The body is MessagePack when Content-Type says so, JSON otherwise.
+        Returns the decoded value, or None after an error response has been sent.
+        """
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length > self.max_request_bytes:
+            # Reject before reading so the oversized body never enters memory.
+            # The unread body makes the connection unusable, so close it.
+            self.close_connection = True
+            self.send_error(413, f"Request body exceeds {self.max_request_bytes} bytes")
+            return None
+
+        with _spool() as body:
+            _copy_limited(self.rfile, body, self.max_request_bytes, content_length)
+            body.seek(0)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: body.read(COPY_CHUNK_BYTES), b''):
+                digest.update(chunk)
+            self.body_digest = digest.hexdigest()
+            body.seek(0)
+            if self._is_msgpack('Content-Type'):
+                try:
+                    return msgpack_loads(body.read())
+                except ValueError:
+                    self.send_error(400, "Invalid MessagePack in proxy request")
+                    return None
+            try:
+                return json.load(body)
+            except (json.JSONDecodeError, UnicodeDecodeError, RecursionError):
+                self.send_error(400, "Invalid JSON in proxy request")
+                return None
+
+    def _send_payload(self, status, payload, headers=None):
+        """Send a proxy-generated result as MessagePack or JSON, following Accept"""
+        if self._is_msgpack('Accept'):
+            content_type = MSGPACK_CONTENT_TYPES[0]
+            body = msgpack_dumps(payload)
+        else:
+            content_type = 'application/json'
+            body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.response_bytes = len(body)
+        self.wfile.write(body)
+
     def do_POST(self):
         """Handle POST requests from Love2D"""
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length)
-        
-        # Parse the proxy request
+        # Handlers are reused across keep-alive requests, so reset per request
+        self.marks = [('received', time.perf_counter())]
+        self.response_status = self.upstream_status = None
+        self.response_bytes = 0
+        self.target_url = self.target_headers = None
+        self.payload = None
+        _request_context.handler = self
+        try:
+            self._handle_post()
+        finally:
+            _request_context.handler = None
+            self._mark('sent')
+            if self.slow_recorder is not None:
+                self.slow_recorder.observe(self, self.marks[-1][1] - self.marks[0][1])
+            if self.tracer is not None:
+                self.tracer.observe(self)
+            if self.capture is not None and self.payload is not None:
+                self.capture.observe(self, self.payload)
+
+    def _handle_post(self):
+        split = urllib.parse.urlsplit(self.path)
+        path = split.path
+        self.projection = None
+        fields = urllib.parse.parse_qs(split.query).get('fields')
+        if fields:
+            self.projection = [f for f in ','.join(fields).split(',') if f]
+
+        facade_request = path.startswith('/sessions') or path.startswith('/agents/')
+        if facade_request and self.facade is None:
+            self.send_error(503, "Agent facade unavailable: install artificial_agency and set an API key")
+            return
+
+        payload = self._read_payload()
+        if payload is None:
+            return
+        if self.capture is not None:
+            # Kept until the response is sent so the capture can record it
+            self.payload = payload
+        self._mark('body_read')
+
+        key = self.headers.get('Idempotency-Key')
+        if key and self.idempotency is not None:
+            # Keys are only unique per caller: another client (or API key) reusing one
+            # must not be handed this caller's response
+            scope = (self.client_id, self._credential(payload) or '', path, key)
+            self._handle_idempotent(scope, payload, facade_request, path)
+        else:
+            self._dispatch(payload, facade_request, path)
+
+    @staticmethod
+    def _credential(payload):
+        """The Authorization header of an envelope, or None (facade calls use the proxy's own key)"""
+        headers = payload.get('headers') if isinstance(payload, dict) else None
+        if not isinstance(headers, dict):
+            return None
+        return next((str(v) for h, v in headers.items() if str(h).lower() == 'authorization'), None)
+
+    def _dispatch(self, payload, facade_request, path):
+        if facade_request:
+            self._handle_facade(path, payload)
+        elif path.rstrip('/') == '/chain':
+            self._handle_chain(payload)
+        elif path.startswith('/templates/') or path.startswith('/call/'):
+            self._handle_template(path, payload)
+        else:
+            self._handle_proxy(payload)
+
+    def _handle_idempotent(self, key, payload, facade_request, path):
+        """Run a request at most once per Idempotency-Key and replay its response to duplicates"""
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            try:
+                entry, owner = self.idempotency.begin(key, self.body_digest)
+            except Overloaded as e:
+                self._send_overloaded(e)
+                return
+            if entry.digest != self.body_digest:
+                self._send_payload(422, {"error": {
+                    "type": "idempotency_key_reused",
+                    "message": "Idempotency-Key was already used with a different request body"}})
+                return
+            if owner:
+                break
+            if not self.idempotency.wait(key, entry, max(0, deadline - time.monotonic())):
+                self._send_payload(409, {"error": {
+                    "type": "idempotency_in_progress",
+                    "message": "A request with this Idempotency-Key is still in progress"}})
+                return
+            if entry.response is not None:
+                self._replay(entry.response)
+                return
+            # The owner's response was not kept; try to take the key over
+
+        tee = _TeeWriter(self.wfile, IDEMPOTENCY_MAX_RESPONSE_BYTES)
+        self.wfile = tee
+        try:
+            self._dispatch(payload, facade_request, path)
+        finally:
+            self.wfile = tee.wrapped
+            status = self._captured_status(tee.captured)
+            if tee.overflow or status is None or status >= 500 or status == 429:
+                # Failures and oversized replies are not replayed; a retry runs again
+                self.idempotency.abandon(key, entry)
+            else:
+                self.idempotency.complete(key, entry, bytes(tee.captured))
+
+    @staticmethod
+    def _captured_status(raw):
         try:
-            proxy_data = json.loads(body.decode('utf-8'))
-            target_url = proxy_data.get('url')
+            return int(raw.split(b' ', 2)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def _replay(self, raw):
+        """Write a stored raw response, marked so the client can tell it was replayed"""
+        self.idempotency.replayed += 1
+        self.response_status = self._captured_status(raw)
+        self.response_bytes = len(raw)
+        status_line, _, rest = raw.partition(b'\r\n')
+        self.wfile.write(status_line + b'\r\nIdempotent-Replayed: true\r\n' + rest)
+        self.close_connection = True
+
+    def _handle_proxy(self, proxy_data):
+        """Forward a /proxy envelope upstream"""
+        try:
+            fields = proxy_data.get('fields')
+            if fields is not None:
+                if not isinstance(fields, list) or not all(isinstance(f, str) for f in fields):
+                    self.send_error(400, "'fields' must be a list of field paths")
+                    return
+                self.projection = fields
+            write_behind = proxy_data.get('write_behind')
+
+            target_url = self.target_url = proxy_data.get('url')
             target_method = proxy_data.get('method', 'POST')
-            target_headers = proxy_data.get('headers', {})
+            target_headers = self.target_headers = proxy_data.get('headers', {})
             target_body = proxy_data.get('body', '')
-            
+            if target_body is None:
+                # No body at all (e.g. a GET template without one), not the JSON literal null
+                target_body = ''
+            elif not isinstance(target_body, str):
+                # Structured bodies (common with MessagePack envelopes) are sent upstream as JSON
+                target_body = json.dumps(target_body)
+            # The envelope is no longer needed. Callers still hold the dict, so take the body
+            # out of it (unless the capture records it) and only the spooled copy remains
+            if self.capture is None:
+                proxy_data.pop('body', None)
+            del proxy_data
+
             if not target_url:
                 self.send_error(400, "Missing 'url' in proxy request")
                 return
-            
-            # Make the actual HTTPS request
-            req = urllib.request.Request(
-                target_url,
-                data=target_body.encode('utf-8') if target_body else None,
-                headers=target_headers,
-                method=target_method
-            )
-            
-            try:
-                with urllib.request.urlopen(req, timeout=30) as response:
-                    response_body = response.read()
-                    response_headers = dict(response.headers)
-                    
-                    # Send response back to Love2D
-                    self.send_response(response.getcode())
-                    for header, value in response_headers.items():
-                        if header.lower() not in ['connection', 'transfer-encoding']:
-                            self.send_header(header, value)
-                    self.send_header('Content-Length', str(len(response_body)))
-                    self.end_headers()
-                    self.wfile.write(response_body)
-                    
-            except urllib.error.HTTPError as e:
-                # Handle HTTP errors (4xx, 5xx)
-                error_body = e.read()
-                self.send_response(e.code)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Content-Length', str(len(error_body)))
-                self.end_headers()
-                self.wfile.write(error_body)
-                
-            except Exception as e:
-                self.send_error(500, f"Proxy error: {str(e)}")
-                
-        except json.JSONDecodeError:
-            self.send_error(400, "Invalid JSON in proxy request")
+
+            if self.cache is not None and target_method == 'GET' and not target_body:
+                self._forward_cached(target_url, target_headers)
+                return
+
+            add_messages = (target_method == 'POST'
+                            and ADD_MESSAGES_PATH.search(urllib.parse.urlsplit(target_url).path))
+            if add_messages and write_behind and self.write_behind is not None:
+                self._enqueue_write_behind(target_url, target_headers, target_body)
+                return
+            if add_messages and self.coalescer is not None:
+                self._forward_coalesced(target_url, target_headers, target_body)
+                return
+
+            with _spool() as upload:
+                if target_body:
+                    upload.write(target_body.encode('utf-8'))
+                    del target_body
+                    upload_length = upload.tell()
+                    upload.seek(0)
+                    target_headers['Content-Length'] = str(upload_length)
+                    data = upload
+                else:
+                    data = None
+                self._forward(target_url, target_method, target_headers, data)
+
         except Exception as e:
             self.send_error(500, f"Error: {str(e)}")
-    
+
+    def _handle_template(self, path, payload):
+        """Register a named template, or expand one into an envelope and proxy it"""
+        if self.templates is None:
+            self.send_error(404, "Request templates are disabled")
+            return
+        if not isinstance(payload, dict):
+            self.send_error(400, "Template request body must be an object")
+            return
+
+        if match := TEMPLATE_REGISTER_ROUTE.match(path):
+            try:
+                self.templates.register(match.group(1), payload)
+            except ValueError as e:
+                self._send_payload(400, {"error": {"type": "invalid_template", "message": str(e)}})
+                return
+            self._send_payload(201, {"template": match.group(1)})
+        elif match := TEMPLATE_CALL_ROUTE.match(path):
+            try:
+                envelope = self.templates.expand(match.group(1), payload)
+            except KeyError:
+                self._send_payload(404, {"error": {
+                    "type": "unknown_template",
+                    "message": f"No template named '{match.group(1)}'; register it first"}})
+                return
+            except ValueError as e:
+                self._send_payload(400, {"error": {"type": "invalid_request", "message": str(e)}})
+                return
+            self._handle_proxy(envelope)
+        else:
+            self.send_error(404, f"Unknown template endpoint {path}")
+
+    def _handle_chain(self, payload):
+        """Run a list of envelopes in order, substituting earlier responses into later steps.
+
+        Replies 200 with every step's status and body once all steps succeed.
+        The first step that fails stops the chain: the reply is then 502 for an
+        upstream error, or 400 for a bad reference, with the results so far.
+        """
+        steps = payload.get('steps') if isinstance(payload, dict) else None
+        if not isinstance(steps, list) or not steps or not all(isinstance(step, dict) for step in steps):
+            self.send_error(400, "Chain request needs a non-empty 'steps' list of envelopes")
+            return
+        if len(steps) > CHAIN_MAX_STEPS:
+            self.send_error(400, f"Chains are limited to {CHAIN_MAX_STEPS} steps")
+            return
+
+        # Parsed responses for substitution, and per-step results for the reply
+        responses = []
+        results = []
+        for index, step in enumerate(steps):
+            body = step.get('body', '')
+            if isinstance(body, str) and body:
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    pass  # Not JSON; references are substituted as text
+            try:
+                target_url = substitute_references(step.get('url'), responses)
+                target_headers = substitute_references(step.get('headers', {}), responses)
+                body = substitute_references(body, responses)
+            except ChainReferenceError as e:
+                self._send_payload(400, {"results": results, "failed_step": index,
+                                         "error": {"type": "invalid_reference", "message": str(e)}})
+                return
+            if not target_url:
+                self.send_error(400, f"Missing 'url' in chain step {index}")
+                return
+            self.target_url = target_url
+            data = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8') if body else None
+
+            try:
+                with _upstream_slot(self.admission, self.priority, self.client_id):
+                    self._mark('admitted')
+                    status, _, response_body = self._fetch(target_url, step.get('method', 'POST'),
+                                                           target_headers, data)
+                    self._mark('upstream_done')
+            except Overloaded as e:
+                self._send_overloaded(e)
+                return
+            except BodyTooLarge:
+                self.send_error(502, f"Upstream response exceeds {self.max_response_bytes} bytes")
+                return
+            except Exception as e:
+                self.send_error(500, f"Proxy error in chain step {index}: {str(e)}")
+                return
+            self.upstream_status = status
+
+            try:
+                response = json.loads(response_body)
+            except ValueError:
+                response = response_body.decode('utf-8', 'replace')
+            responses.append(response)
+            fields = step.get('fields')
+            if fields and 200 <= status < 300 and isinstance(response, dict):
+                response = project_fields(response, fields)
+            results.append({"status": status, "body": response})
+
+            if not 200 <= status < 300:
+                self._send_payload(502, {"results": results, "failed_step": index,
+                                         "error": {"type": "step_failed",
+                                                   "message": f"Step {index} returned {status}"}})
+                return
+
+        self._send_payload(200, {"results": results})
+
+    def _handle_facade(self, path, payload):
+        """Serve a typed agent API call through the shared AgentFacade"""
+        if not isinstance(payload, dict):
+            self.send_error(400, "Facade request body must be a JSON object")
+            return
+
+        self.target_url = path
+        try:
+            if FACADE_SESSION_ROUTE.match(path):
+                result = self.facade.create_session(payload, self.priority, self.client_id)
+            elif match := FACADE_AGENT_CREATE_ROUTE.match(path):
+                result = self.facade.create_agent(match.group(1), payload, self.priority,
+                                                  self.client_id)
+            elif match := FACADE_AGENT_ROUTE.match(path):
+                agent_id, action = match.groups()
+                if action == 'messages':
+                    result = self.facade.add_messages(agent_id, payload, self.priority,
+                                                      self.client_id)
+                else:
+                    result = self.facade.generate(action[len('generate_'):], agent_id, payload,
+                                                  self.priority, self.client_id)
+            else:
+                self.send_error(404, f"Unknown facade endpoint {path}")
+                return
+        except Overloaded as e:
+            self._send_overloaded(e)
+            return
+        except FacadeError as e:
+            self.upstream_status = e.status_code
+            self._send_payload(e.status_code, {"error": {"type": e.error_type, "message": str(e)}})
+            return
+        except Exception as e:
+            self.upstream_status = 500
+            self.log_error("Facade call %s failed: %r", path, e)
+            self._send_payload(500, {"error": {"type": "internal_error", "message": str(e)}})
+            return
+
+        self._mark('facade_done')
+        self.upstream_status = 200
+        if self.projection:
+            result = project_fields(result, self.projection)
+        self._send_payload(200, result)
+
+    def _enqueue_write_behind(self, target_url, target_headers, target_body):
+        """Store an add_messages envelope for background delivery and acknowledge it with 202"""
+        try:
+            messages = json.loads(target_body)['messages']
+        except (ValueError, TypeError, KeyError):
+            messages = None
+        if not isinstance(messages, list):
+            self.send_error(400, "write_behind needs an add_messages body with a 'messages' list")
+            return
+        try:
+            queue_id = self.write_behind.enqueue(target_url, target_headers, messages)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self._send_payload(202, {"queued": True, "id": queue_id})
+
+    def _forward_coalesced(self, target_url, target_headers, target_body):
+        """Send an add_messages envelope through the shared MessageCoalescer"""
+        try:
+            messages = json.loads(target_body)['messages']
+        except (ValueError, TypeError, KeyError):
+            # Not a recognisable add_messages body; let the API report the problem
+            messages = None
+        if not isinstance(messages, list):
+            with _spool() as upload:
+                upload.write(target_body.encode('utf-8'))
+                target_headers['Content-Length'] = str(upload.tell())
+                upload.seek(0)
+                self._forward(target_url, 'POST', target_headers, upload)
+            return
+
+        priority, client = self.priority, self.client_id
+
+        def send(batch):
+            with _upstream_slot(self.admission, priority, client):
+                self._mark('admitted')
+                return self._fetch(target_url, 'POST', target_headers,
+                                   json.dumps({"messages": batch}).encode('utf-8'))
+
+        # The batch goes out with the leader's headers, so only envelopes whose forwarded
+        # headers all match (credential, AA-API-Version, ...) may share it
+        key = (target_url, tuple(sorted((str(h).lower(), str(v)) for h, v in target_headers.items()
+                                        if str(h).lower() != 'content-length')))
+        try:
+            status, response_headers, response_body = self.coalescer.submit(key, messages, send)
+            self.upstream_status = status
+            self._mark('batch_done')
+        except Overloaded as e:
+            self._send_overloaded(e)
+            return
+        except BodyTooLarge:
+            self.send_error(502, f"Upstream response exceeds {self.max_response_bytes} bytes")
+            return
+        except Exception as e:
+            self.send_error(500, f"Proxy error: {str(e)}")
+            return
+
+        self._send_upstream(status, response_headers, io.BytesIO(response_body), len(response_body))
+
+    def _forward_cached(self, target_url, target_headers):
+        """Serve a GET envelope from the shared cache, fetching and storing it on a miss"""
+        # Responses can differ per credential, so the key covers the Authorization header
+        auth = next((v for h, v in target_headers.items() if h.lower() == 'authorization'), None)
+        key = 'get:' + hashlib.sha256(json.dumps([target_url, auth]).encode('utf-8')).hexdigest()
+        cached = self.cache.get(key)
+        if cached is not None:
+            meta, _, body = cached.partition(b'\n')
+            status, response_headers = json.loads(meta)
+            response_headers['X-Proxy-Cache'] = 'hit'
+            self._send_upstream(status, response_headers, io.BytesIO(body), len(body))
+            return
+
+        try:
+            with _upstream_slot(self.admission, self.priority, self.client_id):
+                self._mark('admitted')
+                status, response_headers, body = self._fetch(target_url, 'GET', target_headers, None)
+                self._mark('upstream_done')
+        except Overloaded as e:
+            self._send_overloaded(e)
+            return
+        except BodyTooLarge:
+            self.send_error(502, f"Upstream response exceeds {self.max_response_bytes} bytes")
+            return
+        except Exception as e:
+            self.send_error(500, f"Proxy error: {str(e)}")
+            return
+
+        self.upstream_status = status
+        ttl = _cache_ttl(response_headers, self.cache.default_ttl)
+        if status == 200 and ttl > 0:
+            meta = json.dumps([status, response_headers]).encode('utf-8')
+            self.cache.put(key, meta + b'\n' + body, ttl)
+        response_headers['X-Proxy-Cache'] = 'miss'
+        self._send_upstream(status, response_headers, io.BytesIO(body), len(body))
+
+    def _fetch(self, target_url, target_method, target_headers, data):
+        """Make an upstream request and return (status, headers, body) held in memory"""
+        req = urllib.request.Request(
+            target_url,
+            data=data,
+            headers=target_headers,
+            method=target_method
+        )
+        buffer = io.BytesIO()
+        try:
+            with _OPENER.open(req, timeout=30) as response:
+                self._mark('upstream_headers')
+                _copy_limited(response, buffer, self.max_response_bytes)
+                return response.getcode(), dict(response.headers), buffer.getvalue()
+        except urllib.error.HTTPError as e:
+            _copy_limited(e, buffer, self.max_response_bytes)
+            return e.code, {'Content-Type': 'application/json'}, buffer.getvalue()
+
+    def _forward(self, target_url, target_method, target_headers, data):
+        """Make the upstream HTTPS request and relay its response to Love2D"""
+        # Make the actual HTTPS request
+        req = urllib.request.Request(
+            target_url,
+            data=data,
+            headers=target_headers,
+            method=target_method
+        )
+
+        try:
+            with _upstream_slot(self.admission, self.priority, self.client_id):
+                self._mark('admitted')
+                try:
+                    with _OPENER.open(req, timeout=30) as response:
+                        self._mark('upstream_headers')
+                        self._relay(response.getcode(), dict(response.headers), response)
+
+                except urllib.error.HTTPError as e:
+                    # Handle HTTP errors (4xx, 5xx)
+                    self._mark('upstream_headers')
+                    self._relay(e.code, {'Content-Type': 'application/json'}, e)
+
+        except Overloaded as e:
+            self._send_overloaded(e)
+
+        except Exception as e:
+            self.send_error(500, f"Proxy error: {str(e)}")
+
+    def _relay(self, status, response_headers, response):
+        """Spool an upstream response and stream it back within the size limit"""
+        self.upstream_status = status
+        declared = response_headers.get('Content-Length')
+        if declared and declared.isdigit() and int(declared) > self.max_response_bytes:
+            self.send_error(502, f"Upstream response exceeds {self.max_response_bytes} bytes")
+            return
+
+        with _spool() as response_body:
+            try:
+                length = _copy_limited(response, response_body, self.max_response_bytes)
+            except BodyTooLarge:
+                self.send_error(502, f"Upstream response exceeds {self.max_response_bytes} bytes")
+                return
+            self._mark('upstream_done')
+            response_body.seek(0)
+            self._send_upstream(status, response_headers, response_body, length)
+
+    def _send_upstream(self, status, response_headers, response_body, length):
+        """Send an upstream response to Love2D, converting JSON to MessagePack if asked"""
+        content_type = next((v for h, v in response_headers.items() if h.lower() == 'content-type'), '')
+        if self.projection and 200 <= status < 300 and 'json' in content_type:
+            try:
+                full = json.load(response_body)
+            except (ValueError, UnicodeDecodeError):
+                response_body.seek(0)
+            else:
+                # Errors are never projected, so Love2D still sees their messages
+                self._send_payload(status, project_fields(full, self.projection))
+                return
+
+        if self._is_msgpack('Accept') and 'json' in content_type:
+            try:
+                converted = msgpack_dumps(json.load(response_body))
+            except (ValueError, UnicodeDecodeError):
+                # Not actually JSON; pass the original bytes through untouched
+                response_body.seek(0)
+            else:
+                response_headers = {h: v for h, v in response_headers.items()
+                                    if h.lower() != 'content-type'}
+                response_headers['Content-Type'] = MSGPACK_CONTENT_TYPES[0]
+                response_body, length = io.BytesIO(converted), len(converted)
+
+        # Send response back to Love2D
+        self.send_response(status)
+        for header, value in response_headers.items():
+            if header.lower() not in ['connection', 'transfer-encoding', 'content-length']:
+                self.send_header(header, value)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        self.response_bytes = length
+        shutil.copyfileobj(response_body, self.wfile, COPY_CHUNK_BYTES)
+
     def do_GET(self):
-        """Handle GET requests (health check)"""
-        if self.path == '/health':
+        """Handle GET requests (health check and diagnostics)"""
+        split = urllib.parse.urlsplit(self.path)
+        path = split.path
+        if path == '/metrics' and self.admission is not None:
+            self._send_metrics()
+        elif path == '/debug/profile' and self.profiling:
+            self._send_profile(urllib.parse.parse_qs(split.query))
+        elif path == '/debug/trace' and self.tracer is not None:
+            try:
+                seconds = float(urllib.parse.parse_qs(split.query).get('seconds', [TRACE_DEFAULT_SECONDS])[0])
+            except ValueError:
+                self.send_error(400, "seconds must be a number")
+                return
+            body = json.dumps(self.tracer.export(seconds)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Disposition', 'attachment; filename="proxy_trace.json"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/debug/slow' and self.slow_recorder is not None:
+            body = json.dumps(self.slow_recorder.dump(), indent=2).encode('utf-8')
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok"}).encode())
+            self.wfile.write(body)
+        elif path == '/health':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            health = {"status": "ok"}
+            if self.admission is not None:
+                health["admission"] = self.admission.stats()
+            if self.idempotency is not None:
+                health["idempotency_replayed"] = self.idempotency.replayed
+            if self.write_behind is not None:
+                health["write_behind"] = self.write_behind.stats()
+            if self.cache is not None:
+                health["cache"] = self.cache.stats()
+            self.wfile.write(json.dumps(health).encode())
         else:
-            self.send_error(404, "Only POST /proxy and GET /health are supported")
-    
+            self.send_error(404, "Only POST /proxy, /chain, /templates/{name} and /call/{name}, GET /health, /metrics, /debug/profile, /debug/slow and /debug/trace are supported")
+
+    def _send_metrics(self):
+        """Admission and per-client fair-queuing counters in Prometheus text format"""
+        stats = self.admission.stats()
+        lines = [
+            '# HELP proxy_upstream_slots Concurrent upstream calls allowed',
+            '# TYPE proxy_upstream_slots gauge',
+            f'proxy_upstream_slots {self.admission.max_active}',
+            '# HELP proxy_client_max_active Upstream slots one client may hold (0 = no cap)',
+            '# TYPE proxy_client_max_active gauge',
+            f'proxy_client_max_active {self.admission.client_max_active}',
+            '# TYPE proxy_upstream_active gauge',
+            f'proxy_upstream_active {stats["active"]}',
+            '# TYPE proxy_upstream_queued gauge',
+            f'proxy_upstream_queued {stats["queued"]}',
+        ]
+        clients = self.admission.client_stats()
+        for name, kind, help_text in CLIENT_METRICS:
+            lines.append(f'# HELP proxy_client_{name} {help_text}')
+            lines.append(f'# TYPE proxy_client_{name} {kind}')
+            key = name[:-len('_total')] if name.endswith('_total') else name
+            for client, values in clients.items():
+                label = client.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                lines.append(f'proxy_client_{name}{{client="{label}"}} {values[key]:g}')
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_profile(self, query):
+        """Sample the proxy's threads for ?seconds=N and reply with collapsed stacks"""
+        try:
+            seconds = float(query.get('seconds', [PROFILE_DEFAULT_SECONDS])[0])
+            interval_ms = float(query.get('interval_ms', [PROFILE_INTERVAL_MS])[0])
+        except ValueError:
+            self.send_error(400, "seconds and interval_ms must be numbers")
+            return
+        if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_ms <= 0:
+            self.send_error(400, f"seconds must be between 0 and {PROFILE_MAX_SECONDS}, interval_ms above 0")
+            return
+        if not _profile_lock.acquire(blocking=False):
+            self.send_error(409, "A profile is already running")
+            return
+        try:
+            lines = sample_stacks(seconds, interval_ms / 1000)
+        finally:
+            _profile_lock.release()
+        body = ''.join(line + '\n' for line in lines).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Disposition', 'attachment; filename="proxy_profile.folded"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def log_message(self, format, *args):
         """Override to use Python logging instead of stderr"""
         print(f"[HTTP Proxy] {format % args}")
 
-def run(port=8080):
+def _install_slow_dump_signal(directory):
+    """Dump the flight recorder to disk on SIGUSR1 (Ctrl+Break on Windows)"""
+    dump_signal = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+    if dump_signal is None:
+        return
+
+    def write_dump():
+        path = ProxyHandler.slow_recorder.write(directory)
+        print(f"[HTTP Proxy] Slow requests written to {path}")
+
+    def on_signal(signum, frame):
+        # Write from a thread so the signal handler itself stays trivial
+        threading.Thread(target=write_dump, name="slow-dump", daemon=True).start()
+
+    signal.signal(dump_signal, on_signal)
+    print(f"  Signal {dump_signal.name} - Write slow requests to {os.path.abspath(directory)}")
+
+class ProxyServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+
+def run(port=8080, slow_dump_dir='.'):
     server_address = ('', port)
-    httpd = HTTPServer(server_address, ProxyHandler)
+    # Threaded so slow upstream calls do not block other Love2D requests
+    httpd = ProxyServer(server_address, ProxyHandler)
     print(f"HTTP Proxy server running on http://localhost:{port}")
     print("Endpoints:")
     print("  POST /proxy - Proxy HTTPS requests")
+    print("  POST /chain - Run dependent envelopes in one round trip")
+    if ProxyHandler.templates is not None:
+        print("  POST /templates/{name}, /call/{name} - Register and call request templates")
     print("  GET /health - Health check")
+    if ProxyHandler.profiling:
+        print("  GET /debug/profile?seconds=N - Sample thread stacks (collapsed-stack format)")
+    if ProxyHandler.slow_recorder is not None:
+        print(f"  GET /debug/slow - Requests slower than "
+              f"{ProxyHandler.slow_recorder.threshold * 1000:.0f} ms")
+        _install_slow_dump_signal(slow_dump_dir)
+    if ProxyHandler.tracer is not None:
+        print("  GET /debug/trace?seconds=N - Chrome trace of the last N seconds")
+    if ProxyHandler.facade is not None:
+        print("  POST /sessions, /sessions/{id}/agents - Create sessions and agents")
+        print("  POST /agents/{id}/messages|generate_text|generate_json|generate_function_call")
+    if ProxyHandler.admission is not None:
+        print("  GET /metrics - Upstream slot usage per client (Prometheus format)")
+        print(f"Admission control: {ProxyHandler.admission.max_active} upstream slots, "
+              f"queue up to {ProxyHandler.admission.max_queue} requests / "
+              f"{ProxyHandler.admission.max_wait:g} s, fair-queued per client")
+    if ProxyHandler.capture is not None:
+        print(f"Capturing traffic to {ProxyHandler.capture.path} (replay with proxy_replay.py)")
+    if ProxyHandler.cache is not None:
+        print(f"Shared cache in {ProxyHandler.cache.path} (up to {ProxyHandler.cache.max_bytes} bytes)")
+    if ProxyHandler.write_behind is not None:
+        print(f"Write-behind add_messages queued in {ProxyHandler.write_behind.path}")
+    if ProxyHandler.coalescer is not None:
+        print(f"Coalescing add_messages per agent: {ProxyHandler.coalescer.window * 1000:.0f} ms window, "
+              f"up to {ProxyHandler.coalescer.max_messages} messages")
+    print(f"Limits: request {ProxyHandler.max_request_bytes} bytes, "
+          f"response {ProxyHandler.max_response_bytes} bytes, "
+          f"spool to disk above {ProxyHandler.spool_threshold_bytes} bytes")
     print("\nPress Ctrl+C to stop")
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down proxy server...")
         httpd.shutdown()
+        if ProxyHandler.capture is not None:
+            ProxyHandler.capture.close()
+            print(f"Captured {ProxyHandler.capture.count} requests to {ProxyHandler.capture.path}")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Local HTTP proxy for Love2D")
+    parser.add_argument('port', nargs='?', type=int, default=8080)
+    parser.add_argument('--max-request-bytes', type=int, default=MAX_REQUEST_BYTES,
+                        help="Reject proxy requests larger than this with 413")
+    parser.add_argument('--max-response-bytes', type=int, default=MAX_RESPONSE_BYTES,
+                        help="Replace upstream responses larger than this with 502")
+    parser.add_argument('--spool-threshold-bytes', type=int, default=SPOOL_THRESHOLD_BYTES,
+                        help="Spill bodies larger than this to a temporary file")
+    parser.add_argument('--api-key', default=os.environ.get('AA_API_KEY'),
+                        help="Artificial Agency API key for the agent facade (default: $AA_API_KEY)")
+    parser.add_argument('--api-base-url', default=None,
+                        help="Artificial Agency API base URL for the agent facade")
+    parser.add_argument('--coalesce-window-ms', type=int, default=COALESCE_WINDOW_MS,
+                        help="Merge add_messages calls per agent within this window (0 disables)")
+    parser.add_argument('--coalesce-max-messages', type=int, default=COALESCE_MAX_MESSAGES,
+                        help="Flush a coalesced add_messages batch once it holds this many messages")
+    parser.add_argument('--max-upstream', type=int, default=MAX_UPSTREAM,
+                        help="Concurrent upstream calls before requests queue (0 disables admission control)")
+    parser.add_argument('--max-queue', type=int, default=MAX_QUEUE,
+                        help="Queued requests before new ones are rejected with 503")
+    parser.add_argument('--max-queue-wait', type=float, default=MAX_QUEUE_WAIT,
+                        help="Estimated queue wait in seconds before new requests are rejected with 503")
+    parser.add_argument('--max-queue-timeout', type=float, default=MAX_QUEUE_TIMEOUT,
+                        help="Seconds a queued request waits for a slot before it is rejected with 503")
+    parser.add_argument('--idempotency-ttl', type=float, default=IDEMPOTENCY_TTL,
+                        help="Seconds to remember Idempotency-Key responses (0 disables)")
+    parser.add_argument('--idempotency-max-entries', type=int, default=IDEMPOTENCY_MAX_ENTRIES,
+                        help="Most Idempotency-Key responses kept at once")
+    parser.add_argument('--slow-threshold-ms', type=int, default=SLOW_THRESHOLD_MS,
+                        help="Record requests slower than this for /debug/slow (0 disables)")
+    parser.add_argument('--slow-buffer-size', type=int, default=SLOW_BUFFER_SIZE,
+                        help="Most slow requests kept by the flight recorder")
+    parser.add_argument('--slow-dump-dir', default='.',
+                        help="Directory for flight recorder dumps written on SIGUSR1")
+    parser.add_argument('--trace', action='store_true',
+                        help="Record request timelines for GET /debug/trace (Chrome trace format)")
+    parser.add_argument('--trace-buffer-size', type=int, default=TRACE_BUFFER_SIZE,
+                        help="Most requests kept for trace export")
+    parser.add_argument('--profile', action='store_true',
+                        help="Serve GET /debug/profile, which samples every thread's stack on demand")
+    parser.add_argument('--write-behind', metavar='DB_PATH', default=None,
+                        help="Queue add_messages envelopes marked write_behind in this SQLite file "
+                             "and deliver them in the background")
+    parser.add_argument('--write-behind-max-messages', type=int, default=WRITE_BEHIND_MAX_MESSAGES,
+                        help="Most messages merged into one write-behind add_messages call")
+    parser.add_argument('--write-behind-workers', type=int, default=WRITE_BEHIND_WORKERS,
+                        help="Agents drained concurrently by the write-behind queue")
+    parser.add_argument('--client-max-active', type=int, default=0,
+                        help="Upstream slots one client may hold at once (0 = only fair sharing)")
+    parser.add_argument('--client-weight', action='append', default=[], metavar='CLIENT=WEIGHT',
+                        help="Give a client a larger (or smaller) share of upstream time; repeatable")
+    parser.add_argument('--max-templates', type=int, default=TEMPLATE_MAX_COUNT,
+                        help="Request templates that can be registered (0 disables templates)")
+    parser.add_argument('--shared-cache', metavar='PATH', default=None,
+                        help="Cache GET envelopes and idempotent replays in this SQLite file, "
+                             "shared by every proxy process that opens it")
+    parser.add_argument('--cache-max-bytes', type=int, default=CACHE_MAX_BYTES,
+                        help="Evict least recently used cache entries above this total size")
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL,
+                        help="Seconds to cache GET responses without Cache-Control max-age")
+    parser.add_argument('--capture', metavar='PATH', default=None,
+                        help="Append every POST (secrets redacted) to this JSON lines file for proxy_replay.py; "
+                             "gzip when it ends in .gz")
+    return parser.parse_args(argv)
 
-if __name__ == '__main__':
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
-    run(port)
 
+def parse_client_weights(values):
+    """Parse repeated CLIENT=WEIGHT options into a dict"""
+    weights = {}
+    for value in values:
+        client, _, weight = value.rpartition('=')
+        try:
+            weights[client] = float(weight)
+        except ValueError:
+            weights[client] = 0
+        if not client or not weights[client] > 0:
+            raise SystemExit(f"--client-weight expects CLIENT=WEIGHT with a positive weight, got {value!r}")
+    return weights
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    ProxyHandler.max_request_bytes = args.max_request_bytes
+    ProxyHandler.max_response_bytes = args.max_response_bytes
+    ProxyHandler.spool_threshold_bytes = args.spool_threshold_bytes
+    if args.coalesce_window_ms > 0:
+        ProxyHandler.coalescer = MessageCoalescer(args.coalesce_window_ms / 1000.0,
+                                                  args.coalesce_max_messages)
+    if args.capture:
+        ProxyHandler.capture = TrafficCapture(args.capture)
+    if args.shared_cache:
+        ProxyHandler.cache = SharedCache(args.shared_cache, args.cache_max_bytes, args.cache_ttl)
+    if args.idempotency_ttl > 0:
+        ProxyHandler.idempotency = IdempotencyStore(args.idempotency_ttl,
+                                                    args.idempotency_max_entries,
+                                                    shared=ProxyHandler.cache)
+    if args.slow_threshold_ms > 0:
+        ProxyHandler.slow_recorder = SlowRequestRecorder(args.slow_threshold_ms / 1000.0,
+                                                         args.slow_buffer_size)
+    if args.max_templates > 0:
+        ProxyHandler.templates = TemplateStore(args.max_templates)
+    if args.trace:
+        ProxyHandler.tracer = TraceRecorder(args.trace_buffer_size)
+    ProxyHandler.profiling = args.profile
+    if args.max_upstream > 0:
+        ProxyHandler.admission = AdmissionController(args.max_upstream, args.max_queue,
+                                                     args.max_queue_wait,
+                                                     client_max_active=args.client_max_active,
+                                                     client_weights=parse_client_weights(args.client_weight),
+                                                     queue_timeout=args.max_queue_timeout)
+    if args.write_behind:
+        ProxyHandler.write_behind = WriteBehindQueue(args.write_behind, args.write_behind_max_messages,
+                                                     args.write_behind_workers,
+                                                     admission=ProxyHandler.admission)
+    if args.api_key and aa_async_client is not None:
+        ProxyHandler.facade = AgentFacade(args.api_key, args.api_base_url or aa_constants.API_URL,
+                                          coalescer=ProxyHandler.coalescer,
+                                          admission=ProxyHandler.admission)
+    elif args.api_key:
+        print("artificial_agency is not installed; agent facade disabled")
+    run(args.port, args.slow_dump_dir)
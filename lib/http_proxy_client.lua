@@ -7,7 +7,11 @@ local json = require('lunajson')
 
 local HttpProxyClient = {
     proxy_url = "http://localhost:8080/proxy",
-    enabled = false
+    enabled = false,
+    -- Sent as X-Proxy-Client so the proxy fair-queues this game instance on its own; without it
+    -- every local instance shares one queue under its source address (127.0.0.1).
+    -- Unique per process by default; set a stable name to match the proxy's --client-weight.
+    client_id = "love2d-" .. os.time() .. "-" .. tostring({}):match("(%x+)$")
 }
 
 -- Check if proxy is available
@@ -42,8 +46,10 @@ end
 -- @param url string: The target HTTPS URL
 -- @param body string or table: Request body (if table, will be JSON encoded)
 -- @param headers table (optional): Request headers
+-- @param fields table (optional): Field paths to keep from a successful JSON reply, e.g. { "text", "moment_id" }
+-- @param idempotency_key string (optional): Reuse the same key when retrying so the proxy replays instead of repeating the call
 -- @return success boolean, response table { status_code, headers, body } or error string
-function HttpProxyClient.post(url, body, headers)
+function HttpProxyClient.post(url, body, headers, fields, idempotency_key)
     if not HttpProxyClient.enabled then
         local available = HttpProxyClient.check_available()
         if not available then
@@ -69,7 +75,8 @@ function HttpProxyClient.post(url, body, headers)
         url = url,
         method = "POST",
         headers = headers or {},
-        body = body_str or ""
+        body = body_str or "",
+        fields = fields
     }
     
     local proxy_body = json.encode(proxy_request)
@@ -84,7 +91,9 @@ function HttpProxyClient.post(url, body, headers)
         method = "POST",
         headers = {
             ["Content-Type"] = "application/json",
-            ["Content-Length"] = tostring(#proxy_body)
+            ["X-Proxy-Client"] = HttpProxyClient.client_id,
+            ["Content-Length"] = tostring(#proxy_body),
+            ["Idempotency-Key"] = idempotency_key
         },
         source = ltn12.source.string(proxy_body),
         sink = ltn12.sink.table(sink)
@@ -111,5 +120,305 @@ function HttpProxyClient.post(url, body, headers)
     }
 end
 
+-- Make HTTP POST request via proxy using MessagePack instead of JSON
+-- The envelope (including a table body) is MessagePack encoded, the proxy sends
+-- the body upstream as JSON, and the JSON reply comes back as MessagePack.
+-- This skips lunajson on both directions for the caller.
+-- @param url string: The target HTTPS URL
+-- @param body table: Request body, sent upstream as JSON
+-- @param headers table (optional): Request headers
+-- @param fields table (optional): Field paths to keep from a successful JSON reply, e.g. { "text", "moment_id" }
+-- @param idempotency_key string (optional): Reuse the same key when retrying so the proxy replays instead of repeating the call
+-- @return success boolean, response table { status_code, headers, data } or error string
+-- Example: local ok, res = HttpProxyClient.post_msgpack(url, { messages = messages }, headers)
+--          if ok and res.status_code == 200 then print(res.data.moment_id) end
+function HttpProxyClient.post_msgpack(url, body, headers, fields, idempotency_key)
+    if not HttpProxyClient.enabled then
+        local available = HttpProxyClient.check_available()
+        if not available then
+            return false, "HTTP proxy not available. Start http_proxy.py first."
+        end
+    end
+
+    local msgpack = require('lib.msgpack')
+    headers = headers or {}
+    headers["Content-Type"] = headers["Content-Type"] or "application/json"
+
+    local proxy_body = msgpack.encode({
+        url = url,
+        method = "POST",
+        headers = headers,
+        body = body or {},
+        fields = fields
+    })
+
+    local socket_http = require('socket.http')
+    local ltn12 = require('ltn12')
+
+    local sink = {}
+    local result, code, response_headers = socket_http.request({
+        url = HttpProxyClient.proxy_url,
+        method = "POST",
+        headers = {
+            ["Content-Type"] = "application/msgpack",
+            ["X-Proxy-Client"] = HttpProxyClient.client_id,
+            ["Accept"] = "application/msgpack",
+            ["Content-Length"] = tostring(#proxy_body),
+            ["Idempotency-Key"] = idempotency_key
+        },
+        source = ltn12.source.string(proxy_body),
+        sink = ltn12.sink.table(sink)
+    })
+
+    if not result then
+        log.info("http_proxy_client:post_msgpack", { step = "request_failed", error = tostring(code) })
+        return false, tostring(code)
+    end
+
+    local response_body = table.concat(sink)
+    local content_type = response_headers and response_headers["content-type"] or ""
+
+    -- The proxy only converts JSON replies; anything else (e.g. proxy error pages) stays raw
+    local data = nil
+    if content_type:find("msgpack", 1, true) then
+        local decoded, parsed = pcall(msgpack.decode, response_body)
+        if not decoded then
+            return false, "Failed to decode MessagePack: " .. tostring(parsed)
+        end
+        data = parsed
+    end
+
+    log.info("http_proxy_client:post_msgpack", {
+        url = url,
+        status = code >= 200 and code < 300 and "success" or "error",
+        status_code = code,
+        body_length = #response_body
+    })
+
+    return true, {
+        status_code = code,
+        headers = response_headers or {},
+        data = data,
+        body = data == nil and response_body or nil
+    }
+end
+
+-- Run several dependent requests in one round trip to the proxy
+-- Later steps can use values from earlier responses with references like "{{$[0].id}}"
+-- in their url, headers or body; a string that is only a reference keeps the value's type.
+-- @param steps table: Array of { url, method (optional), headers (optional), body (optional), fields (optional) }
+-- @return success boolean, response table { status_code, headers, body } or error string
+--         body is JSON: { results = { { status, body }, ... } }, plus failed_step and error when a step failed
+-- Example: HttpProxyClient.chain({
+--              { url = base .. "/v1/sessions", headers = headers, body = { project_id = project_id } },
+--              { url = base .. "/v1/sessions/{{$[0].id}}/agents", headers = headers, body = agent_config },
+--          })
+function HttpProxyClient.chain(steps)
+    if not HttpProxyClient.enabled then
+        local available = HttpProxyClient.check_available()
+        if not available then
+            return false, "HTTP proxy not available. Start http_proxy.py first."
+        end
+    end
+
+    local proxy_body = json.encode({ steps = steps })
+
+    local socket_http = require('socket.http')
+    local ltn12 = require('ltn12')
+
+    local sink = {}
+    local result, code, response_headers = socket_http.request({
+        url = HttpProxyClient.proxy_url:gsub("/proxy$", "/chain"),
+        method = "POST",
+        headers = {
+            ["Content-Type"] = "application/json",
+            ["X-Proxy-Client"] = HttpProxyClient.client_id,
+            ["Content-Length"] = tostring(#proxy_body)
+        },
+        source = ltn12.source.string(proxy_body),
+        sink = ltn12.sink.table(sink)
+    })
+
+    if not result then
+        log.info("http_proxy_client:chain", { step = "request_failed", error = tostring(code) })
+        return false, tostring(code)
+    end
+
+    local response_body = table.concat(sink)
+
+    log.info("http_proxy_client:chain", {
+        steps = #steps,
+        status = code == 200 and "success" or "error",
+        status_code = code,
+        body_length = #response_body
+    })
+
+    return true, {
+        status_code = code,
+        headers = response_headers or {},
+        body = response_body
+    }
+end
+
+-- Templates registered through this client, kept so they can be re-registered after a proxy restart
+HttpProxyClient.templates = {}
+
+-- POST a JSON body to another proxy endpoint (path replaces /proxy in proxy_url)
+local function post_to_proxy(path, proxy_body)
+    local socket_http = require('socket.http')
+    local ltn12 = require('ltn12')
+
+    local sink = {}
+    local result, code, response_headers = socket_http.request({
+        url = HttpProxyClient.proxy_url:gsub("/proxy$", path),
+        method = "POST",
+        headers = {
+            ["Content-Type"] = "application/json",
+            ["X-Proxy-Client"] = HttpProxyClient.client_id,
+            ["Content-Length"] = tostring(#proxy_body)
+        },
+        source = ltn12.source.string(proxy_body),
+        sink = ltn12.sink.table(sink)
+    })
+    if not result then
+        return false, tostring(code)
+    end
+    return true, {
+        status_code = code,
+        headers = response_headers or {},
+        body = table.concat(sink)
+    }
+end
+
+-- Register a named request template with the proxy
+-- Send the url (with {param} placeholders), headers and static body once; later calls only send what changes.
+-- @param name string: Template name (letters, digits, '_', '-', '.')
+-- @param template table: { url, method (optional), headers (optional), body (optional), fields (optional) }
+-- @return success boolean, response table or error string
+-- Example: HttpProxyClient.register_template("add_messages", {
+--              url = base_url .. "/v1/sessions/{session_id}/agents/{agent_id}/messages",
+--              headers = headers,
+--          })
+function HttpProxyClient.register_template(name, template)
+    if not HttpProxyClient.enabled then
+        local available = HttpProxyClient.check_available()
+        if not available then
+            return false, "HTTP proxy not available. Start http_proxy.py first."
+        end
+    end
+
+    HttpProxyClient.templates[name] = template
+    local success, response = post_to_proxy("/templates/" .. name, json.encode(template))
+    log.info("http_proxy_client:register_template", {
+        name = name,
+        status = success and response.status_code == 201 and "success" or "error",
+        status_code = success and response.status_code or nil
+    })
+    return success, response
+end
+
+-- Send a request built from a registered template
+-- Registers the template again and retries once if the proxy has restarted and forgotten it.
+-- @param name string: Template name given to register_template
+-- @param params table: Values for the url/header placeholders, e.g. { session_id = sid, agent_id = aid }
+-- @param body table (optional): Body fragment merged over the template's static body
+-- @param fields table (optional): Field paths to keep from a successful JSON reply
+-- @return success boolean, response table { status_code, headers, body } or error string
+-- Example: HttpProxyClient.call_template("add_messages", { session_id = sid, agent_id = aid }, { messages = messages })
+function HttpProxyClient.call_template(name, params, body, fields)
+    if not HttpProxyClient.enabled then
+        local available = HttpProxyClient.check_available()
+        if not available then
+            return false, "HTTP proxy not available. Start http_proxy.py first."
+        end
+    end
+
+    local proxy_body = json.encode({ params = params, body = body, fields = fields })
+    local success, response = post_to_proxy("/call/" .. name, proxy_body)
+    if success and response.status_code == 404 and HttpProxyClient.templates[name]
+            and response.body:find("unknown_template", 1, true) then
+        local registered = HttpProxyClient.register_template(name, HttpProxyClient.templates[name])
+        if registered then
+            success, response = post_to_proxy("/call/" .. name, proxy_body)
+        end
+    end
+
+    if not success then
+        log.info("http_proxy_client:call_template", { name = name, step = "request_failed", error = response })
+        return false, response
+    end
+    log.info("http_proxy_client:call_template", {
+        name = name,
+        status = response.status_code >= 200 and response.status_code < 300 and "success" or "error",
+        status_code = response.status_code,
+        body_length = #response.body
+    })
+    return true, response
+end
+
+-- Queue an add_messages call in the proxy's write-behind queue instead of waiting for the API
+-- The proxy must run with --write-behind; it stores the call, replies 202 at once and delivers it
+-- in the background, in order per agent, with retries. Without --write-behind it is sent normally.
+-- @param url string: The add_messages URL (.../v1/sessions/{id}/agents/{id}/messages)
+-- @param body table: Request body { messages = { ... } }
+-- @param headers table (optional): Request headers
+-- @return success boolean, response table { status_code, headers, body } or error string
+-- Example: local ok, res = HttpProxyClient.post_write_behind(url, { messages = messages }, headers)
+--          if ok and res.status_code == 202 then -- queued, no moment_id yet
+function HttpProxyClient.post_write_behind(url, body, headers)
+    if not HttpProxyClient.enabled then
+        local available = HttpProxyClient.check_available()
+        if not available then
+            return false, "HTTP proxy not available. Start http_proxy.py first."
+        end
+    end
+
+    headers = headers or {}
+    headers["Content-Type"] = headers["Content-Type"] or "application/json"
+
+    local proxy_body = json.encode({
+        url = url,
+        method = "POST",
+        headers = headers,
+        body = json.encode(body),
+        write_behind = true
+    })
+
+    local socket_http = require('socket.http')
+    local ltn12 = require('ltn12')
+
+    local sink = {}
+    local result, code, response_headers = socket_http.request({
+        url = HttpProxyClient.proxy_url,
+        method = "POST",
+        headers = {
+            ["Content-Type"] = "application/json",
+            ["X-Proxy-Client"] = HttpProxyClient.client_id,
+            ["Content-Length"] = tostring(#proxy_body)
+        },
+        source = ltn12.source.string(proxy_body),
+        sink = ltn12.sink.table(sink)
+    })
+
+    if not result then
+        log.info("http_proxy_client:post_write_behind", { step = "request_failed", error = tostring(code) })
+        return false, tostring(code)
+    end
+
+    local response_body = table.concat(sink)
+
+    log.info("http_proxy_client:post_write_behind", {
+        url = url,
+        status = code == 202 and "queued" or (code >= 200 and code < 300 and "success" or "error"),
+        status_code = code
+    })
+
+    return true, {
+        status_code = code,
+        headers = response_headers or {},
+        body = response_body
+    }
+end
+
 return HttpProxyClient
 
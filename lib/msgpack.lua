@@ -0,0 +1,309 @@
+-- MessagePack encoder/decoder in plain Lua (works on LuaJIT / Lua 5.1)
+-- Used for the compact envelope format between Love2D and http_proxy.py:
+-- it is cheaper to build and parse than JSON and produces smaller payloads.
+-- Tables follow lunajson's rules: t[0] = length or a non-nil t[1] makes an
+-- array, anything else (including an empty table) becomes a map.
+
+local MsgPack = {}
+
+local char, byte, sub = string.char, string.byte, string.sub
+local floor, frexp, ldexp, huge = math.floor, math.frexp, math.ldexp, math.huge
+local concat = table.concat
+local unpack = unpack or table.unpack
+
+-- Largest integer a Lua number (double) holds exactly
+local MAX_SAFE_INTEGER = 2 ^ 53
+
+-- Big-endian bytes of an unsigned integer that fits in `count` bytes
+local function _uint_bytes(n, count)
+    local out = {}
+    for i = count, 1, -1 do
+        out[i] = n % 256
+        n = floor(n / 256)
+    end
+    return char(unpack(out))
+end
+
+-- Encode a double as IEEE 754 binary64 (msgpack float 64)
+local function _encode_double(n)
+    local sign = 0
+    if n < 0 or (n == 0 and 1 / n < 0) then
+        sign = 0x80
+        n = -n
+    end
+    if n ~= n then
+        return char(0xcb, 0x7f, 0xf8, 0, 0, 0, 0, 0, 0)
+    elseif n == huge then
+        return char(0xcb, sign + 0x7f, 0xf0, 0, 0, 0, 0, 0, 0)
+    elseif n == 0 then
+        return char(0xcb, sign, 0, 0, 0, 0, 0, 0, 0)
+    end
+
+    -- n = m * 2^e with 0.5 <= m < 1, so the biased exponent is e + 1022
+    local m, e = frexp(n)
+    local exponent = e + 1022
+    local fraction
+    if exponent <= 0 then
+        -- Subnormal: no implicit leading 1
+        exponent = 0
+        fraction = ldexp(n, 1074)
+    else
+        fraction = (m * 2 - 1) * 2 ^ 52
+    end
+    local high = floor(fraction / 2 ^ 48)
+    return char(0xcb, sign + floor(exponent / 16), (exponent % 16) * 16 + high)
+        .. _uint_bytes(fraction % 2 ^ 48, 6)
+end
+
+local function _encode_integer(n)
+    if n >= 0 then
+        if n < 128 then
+            return char(n)
+        elseif n < 2 ^ 8 then
+            return char(0xcc, n)
+        elseif n < 2 ^ 16 then
+            return char(0xcd) .. _uint_bytes(n, 2)
+        elseif n < 2 ^ 32 then
+            return char(0xce) .. _uint_bytes(n, 4)
+        end
+        return char(0xcf) .. _uint_bytes(floor(n / 2 ^ 32), 4) .. _uint_bytes(n % 2 ^ 32, 4)
+    end
+    if n >= -32 then
+        return char(256 + n)
+    elseif n >= -2 ^ 7 then
+        return char(0xd0, 2 ^ 8 + n)
+    elseif n >= -2 ^ 15 then
+        return char(0xd1) .. _uint_bytes(2 ^ 16 + n, 2)
+    elseif n >= -2 ^ 31 then
+        return char(0xd2) .. _uint_bytes(2 ^ 32 + n, 4)
+    end
+    -- Two's complement split into high and low 32-bit words
+    local high = floor(n / 2 ^ 32)
+    local low = n - high * 2 ^ 32
+    return char(0xd3) .. _uint_bytes(high + 2 ^ 32, 4) .. _uint_bytes(low, 4)
+end
+
+local function _encode_length(len, fix_base, fix_max, code16, code32, code8)
+    if len <= fix_max then
+        return char(fix_base + len)
+    elseif code8 and len < 2 ^ 8 then
+        return char(code8, len)
+    elseif len < 2 ^ 16 then
+        return char(code16) .. _uint_bytes(len, 2)
+    end
+    return char(code32) .. _uint_bytes(len, 4)
+end
+
+local _encode_value
+
+local function _encode_table(t, out, visited)
+    if visited[t] then
+        error("loop detected")
+    end
+    visited[t] = true
+
+    local length = t[0]
+    if type(length) ~= 'number' and t[1] ~= nil then
+        length = 1
+        while t[length + 1] ~= nil do
+            length = length + 1
+        end
+    end
+
+    if type(length) == 'number' then
+        out[#out + 1] = _encode_length(length, 0x90, 15, 0xdc, 0xdd)
+        for i = 1, length do
+            _encode_value(t[i], out, visited)
+        end
+    else
+        local count = 0
+        for _ in pairs(t) do
+            count = count + 1
+        end
+        out[#out + 1] = _encode_length(count, 0x80, 15, 0xde, 0xdf)
+        for k, v in pairs(t) do
+            if type(k) ~= 'string' then
+                error("non-string key")
+            end
+            _encode_value(k, out, visited)
+            _encode_value(v, out, visited)
+        end
+    end
+
+    visited[t] = nil
+end
+
+_encode_value = function(v, out, visited)
+    local kind = type(v)
+    if v == nil then
+        out[#out + 1] = char(0xc0)
+    elseif kind == 'boolean' then
+        out[#out + 1] = char(v and 0xc3 or 0xc2)
+    elseif kind == 'number' then
+        if v == floor(v) and v >= -MAX_SAFE_INTEGER and v <= MAX_SAFE_INTEGER then
+            out[#out + 1] = _encode_integer(v)
+        else
+            out[#out + 1] = _encode_double(v)
+        end
+    elseif kind == 'string' then
+        out[#out + 1] = _encode_length(#v, 0xa0, 31, 0xda, 0xdb, 0xd9)
+        out[#out + 1] = v
+    elseif kind == 'table' then
+        _encode_table(v, out, visited)
+    else
+        error("invalid type value: " .. kind)
+    end
+end
+
+-- Encode a Lua value as a MessagePack string
+-- @param value any: nil, boolean, number, string or table
+-- @return string: Encoded bytes
+-- Example: local bytes = MsgPack.encode({ url = url, body = { messages = messages } })
+function MsgPack.encode(value)
+    local out = {}
+    _encode_value(value, out, {})
+    return concat(out)
+end
+
+-- Read a big-endian unsigned integer of `count` bytes starting at `pos`
+local function _read_uint(data, pos, count)
+    local n = 0
+    for i = pos, pos + count - 1 do
+        n = n * 256 + byte(data, i)
+    end
+    return n
+end
+
+local function _decode_double(data, pos)
+    local b1, b2 = byte(data, pos, pos + 1)
+    local sign = b1 >= 0x80 and -1 or 1
+    local exponent = (b1 % 0x80) * 16 + floor(b2 / 16)
+    local fraction = (b2 % 16) * 2 ^ 48 + _read_uint(data, pos + 2, 6)
+    if exponent == 0x7ff then
+        return fraction == 0 and sign * huge or 0 / 0
+    elseif exponent == 0 then
+        return sign * ldexp(fraction, -1074)
+    end
+    return sign * ldexp(fraction + 2 ^ 52, exponent - 1075)
+end
+
+local function _decode_float(data, pos)
+    local b1, b2 = byte(data, pos, pos + 1)
+    local sign = b1 >= 0x80 and -1 or 1
+    local exponent = (b1 % 0x80) * 2 + floor(b2 / 128)
+    local fraction = (b2 % 128) * 2 ^ 16 + _read_uint(data, pos + 2, 2)
+    if exponent == 0xff then
+        return fraction == 0 and sign * huge or 0 / 0
+    elseif exponent == 0 then
+        return sign * ldexp(fraction, -149)
+    end
+    return sign * ldexp(fraction + 2 ^ 23, exponent - 150)
+end
+
+local _decode_value
+
+local function _decode_array(data, pos, count)
+    local arr = {}
+    local value
+    for i = 1, count do
+        value, pos = _decode_value(data, pos)
+        arr[i] = value
+    end
+    return arr, pos
+end
+
+local function _decode_map(data, pos, count)
+    local map = {}
+    local key, value
+    for _ = 1, count do
+        key, pos = _decode_value(data, pos)
+        value, pos = _decode_value(data, pos)
+        if key ~= nil then
+            map[key] = value
+        end
+    end
+    return map, pos
+end
+
+-- Decode the value starting at `pos`; returns the value and the next position
+_decode_value = function(data, pos)
+    local code = byte(data, pos)
+    if code == nil then
+        error("unexpected end of data")
+    end
+    pos = pos + 1
+
+    if code < 0x80 then
+        return code, pos
+    elseif code < 0x90 then
+        return _decode_map(data, pos, code - 0x80)
+    elseif code < 0xa0 then
+        return _decode_array(data, pos, code - 0x90)
+    elseif code < 0xc0 then
+        local len = code - 0xa0
+        return sub(data, pos, pos + len - 1), pos + len
+    elseif code >= 0xe0 then
+        return code - 256, pos
+    elseif code == 0xc0 then
+        return nil, pos
+    elseif code == 0xc2 then
+        return false, pos
+    elseif code == 0xc3 then
+        return true, pos
+    elseif code == 0xc4 or code == 0xd9 then
+        local len = byte(data, pos)
+        return sub(data, pos + 1, pos + len), pos + 1 + len
+    elseif code == 0xc5 or code == 0xda then
+        local len = _read_uint(data, pos, 2)
+        return sub(data, pos + 2, pos + 1 + len), pos + 2 + len
+    elseif code == 0xc6 or code == 0xdb then
+        local len = _read_uint(data, pos, 4)
+        return sub(data, pos + 4, pos + 3 + len), pos + 4 + len
+    elseif code == 0xca then
+        return _decode_float(data, pos), pos + 4
+    elseif code == 0xcb then
+        return _decode_double(data, pos), pos + 8
+    elseif code == 0xcc then
+        return byte(data, pos), pos + 1
+    elseif code == 0xcd then
+        return _read_uint(data, pos, 2), pos + 2
+    elseif code == 0xce then
+        return _read_uint(data, pos, 4), pos + 4
+    elseif code == 0xcf then
+        return _read_uint(data, pos, 4) * 2 ^ 32 + _read_uint(data, pos + 4, 4), pos + 8
+    elseif code == 0xd0 then
+        local n = byte(data, pos)
+        return n >= 0x80 and n - 2 ^ 8 or n, pos + 1
+    elseif code == 0xd1 then
+        local n = _read_uint(data, pos, 2)
+        return n >= 2 ^ 15 and n - 2 ^ 16 or n, pos + 2
+    elseif code == 0xd2 then
+        local n = _read_uint(data, pos, 4)
+        return n >= 2 ^ 31 and n - 2 ^ 32 or n, pos + 4
+    elseif code == 0xd3 then
+        local high = _read_uint(data, pos, 4)
+        if high >= 2 ^ 31 then
+            high = high - 2 ^ 32
+        end
+        return high * 2 ^ 32 + _read_uint(data, pos + 4, 4), pos + 8
+    elseif code == 0xdc then
+        return _decode_array(data, pos + 2, _read_uint(data, pos, 2))
+    elseif code == 0xdd then
+        return _decode_array(data, pos + 4, _read_uint(data, pos, 4))
+    elseif code == 0xde then
+        return _decode_map(data, pos + 2, _read_uint(data, pos, 2))
+    elseif code == 0xdf then
+        return _decode_map(data, pos + 4, _read_uint(data, pos, 4))
+    end
+    error(string.format("unsupported MessagePack type 0x%02x", code))
+end
+
+-- Decode a MessagePack string into a Lua value
+-- @param data string: Encoded bytes
+-- @return any: Decoded value (maps become tables with string keys, arrays become sequences)
+function MsgPack.decode(data)
+    local value = _decode_value(data, 1)
+    return value
+end
+
+return MsgPack
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+"""
+Game-session load generator for http_proxy.py
+
+Replays the API call pattern of a full 12-month Mountain Home game for many
+simulated players at once, following lib/api_client.lua:
+create_session -> create_agent (one per character) -> every month,
+add_messages for what happened and generate_* for the characters' replies.
+
+Calls go through http_proxy.py to a local stand-in Artificial Agency API whose
+endpoints answer with log-normal latencies (LLM generation slow, bookkeeping
+fast), so results do not depend on the real API or burn credits.
+
+The report has throughput, latency percentiles per call type, errors and the
+proxy's CPU time and peak memory, for sizing deployments and spotting
+regressions between runs (--json-out keeps a machine-readable copy).
+
+Usage:
+    python proxy_loadtest.py [--players N] [--months N] [--agents N]
+                             [--latency-scale F] [--think-ms N] [--mode envelope|facade]
+                             [--proxy-url URL] [--proxy-arg=ARG ...] [--json-out PATH]
+
+By default the script starts http_proxy.py itself on a free port; extra proxy
+flags go through --proxy-arg, e.g. --proxy-arg=--max-upstream=8. Pass
+--proxy-url to load an already running proxy instead (resource usage is then
+only reported with --proxy-pid on Linux).
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import urllib.request
+import urllib.error
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# Stand-in API latency per call type: (median seconds, log-normal sigma).
+# Roughly what the live API shows; --latency-scale shrinks or stretches them.
+LATENCY_PROFILES = {
+    'create_session': (0.15, 0.3),
+    'create_agent': (0.25, 0.3),
+    'add_messages': (0.08, 0.4),
+    'generate_text': (1.5, 0.5),
+    'generate_json': (1.8, 0.5),
+    'generate_function_call': (1.6, 0.5),
+}
+
+# Shape of one simulated game
+MONTHS = 12
+AGENTS_PER_PLAYER = 3
+ADD_MESSAGES_PER_MONTH = 3
+THINK_MS = 200
+
+# Percentiles reported per call type
+PERCENTILES = (50, 90, 95, 99)
+
+# How often the proxy process is sampled for CPU and memory
+RESOURCE_SAMPLE_SECONDS = 0.5
+
+API_VERSION = "2025-05-15"
+
+# Same agent setup the API test screen uses
+AGENT_CONFIG = {
+    "ui_config": {"friendly_name": "Load Test Villager", "emoji": "🏔️", "metadata": {"load-test": "true"}},
+    "role_config": {
+        "core": "You are a villager in a mountain homestead game.",
+        "characterization": "You trade, gossip and react to the seasons.",
+        "max_size": 0,
+    },
+    "presentation_config": {
+        "token_limits": {"cue": 100, "function": 1000, "history": 10000},
+        "presentation_order": [["history", "items"]],
+    },
+    "component_configs": [{
+        "type": "limited_list", "id": "history", "max_entries": 10000,
+        "token_category": "history", "accept_generation": True,
+    }],
+    "service_configs": [{"id": "openai_llm", "type": "openai/llm", "model": "gpt_5"}],
+    "agent_llm": "openai_llm",
+}
+
+TRADE_SCHEMA = {
+    "type": "object",
+    "properties": {"item": {"type": "string"}, "price": {"type": "integer"}},
+    "required": ["item", "price"],
+}
+
+ACTION_FUNCTIONS = [{
+    "name": "choose_action",
+    "docs": "Pick what the villager does this month",
+    "parameters": {"action": {"value_type": "string", "docs": "gather, trade or rest",
+                              "enumeration": ["gather", "trade", "rest"]}},
+    "required": ["action"],
+}]
+
+
+class StandInAPI(BaseHTTPRequestHandler):
+    """Answers the Artificial Agency endpoints the game uses, with simulated latency."""
+
+    protocol_version = 'HTTP/1.1'
+    # Replies go out as a header write and a body write. On a kept-alive connection
+    # Nagle's algorithm holds the body until the client's delayed ACK (~40 ms), which
+    # would dwarf the simulated latencies, so send every write at once (TCP_NODELAY)
+    disable_nagle_algorithm = True
+    latency_scale = 1.0
+    _ids = itertools.count(1)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        # /v1/sessions, /v1/sessions/{id}/agents, /v1/sessions/{id}/agents/{id}/<action>;
+        # the Python client creates agents under /v1/advanced/sessions/...
+        parts = [part for part in self.path.strip('/').split('/') if part != 'advanced']
+        if parts == ['v1', 'sessions']:
+            kind = 'create_session'
+            result = {"id": f"sess_{next(self._ids)}", "created_at": int(time.time()),
+                      "project_id": body.get('project_id'), "metadata": body.get('metadata', {}),
+                      "expires_at": None, "max_requests": None}
+        elif len(parts) == 4 and parts[3] == 'agents':
+            kind = 'create_agent'
+            result = {"id": f"agent_{next(self._ids)}", "session_id": parts[2], "moment_id": 1,
+                      "moment_uuid": f"moment_{next(self._ids)}",
+                      "ui_config": body.get('ui_config', {})}
+        elif len(parts) == 6 and parts[5] == 'messages':
+            kind = 'add_messages'
+            result = {"moment_id": f"moment_{next(self._ids)}"}
+        elif len(parts) == 6 and parts[5] in LATENCY_PROFILES:
+            kind = parts[5]
+            result = {"moment_id": f"moment_{next(self._ids)}"}
+            if kind == 'generate_text':
+                result["text"] = "The snow is early this year; I will need more firewood."
+            elif kind == 'generate_json':
+                result["json"] = {"item": "firewood", "price": 12}
+            else:
+                result["function_call"] = {"id": f"call_{next(self._ids)}", "name": "choose_action",
+                                           "args": {"action": "gather"}}
+        else:
+            self._reply(404, {"error": {"type": "not_found", "message": f"No route {self.path}"}})
+            return
+
+        median, sigma = LATENCY_PROFILES[kind]
+        time.sleep(random.lognormvariate(math.log(median), sigma) * self.latency_scale)
+        self._reply(200, result)
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Every simulated player may connect at once
+    request_queue_size = 1024
+
+
+class Recorder:
+    """Thread-safe latency samples and error counts per call type."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, kind, seconds, ok):
+        with self._lock:
+            if ok:
+                self.latencies.setdefault(kind, []).append(seconds)
+            else:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class Player:
+    """One simulated game: a session, a few characters and twelve months of play."""
+
+    def __init__(self, number, args, recorder):
+        self.number = number
+        self.args = args
+        self.recorder = recorder
+        self.random = random.Random(number)
+
+    def _think(self):
+        if self.args.think_ms > 0:
+            time.sleep(self.random.uniform(0.5, 1.5) * self.args.think_ms / 1000.0)
+
+    def _call(self, kind, path, body, facade_path=None):
+        """POST one API call the way the game would; returns the parsed reply or None"""
+        if self.args.mode == 'facade':
+            url = self.args.proxy_url.rsplit('/proxy', 1)[0] + facade_path
+            data = json.dumps(body).encode('utf-8')
+        else:
+            url = self.args.proxy_url
+            data = json.dumps({
+                "url": self.args.api_url + path,
+                "method": "POST",
+                "headers": {"Authorization": "Bearer load-test", "AA-API-Version": API_VERSION,
+                            "Content-Type": "application/json"},
+                "body": json.dumps(body),
+            }).encode('utf-8')
+        req = urllib.request.Request(url, data=data, method='POST', headers={
+            'Content-Type': 'application/json',
+            'X-Proxy-Client': f"player-{self.number}",
+        })
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=120) as response:
+                result = json.loads(response.read())
+            ok = True
+        except (urllib.error.URLError, OSError, ValueError):
+            result, ok = None, False
+        self.recorder.record(kind, time.perf_counter() - started, ok)
+        return result
+
+    def play(self):
+        session = self._call('create_session', '/v1/sessions',
+                             {"project_id": "load-test", "metadata": {"player": str(self.number)}},
+                             '/sessions')
+        if not session:
+            return
+        session_id = session.get('id') or session.get('session_id')
+
+        agents = []
+        for _ in range(self.args.agents):
+            agent = self._call('create_agent', f'/v1/sessions/{session_id}/agents', AGENT_CONFIG,
+                               f'/sessions/{session_id}/agents')
+            if agent:
+                agents.append(agent.get('id') or agent.get('agent_id'))
+        if not agents:
+            return
+
+        for month in range(1, self.args.months + 1):
+            for agent_id in agents:
+                prefix = f'/v1/sessions/{session_id}/agents/{agent_id}'
+                facade_prefix = f'/agents/{agent_id}'
+                for event in range(ADD_MESSAGES_PER_MONTH):
+                    messages = [{"message_type": "ContentMessage",
+                                 "content": f"Month {month}: the player did thing {event} nearby."}
+                                for _ in range(self.random.randint(1, 3))]
+                    self._call('add_messages', prefix + '/messages', {"messages": messages},
+                               facade_prefix + '/messages')
+                    self._think()
+                self._call('generate_text', prefix + '/generate_text',
+                           {"cue": "Greet the player and mention the season."},
+                           facade_prefix + '/generate_text')
+                self._think()
+            # Once a month one character decides what to do, and every quarter a trade offer
+            self._call('generate_function_call', f'/v1/sessions/{session_id}/agents/{agents[0]}'
+                       '/generate_function_call', {"functions": ACTION_FUNCTIONS},
+                       f'/agents/{agents[0]}/generate_function_call')
+            if month % 3 == 0:
+                trader = agents[-1]
+                self._call('generate_json', f'/v1/sessions/{session_id}/agents/{trader}/generate_json',
+                           {"schema": TRADE_SCHEMA, "cue": "Offer the player a trade."},
+                           f'/agents/{trader}/generate_json')
+            self._think()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.1)
+    return False
+
+
+def _proc_usage(pid):
+    """(CPU seconds, resident bytes) of a process from /proc, or None where unavailable"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return (int(fields[11]) + int(fields[12])) / ticks, rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class ResourceSampler:
+    """Track CPU time and peak resident memory of the proxy process while the test runs."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.cpu_start = self.cpu_end = None
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+
+    def start(self):
+        usage = _proc_usage(self.pid)
+        if usage is None:
+            return
+        self.cpu_start = usage[0]
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(RESOURCE_SAMPLE_SECONDS):
+            self._sample()
+
+    def _sample(self):
+        usage = _proc_usage(self.pid)
+        if usage is not None:
+            self.cpu_end = usage[0]
+            self.peak_rss = max(self.peak_rss, usage[1])
+
+    def stop(self):
+        if self.cpu_start is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def build_report(recorder, wall_seconds, sampler, args):
+    calls = {}
+    total = 0
+    for kind in LATENCY_PROFILES:
+        samples = sorted(recorder.latencies.get(kind, []))
+        errors = recorder.errors.get(kind, 0)
+        if not samples and not errors:
+            continue
+        total += len(samples)
+        stats = {"count": len(samples), "errors": errors}
+        if samples:
+            stats.update({f"p{p}_ms": round(percentile(samples, p) * 1000, 1) for p in PERCENTILES})
+            stats["max_ms"] = round(samples[-1] * 1000, 1)
+            stats["mean_ms"] = round(sum(samples) / len(samples) * 1000, 1)
+        calls[kind] = stats
+
+    report = {
+        "players": args.players, "months": args.months, "agents_per_player": args.agents,
+        "mode": args.mode, "latency_scale": args.latency_scale,
+        "wall_seconds": round(wall_seconds, 3),
+        "calls_per_second": round(total / wall_seconds, 2) if wall_seconds else 0,
+        "games_per_minute": round(args.players / wall_seconds * 60, 2) if wall_seconds else 0,
+        "calls": calls,
+    }
+    if sampler is not None and sampler.cpu_end is not None:
+        cpu = sampler.cpu_end - sampler.cpu_start
+        report["proxy"] = {"cpu_seconds": round(cpu, 3),
+                           "cpu_percent": round(cpu / wall_seconds * 100, 1) if wall_seconds else 0,
+                           "peak_rss_mb": round(sampler.peak_rss / (1024 * 1024), 1)}
+    return report
+
+
+def print_report(report):
+    print(f"\n{report['players']} players x {report['months']} months x "
+          f"{report['agents_per_player']} agents ({report['mode']} mode, "
+          f"latency x{report['latency_scale']:g}) in {report['wall_seconds']:.1f} s")
+    print(f"Throughput: {report['calls_per_second']:.1f} calls/s, "
+          f"{report['games_per_minute']:.1f} games/min")
+    header = f"{'call':<24}{'count':>7}{'errors':>8}" + ''.join(f"{'p' + str(p):>9}" for p in PERCENTILES)
+    print(header + f"{'max':>9}  (ms)")
+    for kind, stats in report['calls'].items():
+        row = f"{kind:<24}{stats['count']:>7}{stats['errors']:>8}"
+        if stats['count']:
+            row += ''.join(f"{stats[f'p{p}_ms']:>9.1f}" for p in PERCENTILES) + f"{stats['max_ms']:>9.1f}"
+        print(row)
+    if "proxy" in report:
+        proxy = report["proxy"]
+        print(f"Proxy: {proxy['cpu_seconds']:.2f} s CPU ({proxy['cpu_percent']:.1f}% of one core), "
+              f"peak RSS {proxy['peak_rss_mb']:.1f} MB")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Game-session load generator for http_proxy.py")
+    parser.add_argument('--players', type=int, default=20, help="Simulated players playing at once")
+    parser.add_argument('--months', type=int, default=MONTHS, help="Months per simulated game")
+    parser.add_argument('--agents', type=int, default=AGENTS_PER_PLAYER, help="Characters (agents) per game")
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help="Multiply the stand-in API latencies (e.g. 0.1 for a quick run)")
+    parser.add_argument('--think-ms', type=int, default=THINK_MS,
+                        help="Average pause between a player's actions")
+    parser.add_argument('--mode', choices=('envelope', 'facade'), default='envelope',
+                        help="Send /proxy envelopes like lib/api_client.lua, or use the typed facade "
+                             "endpoints (needs artificial_agency installed)")
+    parser.add_argument('--proxy-url', default=None,
+                        help="Use a running proxy (e.g. http://localhost:8080/proxy) instead of starting one")
+    parser.add_argument('--proxy-pid', type=int, default=None,
+                        help="Process id of the --proxy-url proxy, for resource usage")
+    parser.add_argument('--proxy-arg', action='append', default=[],
+                        help="Extra flag for the started proxy, e.g. --proxy-arg=--max-upstream=8")
+    parser.add_argument('--api-port', type=int, default=0, help="Port for the stand-in API (default: any free port)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for latencies and message counts")
+    parser.add_argument('--json-out', default=None, help="Also write the report to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    random.seed(args.seed)
+
+    StandInAPI.latency_scale = args.latency_scale
+    api = StandInServer(('127.0.0.1', args.api_port or free_port()), StandInAPI)
+    threading.Thread(target=api.serve_forever, name="stand-in-api", daemon=True).start()
+    args.api_url = f"http://127.0.0.1:{api.server_address[1]}"
+
+    proxy = None
+    pid = args.proxy_pid
+    if args.proxy_url is None:
+        port = free_port()
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http_proxy.py'),
+                   str(port)] + args.proxy_arg
+        if args.mode == 'facade':
+            command += ['--api-key', 'load-test', '--api-base-url', args.api_url]
+        proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pid = proxy.pid
+        args.proxy_url = f"http://127.0.0.1:{port}/proxy"
+    if not wait_for(args.proxy_url.rsplit('/proxy', 1)[0] + '/health'):
+        print(f"Proxy at {args.proxy_url} did not answer /health")
+        if proxy is not None:
+            proxy.kill()
+        return 1
+
+    recorder = Recorder()
+    sampler = ResourceSampler(pid) if pid else None
+    players = [threading.Thread(target=Player(n, args, recorder).play, name=f"player-{n}")
+               for n in range(args.players)]
+    print(f"Running {args.players} players against {args.proxy_url} (stand-in API at {args.api_url})...")
+    if sampler is not None:
+        sampler.start()
+    started = time.perf_counter()
+    for player in players:
+        player.start()
+    for player in players:
+        player.join()
+    wall_seconds = time.perf_counter() - started
+    if sampler is not None:
+        sampler.stop()
+
+    if proxy is not None:
+        proxy.terminate()
+        proxy.wait()
+    api.shutdown()
+
+    report = build_report(recorder, wall_seconds, sampler, args)
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json_out}")
+    return 1 if any(stats['errors'] for stats in report['calls'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Time-scaled replay of captured proxy traffic
+
+Re-drives a capture written by `http_proxy.py --capture PATH` against a fresh
+proxy, keeping the recorded arrival pattern but compressed by --speed (1 =
+real time, 10 = ten times faster). Upstream calls go to the stand-in API from
+proxy_loadtest.py, so replays are repeatable and never touch the real API; a
+started proxy also points its agent facade (/sessions, /agents/...) there.
+
+The report has latency percentiles and errors per call type; pass the
+--json-out of an earlier run as --baseline to see the deltas, e.g. before and
+after a proxy change or with different --proxy-arg settings.
+
+Usage:
+    python proxy_replay.py CAPTURE [--speed N] [--latency-scale F] [--max-inflight N]
+                           [--proxy-url URL] [--proxy-arg=ARG ...]
+                           [--json-out PATH] [--baseline PATH]
+"""
+
+import urllib.request
+import urllib.error
+import urllib.parse
+import argparse
+import gzip
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from proxy_loadtest import (PERCENTILES, Recorder, ResourceSampler, StandInAPI, StandInServer,
+                            free_port, percentile, wait_for)
+
+# Requests allowed in flight at once; beyond this, arrivals are delayed (and counted as late)
+MAX_INFLIGHT = 256
+
+# Arrivals dispatched more than this many seconds after their scaled time count as late
+LATE_SECONDS = 0.05
+
+# Call type for the last segment of an upstream URL
+UPSTREAM_CALLS = {
+    'sessions': 'create_session',
+    'agents': 'create_agent',
+    'messages': 'add_messages',
+    'generate_text': 'generate_text',
+    'generate_json': 'generate_json',
+    'generate_function_call': 'generate_function_call',
+}
+
+
+def load_capture(path):
+    """Captured records in arrival order; a capture cut off mid-write keeps its complete lines"""
+    opener = gzip.open if path.endswith('.gz') else open
+    records = []
+    with opener(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break  # Partial last line
+        except EOFError:
+            pass  # gzip stream without its trailer (proxy killed while capturing)
+    records.sort(key=lambda record: record['t'])
+    return records
+
+
+def classify(record):
+    """Call type of a captured request, for grouping latencies"""
+    path = urllib.parse.urlsplit(record['path']).path.rstrip('/')
+    payload = record.get('payload')
+    if path == '/proxy' and isinstance(payload, dict) and isinstance(payload.get('url'), str):
+        last = urllib.parse.urlsplit(payload['url']).path.rstrip('/').rsplit('/', 1)[-1]
+        if payload.get('write_behind'):
+            return 'add_messages (write-behind)'
+        return UPSTREAM_CALLS.get(last, 'proxy')
+    if path.startswith('/call/'):
+        return 'template ' + path[len('/call/'):]
+    if path.startswith('/templates/'):
+        return 'register_template'
+    if path in ('/sessions', '/chain'):
+        return path.lstrip('/')
+    return 'facade ' + path.rsplit('/', 1)[-1]
+
+
+def retarget(value, upstream):
+    """Point every absolute "url" in an envelope (or chain / template) at the stand-in API"""
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if key == 'url' and isinstance(item, str) and '://' in item:
+                split = urllib.parse.urlsplit(item)
+                item = urllib.parse.urlunsplit(split._replace(scheme='http', netloc=upstream))
+            result[key] = retarget(item, upstream)
+        return result
+    if isinstance(value, list):
+        return [retarget(item, upstream) for item in value]
+    return value
+
+
+class Replayer:
+    """Send captured requests to the proxy at their scaled arrival times."""
+
+    def __init__(self, records, proxy_base, upstream, speed, max_inflight, recorder):
+        self.records = records
+        self.proxy_base = proxy_base
+        self.upstream = upstream
+        self.speed = speed
+        self.recorder = recorder
+        self.late = 0
+        self.max_lag = 0.0
+        self._slots = threading.BoundedSemaphore(max_inflight)
+
+    def run(self):
+        threads = []
+        started = time.perf_counter()
+        first = self.records[0]['t'] if self.records else 0
+        for record in self.records:
+            due = started + (record['t'] - first) / self.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self._slots.acquire()
+            lag = time.perf_counter() - due
+            self.max_lag = max(self.max_lag, lag)
+            if lag > LATE_SECONDS:
+                self.late += 1
+            thread = threading.Thread(target=self._send, args=(record,), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def _send(self, record):
+        try:
+            data = json.dumps(retarget(record['payload'], self.upstream)).encode('utf-8')
+            headers = dict(record.get('headers', {}), **{'Content-Type': 'application/json'})
+            req = urllib.request.Request(self.proxy_base + record['path'], data=data, method='POST',
+                                         headers=headers)
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(req, timeout=120) as response:
+                    response.read()
+                ok = True
+            except urllib.error.HTTPError as e:
+                e.read()
+                ok = e.code < 400
+            except (urllib.error.URLError, OSError):
+                ok = False
+            self.recorder.record(classify(record), time.perf_counter() - started, ok)
+        finally:
+            self._slots.release()
+
+
+def build_report(recorder, wall_seconds, replayer, sampler, args):
+    calls = {}
+    total = 0
+    for kind in sorted(set(recorder.latencies) | set(recorder.errors)):
+        samples = sorted(recorder.latencies.get(kind, []))
+        stats = {"count": len(samples), "errors": recorder.errors.get(kind, 0)}
+        total += len(samples) + stats["errors"]
+        if samples:
+            stats.update({f"p{p}_ms": round(percentile(samples, p) * 1000, 1) for p in PERCENTILES})
+            stats["max_ms"] = round(samples[-1] * 1000, 1)
+        calls[kind] = stats
+    report = {
+        "capture": os.path.basename(args.capture), "speed": args.speed,
+        "latency_scale": args.latency_scale, "requests": total,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(total / wall_seconds, 2) if wall_seconds else 0,
+        "late_arrivals": replayer.late, "max_dispatch_lag_ms": round(replayer.max_lag * 1000, 1),
+        "calls": calls,
+    }
+    if sampler is not None and sampler.cpu_end is not None:
+        cpu = sampler.cpu_end - sampler.cpu_start
+        report["proxy"] = {"cpu_seconds": round(cpu, 3),
+                           "peak_rss_mb": round(sampler.peak_rss / (1024 * 1024), 1)}
+    return report
+
+
+def _delta(value, before):
+    if before is None or value is None:
+        return ''
+    return f" ({value - before:+.1f})"
+
+
+def print_report(report, baseline=None):
+    print(f"\nReplayed {report['requests']} requests from {report['capture']} at {report['speed']:g}x "
+          f"in {report['wall_seconds']:.1f} s ({report['requests_per_second']:.1f} req/s)")
+    if report['late_arrivals']:
+        print(f"{report['late_arrivals']} arrivals dispatched late (max lag "
+              f"{report['max_dispatch_lag_ms']:.0f} ms); raise --max-inflight or lower --speed")
+    base_calls = (baseline or {}).get('calls', {})
+    columns = [f'p{p}' for p in PERCENTILES] + ['max']
+    print(f"{'call':<30}{'count':>7}{'errors':>12}" + ''.join(f"{c:>18}" for c in columns) + "  (ms)")
+    for kind, stats in report['calls'].items():
+        before = base_calls.get(kind, {})
+        row = f"{kind:<30}{stats['count']:>7}"
+        row += f"{str(stats['errors']) + _delta(stats['errors'], before.get('errors')).replace('.0', ''):>12}"
+        for column in columns:
+            value = stats.get(f'{column}_ms')
+            cell = '' if value is None else f"{value:.1f}{_delta(value, before.get(f'{column}_ms'))}"
+            row += f"{cell:>18}"
+        print(row)
+    if "proxy" in report:
+        proxy = report["proxy"]
+        before = (baseline or {}).get("proxy", {})
+        print(f"Proxy: {proxy['cpu_seconds']:.2f} s CPU{_delta(proxy['cpu_seconds'], before.get('cpu_seconds'))}, "
+              f"peak RSS {proxy['peak_rss_mb']:.1f} MB{_delta(proxy['peak_rss_mb'], before.get('peak_rss_mb'))}")
+    if baseline:
+        print(f"Deltas in parentheses are against {baseline.get('_path', 'the baseline')}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Replay captured proxy traffic against a stand-in API")
+    parser.add_argument('capture', help="File written by http_proxy.py --capture")
+    parser.add_argument('--speed', type=float, default=1.0, help="Replay speed (1 = as captured, 10 = 10x faster)")
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help="Multiply the stand-in API latencies")
+    parser.add_argument('--max-inflight', type=int, default=MAX_INFLIGHT,
+                        help="Requests in flight at once before arrivals are held back")
+    parser.add_argument('--proxy-url', default=None,
+                        help="Replay against a running proxy (e.g. http://localhost:8080) instead of starting one; "
+                             "its envelopes still go to the stand-in API")
+    parser.add_argument('--proxy-arg', action='append', default=[],
+                        help="Extra flag for the started proxy, e.g. --proxy-arg=--max-upstream=8")
+    parser.add_argument('--json-out', default=None, help="Write the report to this JSON file")
+    parser.add_argument('--baseline', default=None, help="Earlier --json-out report to show deltas against")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    records = load_capture(args.capture)
+    if not records:
+        print(f"No requests in {args.capture}")
+        return 1
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        baseline['_path'] = args.baseline
+
+    StandInAPI.latency_scale = args.latency_scale
+    api = StandInServer(('127.0.0.1', free_port()), StandInAPI)
+    threading.Thread(target=api.serve_forever, name="stand-in-api", daemon=True).start()
+    upstream = f"127.0.0.1:{api.server_address[1]}"
+
+    proxy = None
+    proxy_base = args.proxy_url.rstrip('/') if args.proxy_url else None
+    if proxy_base is None:
+        port = free_port()
+        # The facade needs a key and an API to call; --proxy-arg can still override both
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http_proxy.py'),
+                   str(port), '--api-key', 'replay', '--api-base-url', f"http://{upstream}"] + args.proxy_arg
+        proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        proxy_base = f"http://127.0.0.1:{port}"
+    if not wait_for(proxy_base + '/health'):
+        print(f"Proxy at {proxy_base} did not answer /health")
+        if proxy is not None:
+            proxy.kill()
+        return 1
+
+    recorder = Recorder()
+    replayer = Replayer(records, proxy_base, upstream, args.speed, args.max_inflight, recorder)
+    sampler = ResourceSampler(proxy.pid) if proxy is not None else None
+    span = records[-1]['t'] - records[0]['t']
+    print(f"Replaying {len(records)} requests spanning {span:.1f} s at {args.speed:g}x against {proxy_base}...")
+    if sampler is not None:
+        sampler.start()
+    wall_seconds = replayer.run()
+    if sampler is not None:
+        sampler.stop()
+
+    if proxy is not None:
+        proxy.terminate()
+        proxy.wait()
+    api.shutdown()
+    api.server_close()
+
+    report = build_report(recorder, wall_seconds, replayer, sampler, args)
+    print_report(report, baseline)
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json_out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,926 @@
+#!/usr/bin/env python3
+"""
+Tests for http_proxy.py that run a proxy and a stand-in API on localhost
+
+Usage:
+    python -m unittest test_http_proxy
+
+The facade tests need the artificial_agency package on the path, e.g.
+PYTHONPATH=examples/artificial-agency/src python -m unittest test_http_proxy
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+import http.client
+import json
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import http_proxy
+import proxy_loadtest
+import proxy_replay
+
+
+class RecordingAPI(BaseHTTPRequestHandler):
+    """Stand-in API that records each request and answers with `reply` after `delay` seconds"""
+
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    # (status, headers, body) sent for every request, or a function of (method, path, body) returning one
+    reply = (200, {'Content-Type': 'application/json'}, b'{}')
+    delay = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        cls.requests = []
+        cls.reply = (200, {'Content-Type': 'application/json'}, b'{}')
+        cls.delay = 0
+
+    def _record(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request_body = self.rfile.read(length)
+        with RecordingAPI._lock:
+            RecordingAPI.requests.append((self.command, self.path, self.headers, request_body))
+        time.sleep(RecordingAPI.delay)
+        reply = RecordingAPI.reply
+        status, headers, body = reply(self.command, self.path, request_body) if callable(reply) else reply
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _record
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietHandler(http_proxy.ProxyHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server
+
+
+class ProxyTestCase(unittest.TestCase):
+    """Runs a stand-in API and a proxy whose handler gets the attributes from handler_attrs()"""
+
+    def handler_attrs(self):
+        return {}
+
+    def setUp(self):
+        RecordingAPI.reset()
+        self.api = _serve(ThreadingHTTPServer(('127.0.0.1', 0), RecordingAPI))
+        self.addCleanup(self.api.server_close)
+        self.addCleanup(self.api.shutdown)
+        self.handler = type('TestHandler', (QuietHandler,), self.handler_attrs())
+        self.proxy = _serve(http_proxy.ProxyServer(('127.0.0.1', 0), self.handler))
+        self.addCleanup(self.proxy.server_close)
+        self.addCleanup(self.proxy.shutdown)
+
+    def api_url(self, path):
+        return f"http://127.0.0.1:{self.api.server_address[1]}{path}"
+
+    def request(self, path, body=b'', headers=None, method='POST'):
+        """Send a raw request to the proxy; returns (status, headers, body)"""
+        connection = http.client.HTTPConnection('127.0.0.1', self.proxy.server_address[1], timeout=10)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            connection.close()
+
+    def post(self, path, payload, headers=None):
+        """POST a JSON body to the proxy; returns (status, body)"""
+        status, _, body = self.request(path, json.dumps(payload).encode('utf-8'),
+                                       dict(headers or {}, **{'Content-Type': 'application/json'}))
+        return status, body
+
+    def envelope(self, path, body=None, method='POST', headers=None, **extra):
+        """An envelope for the stand-in API at `path`"""
+        envelope = {"url": self.api_url(path), "method": method, "headers": headers or {}, **extra}
+        if body is not None:
+            envelope["body"] = body
+        return envelope
+
+    def upstream_bodies(self):
+        return [json.loads(body) if body else None for _, _, _, body in RecordingAPI.requests]
+
+
+class TestSizeLimits(ProxyTestCase):
+    def handler_attrs(self):
+        return {"max_request_bytes": 4096, "max_response_bytes": 4096}
+
+    def test_oversized_request_is_rejected_unread(self):
+        status, _ = self.post('/proxy', self.envelope('/v1/echo', "x" * 8192))
+        self.assertEqual(status, 413)
+        self.assertEqual(RecordingAPI.requests, [])
+
+    def test_oversized_upstream_response_becomes_502(self):
+        RecordingAPI.reply = (200, {'Content-Type': 'application/json'}, b'"' + b'x' * 8192 + b'"')
+        status, _ = self.post('/proxy', self.envelope('/v1/echo', "{}"))
+        self.assertEqual(status, 502)
+
+    def test_spooled_bodies_pass_through_intact(self):
+        body = json.dumps({"text": "y" * 3000})
+        RecordingAPI.reply = (200, {'Content-Type': 'application/json'}, body.encode('utf-8'))
+        with mock.patch.object(http_proxy.ProxyHandler, 'spool_threshold_bytes', 512):
+            status, reply = self.post('/proxy', self.envelope('/v1/echo', body))
+        self.assertEqual((status, reply), (200, body.encode('utf-8')))
+        self.assertEqual(RecordingAPI.requests[0][3], body.encode('utf-8'))
+
+
+def _agent_api(method, path, body):
+    """Answer the agent API calls the facade makes with minimal valid responses"""
+    parts = [part for part in path.strip('/').split('/') if part != 'advanced']
+    if parts == ['v1', 'sessions']:
+        result = {"id": "sess_1", "created_at": 0, "project_id": "proj_1", "metadata": {},
+                  "expires_at": None, "max_requests": None}
+    elif parts[-1] == 'agents':
+        result = {"id": "agent_1", "session_id": parts[2], "moment_id": 1, "moment_uuid": "m_1",
+                  "ui_config": {"friendly_name": "Villager"}}
+    elif parts[-1] == 'messages':
+        result = {"moment_id": "moment_2"}
+    elif parts[-1] == 'generate_text':
+        result = {"moment_id": "moment_3", "text": "Hello"}
+    else:
+        error = {"error": {"type": "not_found", "message": "No such route", "trace": ""}}
+        return 404, {'Content-Type': 'application/json'}, json.dumps(error).encode('utf-8')
+    return 200, {'Content-Type': 'application/json'}, json.dumps(result).encode('utf-8')
+
+
+@unittest.skipIf(http_proxy.aa_async_client is None, "artificial_agency is not installed")
+class TestFacade(ProxyTestCase):
+    def handler_attrs(self):
+        return {"facade": http_proxy.AgentFacade("test-api-key", self.api_url(''))}
+
+    def setUp(self):
+        super().setUp()
+        RecordingAPI.reply = _agent_api
+
+    def test_agent_calls_need_only_the_agent_id(self):
+        status, body = self.post('/sessions', {"project_id": "proj_1"})
+        self.assertEqual((status, json.loads(body)["session_id"]), (200, "sess_1"))
+        status, body = self.post('/sessions/sess_1/agents', proxy_loadtest.AGENT_CONFIG)
+        self.assertEqual((status, json.loads(body)),
+                         (200, {"agent_id": "agent_1", "session_id": "sess_1", "moment_id": 1}))
+
+        status, body = self.post('/agents/agent_1/messages',
+                                 {"messages": [{"message_type": "ContentMessage", "content": "Snow"}]})
+        self.assertEqual((status, json.loads(body)), (200, {"moment_id": "moment_2"}))
+        status, body = self.post('/agents/agent_1/generate_text?fields=text', {"cue": "Hi"})
+        self.assertEqual((status, json.loads(body)), (200, {"text": "Hello"}))
+        self.assertEqual([path for _, path, _, _ in RecordingAPI.requests][-2:],
+                         ['/v1/sessions/sess_1/agents/agent_1/messages',
+                          '/v1/sessions/sess_1/agents/agent_1/generate_text'])
+        self.assertEqual(RecordingAPI.requests[-1][2]['Authorization'], 'Bearer test-api-key')
+
+    def test_unknown_agent_needs_session_id(self):
+        status, body = self.post('/agents/agent_9/generate_text', {"cue": "Hi"})
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (404, "not_found"))
+        self.assertEqual(RecordingAPI.requests, [])
+
+    def test_unknown_argument_is_a_bad_request(self):
+        status, body = self.post('/agents/agent_1/generate_text', {"session_id": "sess_1", "tone": "grim"})
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (400, "invalid_request"))
+        self.assertEqual(RecordingAPI.requests, [])
+
+    def test_api_errors_keep_their_status(self):
+        status, body = self.post('/agents/agent_1/generate_json', {"session_id": "sess_1", "schema": {}})
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (404, "not_found"))
+
+    def test_unreachable_api_is_a_bad_gateway(self):
+        self.handler.facade = http_proxy.AgentFacade("test-api-key", "http://127.0.0.1:9")
+        status, body = self.post('/agents/agent_1/generate_text', {"session_id": "sess_1"})
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (502, "upstream_error"))
+
+    def test_agent_sessions_are_bounded(self):
+        facade = self.handler.facade
+        with mock.patch.object(http_proxy, 'FACADE_MAX_AGENTS', 2):
+            for agent_id in ('a', 'b', 'c'):
+                facade._remember_agent(agent_id, 'sess_' + agent_id)
+        self.assertEqual(list(facade._agent_sessions), ['b', 'c'])
+
+
+def _concurrently(*calls):
+    """Run the calls at the same time; returns their results in order"""
+    results = [None] * len(calls)
+
+    def run(index, call):
+        results[index] = call()
+
+    threads = [threading.Thread(target=run, args=item) for item in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(15)
+    return results
+
+
+class TestCoalescing(ProxyTestCase):
+    def handler_attrs(self):
+        return {"coalescer": http_proxy.MessageCoalescer(0.3, 64)}
+
+    def add_messages(self, message, headers):
+        path = '/v1/sessions/sess_1/agents/agent_1/messages'
+        return lambda: self.post('/proxy', self.envelope(path, {"messages": [message]}, headers=headers))
+
+    def test_same_headers_share_one_call(self):
+        headers = {"Authorization": "Bearer alice", "AA-API-Version": "2025-05-15"}
+        results = _concurrently(self.add_messages("a", headers), self.add_messages("b", headers))
+        self.assertEqual(results, [(200, b'{}')] * 2)
+        [body] = self.upstream_bodies()
+        self.assertEqual(sorted(body["messages"]), ["a", "b"])
+
+    def test_different_credentials_are_never_merged(self):
+        results = _concurrently(self.add_messages("alice", {"authorization": "Bearer alice"}),
+                                self.add_messages("mallory", {"authorization": "Bearer mallory"}))
+        self.assertEqual(results, [(200, b'{}')] * 2)
+        sent = sorted((headers['authorization'], json.loads(body)["messages"])
+                      for _, _, headers, body in RecordingAPI.requests)
+        self.assertEqual(sent, [("Bearer alice", ["alice"]), ("Bearer mallory", ["mallory"])])
+
+    def test_different_api_versions_are_never_merged(self):
+        auth = {"Authorization": "Bearer alice"}
+        _concurrently(self.add_messages("old", dict(auth, **{"AA-API-Version": "2025-01-01"})),
+                      self.add_messages("new", dict(auth, **{"aa-api-version": "2025-05-15"})))
+        self.assertEqual(sorted(body["messages"][0] for body in self.upstream_bodies()), ["new", "old"])
+
+
+class TestMessagePack(ProxyTestCase):
+    def test_round_trip(self):
+        value = {"text": "héllo", "n": [0, 127, 128, -1, -33, 70000, 2 ** 40, -2 ** 40, 1.5],
+                 "flags": [True, False, None], "nested": {"list": [{"a": "b" * 300}]}}
+        self.assertEqual(http_proxy.msgpack_loads(http_proxy.msgpack_dumps(value)), value)
+
+    def test_malformed_input_raises_value_error(self):
+        for data in (b'', b'\xa5ab', b'\x81\x90\x01', b'\xc1', b'\x91' * 100 + b'\x01'):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                http_proxy.msgpack_loads(data)
+
+    def test_msgpack_envelope_and_reply(self):
+        RecordingAPI.reply = (200, {'Content-Type': 'application/json'}, b'{"moment_id": "m_1"}')
+        envelope = self.envelope('/v1/echo', {"messages": ["hi"]})
+        status, headers, body = self.request('/proxy', http_proxy.msgpack_dumps(envelope),
+                                             {'Content-Type': 'application/msgpack',
+                                              'Accept': 'application/msgpack'})
+        self.assertEqual((status, headers['Content-Type']), (200, 'application/msgpack'))
+        self.assertEqual(http_proxy.msgpack_loads(body), {"moment_id": "m_1"})
+        # Structured bodies go upstream as JSON
+        self.assertEqual(self.upstream_bodies(), [{"messages": ["hi"]}])
+
+    def test_malformed_msgpack_envelope_is_a_bad_request(self):
+        status, _, _ = self.request('/proxy', b'\x81\x90\x01', {'Content-Type': 'application/msgpack'})
+        self.assertEqual(status, 400)
+        status, _, _ = self.request('/proxy', b'\x91' * 100 + b'\xc0', {'Content-Type': 'application/msgpack'})
+        self.assertEqual(status, 400)
+        self.assertEqual(RecordingAPI.requests, [])
+
+
+class TestProjection(ProxyTestCase):
+    RESPONSE = {"moment_id": "m_1", "function_call": {"name": "jump", "args": {"height": 2}},
+                "items": [{"name": "axe"}, {"name": "rope"}]}
+
+    def setUp(self):
+        super().setUp()
+        RecordingAPI.reply = (200, {'Content-Type': 'application/json'}, json.dumps(self.RESPONSE).encode('utf-8'))
+
+    def test_project_fields(self):
+        self.assertEqual(http_proxy.project_fields(self.RESPONSE, ["$.function_call.args", "items[1].name",
+                                                                   "items[5].name", "missing.key"]),
+                         {"$.function_call.args": {"height": 2}, "items[1].name": "rope",
+                          "items[5].name": None, "missing.key": None})
+
+    def test_envelope_fields(self):
+        status, body = self.post('/proxy', self.envelope('/v1/x', "{}", fields=["moment_id", "function_call.name"]))
+        self.assertEqual((status, json.loads(body)), (200, {"moment_id": "m_1", "function_call.name": "jump"}))
+
+    def test_query_fields(self):
+        status, body = self.post('/proxy?fields=moment_id', self.envelope('/v1/x', "{}"))
+        self.assertEqual((status, json.loads(body)), (200, {"moment_id": "m_1"}))
+
+    def test_errors_are_not_projected(self):
+        error = b'{"error": {"type": "invalid_request", "message": "bad"}}'
+        RecordingAPI.reply = (400, {'Content-Type': 'application/json'}, error)
+        self.assertEqual(self.post('/proxy', self.envelope('/v1/x', "{}", fields=["moment_id"])), (400, error))
+
+    def test_invalid_fields_are_a_bad_request(self):
+        status, _ = self.post('/proxy', self.envelope('/v1/x', "{}", fields="moment_id"))
+        self.assertEqual(status, 400)
+        self.assertEqual(RecordingAPI.requests, [])
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.holders = []
+        self.addCleanup(self.release_all)
+
+    def release_all(self):
+        for _, release in self.holders:
+            release.set()
+        for thread, _ in self.holders:
+            thread.join(10)
+
+    def hold(self, admission, release, **kwargs):
+        """Take a slot in a thread and keep it until `release` is set"""
+        held = threading.Event()
+
+        def run():
+            with admission.slot(**kwargs):
+                held.set()
+                release.wait(10)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.holders.append((thread, release))
+        return held
+
+    def test_queued_request_runs_when_a_slot_frees(self):
+        admission = http_proxy.AdmissionController(1, 4, 60)
+        release = threading.Event()
+        self.assertTrue(self.hold(admission, release).wait(5))
+        queued = self.hold(admission, threading.Event())
+        self.assertFalse(queued.wait(0.1))
+        self.assertEqual(admission.stats()["queued"], 1)
+        release.set()
+        self.assertTrue(queued.wait(5))
+
+    def test_full_queue_sheds(self):
+        admission = http_proxy.AdmissionController(1, 1, 60)
+        self.assertTrue(self.hold(admission, threading.Event(), priority='high').wait(5))
+        self.hold(admission, threading.Event(), priority='high')
+        time.sleep(0.1)
+        with self.assertRaises(http_proxy.Overloaded) as e:
+            with admission.slot('high'):
+                pass
+        self.assertGreaterEqual(e.exception.retry_after, 1)
+        self.assertEqual(admission.stats()["shed"], 1)
+
+    def test_low_priority_is_shed_first(self):
+        admission = http_proxy.AdmissionController(1, 2, 60)
+        self.assertTrue(self.hold(admission, threading.Event()).wait(5))
+        self.hold(admission, threading.Event())
+        time.sleep(0.1)
+        # One queued request fills half the queue: the share low priority gets
+        with self.assertRaises(http_proxy.Overloaded):
+            with admission.slot('low'):
+                pass
+        self.hold(admission, threading.Event(), priority='high')
+        time.sleep(0.1)
+        self.assertEqual(admission.stats()["queued"], 2)
+
+    def test_queue_timeout_sheds(self):
+        admission = http_proxy.AdmissionController(1, 4, 60, queue_timeout=0.1)
+        self.assertTrue(self.hold(admission, threading.Event()).wait(5))
+        with self.assertRaises(http_proxy.Overloaded):
+            with admission.slot():
+                pass
+        self.assertEqual(admission.stats()["queued"], 0)
+
+
+class TestFairQueuing(unittest.TestCase):
+    def test_quiet_client_is_served_next(self):
+        admission = http_proxy.AdmissionController(1, 32, 600)
+        order = []
+
+        def call(client):
+            with admission.slot('normal', client):
+                order.append(client)
+                time.sleep(0.05)
+
+        noisy = [threading.Thread(target=call, args=('noisy',)) for _ in range(8)]
+        for thread in noisy:
+            thread.start()
+        # Arrive halfway through a noisy call
+        time.sleep(0.125)
+        served_before = len(order)
+        quiet = threading.Thread(target=call, args=('quiet',))
+        quiet.start()
+        for thread in noisy + [quiet]:
+            thread.join(10)
+        # The request holding the slot when the quiet client arrived finishes, then it goes next
+        self.assertEqual(order.index('quiet'), served_before)
+
+    def test_weights_share_upstream_time(self):
+        admission = http_proxy.AdmissionController(1, 64, 600, client_weights={'heavy': 2.0})
+        order = []
+        release = threading.Event()
+
+        def call(client):
+            with admission.slot('normal', client):
+                order.append(client)
+                release.wait(10)
+                time.sleep(0.02)
+
+        blocker = threading.Thread(target=call, args=('blocker',))
+        blocker.start()
+        _wait_for(lambda: order)
+        threads = [threading.Thread(target=call, args=(client,)) for client in ['heavy'] * 6 + ['light'] * 6]
+        for thread in threads:
+            thread.start()
+        _wait_for(lambda: admission.stats()["queued"] == 12)
+        release.set()
+        for thread in [blocker] + threads:
+            thread.join(10)
+        # Twice the weight, so at least twice the light client's share while both are backlogged
+        self.assertGreaterEqual(order[1:7].count('heavy'), 4)
+
+
+class TestClientIds(ProxyTestCase):
+    def handler_attrs(self):
+        return {"admission": http_proxy.AdmissionController(4, 4, 60)}
+
+    def test_client_comes_from_the_header_or_the_address(self):
+        for client in ('game-1', 'game-2', 'game-2', None):
+            headers = {'X-Proxy-Client': client} if client else {}
+            self.assertEqual(self.post('/proxy', self.envelope('/v1/x', "{}"), headers)[0], 200)
+        stats = self.handler.admission.client_stats()
+        self.assertEqual({client: values["admitted"] for client, values in stats.items()},
+                         {'game-1': 1, 'game-2': 2, '127.0.0.1': 1})
+
+        status, _, body = self.request('/metrics', method='GET')
+        self.assertEqual(status, 200)
+        self.assertIn('proxy_client_admitted_total{client="game-2"} 2', body.decode('utf-8').splitlines())
+
+
+class TestAdmissionThroughProxy(ProxyTestCase):
+    def handler_attrs(self):
+        return {"admission": http_proxy.AdmissionController(1, 0, 60)}
+
+    def test_overloaded_proxy_answers_503_with_retry_after(self):
+        RecordingAPI.delay = 0.3
+
+        def call():
+            return self.request('/proxy', json.dumps(self.envelope('/v1/x', "{}")).encode('utf-8'))
+
+        results = _concurrently(call, call)
+        self.assertEqual(sorted(status for status, _, _ in results), [200, 503])
+        [headers] = [headers for status, headers, _ in results if status == 503]
+        self.assertTrue(headers['Retry-After'].isdigit())
+
+
+class TestIdempotency(ProxyTestCase):
+    def handler_attrs(self):
+        return {"idempotency": http_proxy.IdempotencyStore(60, 8)}
+
+    def send(self, client='game-1', key='key-1', auth='Bearer alice', body='{"n": 1}'):
+        envelope = self.envelope('/v1/x', body, headers={"authorization": auth})
+        return self.request('/proxy', json.dumps(envelope).encode('utf-8'),
+                            {'Idempotency-Key': key, 'X-Proxy-Client': client})
+
+    def test_duplicate_is_replayed(self):
+        status, headers, body = self.send()
+        self.assertEqual((status, headers['Idempotent-Replayed']), (200, None))
+        status, headers, replayed = self.send()
+        self.assertEqual((status, headers['Idempotent-Replayed'], replayed), (200, 'true', body))
+        self.assertEqual(len(RecordingAPI.requests), 1)
+
+    def test_concurrent_duplicate_waits_and_is_replayed(self):
+        RecordingAPI.delay = 0.3
+        results = _concurrently(self.send, self.send)
+        self.assertEqual(sorted(headers['Idempotent-Replayed'] or '' for _, headers, _ in results), ['', 'true'])
+        self.assertEqual(len(RecordingAPI.requests), 1)
+
+    def test_keys_are_scoped_to_the_client(self):
+        self.send()
+        status, headers, _ = self.send(client='game-2')
+        self.assertEqual((status, headers['Idempotent-Replayed']), (200, None))
+        status, headers, _ = self.send(auth='Bearer mallory')
+        self.assertEqual((status, headers['Idempotent-Replayed']), (200, None))
+        self.assertEqual(len(RecordingAPI.requests), 3)
+
+    def test_reused_key_with_another_body_is_rejected(self):
+        self.send()
+        status, _, body = self.send(body='{"n": 2}')
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (422, "idempotency_key_reused"))
+
+    def test_server_errors_are_not_stored(self):
+        RecordingAPI.reply = (500, {'Content-Type': 'application/json'}, b'{}')
+        self.assertEqual(self.send()[0], 500)
+        RecordingAPI.reset()
+        self.assertEqual(self.send()[0], 200)
+        self.assertEqual(len(RecordingAPI.requests), 1)
+
+    def test_in_flight_entries_are_never_evicted(self):
+        store = http_proxy.IdempotencyStore(60, 2)
+        store.begin(('a',), 'd')
+        store.begin(('b',), 'd')
+        with self.assertRaises(http_proxy.Overloaded):
+            store.begin(('c',), 'd')
+        store.complete(('a',), store.begin(('a',), 'd')[0], b'HTTP/1.0 200 OK\r\n\r\n')
+        self.assertTrue(store.begin(('c',), 'd')[1])
+        self.assertFalse(store.begin(('b',), 'd')[1])
+
+
+class TestSharedCache(ProxyTestCase):
+    """Two proxies, each with its own stores on one cache file, stand in for two proxy processes"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name + '/cache.sqlite'
+        super().setUp()
+        self.other = _serve(http_proxy.ProxyServer(('127.0.0.1', 0), type('OtherHandler', (QuietHandler,), self.handler_attrs())))
+        self.addCleanup(self.other.server_close)
+        self.addCleanup(self.other.shutdown)
+
+    def handler_attrs(self):
+        cache = http_proxy.SharedCache(self.path, 1 << 20, 60)
+        return {"cache": cache, "idempotency": http_proxy.IdempotencyStore(60, 8, shared=cache)}
+
+    def send(self, proxy, envelope, headers=None):
+        connection = http.client.HTTPConnection('127.0.0.1', proxy.server_address[1], timeout=10)
+        try:
+            connection.request('POST', '/proxy', body=json.dumps(envelope).encode('utf-8'), headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            connection.close()
+
+    def get(self, proxy, auth='Bearer alice'):
+        return self.send(proxy, self.envelope('/v1/agents', method='GET', headers={"Authorization": auth}))
+
+    def test_get_is_cached_across_processes_per_credential(self):
+        self.assertEqual(self.get(self.proxy)[1]['X-Proxy-Cache'], 'miss')
+        self.assertEqual(self.get(self.other)[1]['X-Proxy-Cache'], 'hit')
+        self.assertEqual(self.get(self.other, auth='Bearer mallory')[1]['X-Proxy-Cache'], 'miss')
+        self.assertEqual(len(RecordingAPI.requests), 2)
+
+    def test_no_store_responses_are_not_cached(self):
+        RecordingAPI.reply = (200, {'Content-Type': 'application/json', 'Cache-Control': 'no-store'}, b'{}')
+        self.get(self.proxy)
+        self.assertEqual(self.get(self.proxy)[1]['X-Proxy-Cache'], 'miss')
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = http_proxy.SharedCache(self.path, 4096, 60)
+        for n in range(4):
+            cache.put(f'k{n}', b'x' * 1000, 60)
+        cache.put('k4', b'x' * 1000, 60)
+        self.assertIsNone(cache.get('k0'))
+        self.assertIsNotNone(cache.get('k4'))
+        self.assertLessEqual(cache.stats()["bytes"], 4096)
+
+    def test_duplicate_in_another_process_waits_and_is_replayed(self):
+        RecordingAPI.delay = 0.3
+        envelope = self.envelope('/v1/x', '{"n": 1}')
+        headers = {'Idempotency-Key': 'key-1'}
+        results = _concurrently(lambda: self.send(self.proxy, envelope, headers),
+                                lambda: (time.sleep(0.1), self.send(self.other, envelope, headers))[1])
+        self.assertEqual([headers['Idempotent-Replayed'] for _, headers, _ in results], [None, 'true'])
+        self.assertEqual(results[0][2], results[1][2])
+        self.assertEqual(len(RecordingAPI.requests), 1)
+
+    def test_claims_are_released_or_completed(self):
+        cache = http_proxy.SharedCache(self.path, 1 << 20, 60)
+        first = http_proxy.IdempotencyStore(60, 8, shared=cache)
+        second = http_proxy.IdempotencyStore(60, 8, shared=http_proxy.SharedCache(self.path, 1 << 20, 60))
+        entry, owner = first.begin(('a',), 'd')
+        waiting, duplicate_owner = second.begin(('a',), 'd')
+        self.assertEqual((owner, duplicate_owner), (True, False))
+        self.assertFalse(second.wait(('a',), waiting, 0.05))
+
+        first.abandon(('a',), entry)
+        self.assertTrue(second.wait(('a',), waiting, 1))
+        self.assertIsNone(waiting.response)
+        entry, owner = second.begin(('a',), 'd')
+        self.assertTrue(owner)
+        second.complete(('a',), entry, b'HTTP/1.0 200 OK\r\n\r\n')
+        replayed, owner = first.begin(('a',), 'd')
+        self.assertEqual((owner, replayed.response), (False, b'HTTP/1.0 200 OK\r\n\r\n'))
+
+    def test_adopted_entries_count_towards_the_cap(self):
+        cache = http_proxy.SharedCache(self.path, 1 << 20, 60)
+        first = http_proxy.IdempotencyStore(60, 8, shared=cache)
+        first.complete(('a',), first.begin(('a',), 'd')[0], b'HTTP/1.0 200 OK\r\n\r\n')
+        second = http_proxy.IdempotencyStore(60, 1, shared=cache)
+        second.begin(('b',), 'd')
+        with self.assertRaises(http_proxy.Overloaded):
+            second.begin(('a',), 'd')
+
+
+class TestSlowRequests(ProxyTestCase):
+    def handler_attrs(self):
+        return {"slow_recorder": http_proxy.SlowRequestRecorder(0.1, 2)}
+
+    def test_only_slow_requests_are_recorded(self):
+        self.post('/proxy', self.envelope('/v1/fast', "{}"))
+        RecordingAPI.delay = 0.15
+        self.post('/proxy', self.envelope('/v1/slow', "{}", headers={"Authorization": "Bearer secret"}))
+
+        status, _, body = self.request('/debug/slow', method='GET')
+        [record] = json.loads(body)["records"]
+        self.assertEqual((status, record["target"], record["status"]), (200, self.api_url('/v1/slow'), 200))
+        self.assertEqual(record["upstream_headers"]["Authorization"], '<redacted>')
+        self.assertGreaterEqual(record["total_ms"], 150)
+        self.assertLessEqual(record["phases_ms"]["upstream_headers"], record["phases_ms"]["sent"])
+
+    def test_dump_to_file(self):
+        RecordingAPI.delay = 0.15
+        self.post('/proxy', self.envelope('/v1/slow', "{}"))
+        with tempfile.TemporaryDirectory() as directory:
+            with open(self.handler.slow_recorder.write(directory)) as f:
+                self.assertEqual(len(json.load(f)["records"]), 1)
+
+
+class TestTrace(ProxyTestCase):
+    def handler_attrs(self):
+        return {"tracer": http_proxy.TraceRecorder(10)}
+
+    def test_trace_has_a_span_per_request_and_phase(self):
+        self.post('/proxy', self.envelope('/v1/x', "{}"))
+        status, headers, body = self.request('/debug/trace?seconds=60', method='GET')
+        self.assertEqual((status, headers['Content-Type']), (200, 'application/json'))
+        events = json.loads(body)["traceEvents"]
+        [request] = [event for event in events if event.get("cat") == "request"]
+        self.assertEqual((request["name"], request["args"]["status"]), ("POST /proxy", 200))
+        phases = [event["name"] for event in events if event.get("cat") == "phase"]
+        self.assertEqual(phases, ["read request", "queued", "connecting", "sending", "upstream wait",
+                                  "upstream body", "relaying"])
+        self.assertTrue(all(event["ts"] >= request["ts"] and event["dur"] >= 0
+                            for event in events if event.get("cat") == "phase"))
+        self.assertIn("thread_name", [event["name"] for event in events if event["ph"] == "M"])
+
+    def test_old_requests_are_left_out(self):
+        self.post('/proxy', self.envelope('/v1/x', "{}"))
+        time.sleep(0.1)
+        self.assertEqual(self.handler.tracer.export(0.05)["traceEvents"], [])
+
+    def test_bad_window_is_a_bad_request(self):
+        self.assertEqual(self.request('/debug/trace?seconds=soon', method='GET')[0], 400)
+
+
+class TestProfile(ProxyTestCase):
+    def handler_attrs(self):
+        return {"profiling": True}
+
+    def test_profile_is_off_by_default(self):
+        self.handler.profiling = False
+        self.assertEqual(self.request('/debug/profile?seconds=0.1', method='GET')[0], 404)
+
+    def test_profile_returns_collapsed_stacks(self):
+        status, headers, body = self.request('/debug/profile?seconds=0.2&interval_ms=10', method='GET')
+        self.assertEqual((status, headers['Content-Type']), (200, 'text/plain; charset=utf-8'))
+        lines = body.decode('utf-8').splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, _, count = line.rpartition(' ')
+            self.assertTrue(stack and count.isdigit(), line)
+        self.assertTrue(any('serve_forever' in line for line in lines))
+
+    def test_one_profile_at_a_time(self):
+        results = _concurrently(lambda: self.request('/debug/profile?seconds=0.3', method='GET')[0],
+                                lambda: time.sleep(0.1) or self.request('/debug/profile?seconds=0.3',
+                                                                        method='GET')[0])
+        self.assertEqual(results, [200, 409])
+
+    def test_window_is_bounded(self):
+        self.assertEqual(self.request('/debug/profile?seconds=1000', method='GET')[0], 400)
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for condition")
+        time.sleep(0.02)
+
+
+class TestWriteBehind(ProxyTestCase):
+    PATH = '/v1/sessions/sess_1/agents/agent_1/messages'
+
+    def handler_attrs(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = f"{directory.name}/queue.db"
+        return {"write_behind": http_proxy.WriteBehindQueue(self.db_path, 64, 1)}
+
+    def queue(self, messages, path=PATH, **envelope):
+        return self.post('/proxy', self.envelope(path, {"messages": messages}, write_behind=True, **envelope))
+
+    def test_queued_envelopes_are_acknowledged_and_delivered_in_order(self):
+        RecordingAPI.delay = 0.2
+        self.assertEqual(self.queue(["a"])[0], 202)
+        status, body = self.queue(["b"])
+        self.assertEqual((status, json.loads(body)["queued"]), (202, True))
+        self.queue(["c"])
+        _wait_for(lambda: self.handler.write_behind.stats()["sent"] == 3)
+        # The first call was already in flight; the two queued behind it are merged
+        self.assertEqual([body["messages"] for body in self.upstream_bodies()], [["a"], ["b", "c"]])
+
+    def test_rejected_calls_move_to_the_failed_table(self):
+        RecordingAPI.reply = (422, {'Content-Type': 'application/json'}, b'{"error": {}}')
+        queue = self.handler.write_behind
+        with mock.patch.object(http_proxy, 'print', create=True) as log:
+            self.queue(["bad"])
+            _wait_for(lambda: queue.stats()["failed"] == 1)
+        self.assertIn("rejected with 422", log.call_args[0][0])
+        self.assertEqual(queue.stats()["pending"], 0)
+        self.assertEqual(queue._db.execute('SELECT status, messages FROM failed').fetchall(), [(422, '["bad"]')])
+
+    def test_server_errors_are_retried(self):
+        RecordingAPI.reply = (503, {'Content-Type': 'application/json'}, b'{}')
+        with mock.patch.object(http_proxy, 'WRITE_BEHIND_RETRY_BASE', 0.05):
+            self.queue(["retry"])
+            _wait_for(lambda: len(RecordingAPI.requests) >= 2)
+            RecordingAPI.reply = (200, {'Content-Type': 'application/json'}, b'{}')
+            _wait_for(lambda: self.handler.write_behind.stats()["sent"] == 1)
+        self.assertEqual({body["messages"][0] for body in self.upstream_bodies()}, {"retry"})
+
+    def test_unsendable_envelopes_are_rejected_up_front(self):
+        status, _ = self.post('/proxy', {"url": "ftp://example.com" + self.PATH, "write_behind": True,
+                                         "body": {"messages": ["x"]}})
+        self.assertEqual(status, 400)
+        self.assertEqual(self.queue(["x"], headers={"Authorization": 7})[0], 400)
+        self.assertEqual(self.queue("not a list")[0], 400)
+        self.assertEqual(self.handler.write_behind.stats()["pending"], 0)
+
+    def test_queue_survives_a_restart(self):
+        stopped = http_proxy.WriteBehindQueue(self.db_path + '.2', 64, 0)
+        stopped.enqueue(self.api_url(self.PATH), {}, ["kept"])
+        restarted = http_proxy.WriteBehindQueue(self.db_path + '.2', 64, 1)
+        _wait_for(lambda: restarted.stats()["sent"] == 1)
+        self.assertEqual(self.upstream_bodies(), [{"messages": ["kept"]}])
+
+
+class TestLoadTestStandIn(unittest.TestCase):
+    def test_replies_are_not_held_back_by_nagle(self):
+        nodelay = []
+
+        class StandIn(proxy_loadtest.StandInAPI):
+            latency_scale = 0
+
+            def do_POST(self):
+                nodelay.append(self.connection.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+                super().do_POST()
+
+        api = _serve(proxy_loadtest.StandInServer(('127.0.0.1', 0), StandIn))
+        self.addCleanup(api.server_close)
+        self.addCleanup(api.shutdown)
+        connection = http.client.HTTPConnection('127.0.0.1', api.server_address[1], timeout=10)
+        self.addCleanup(connection.close)
+        for _ in range(2):
+            connection.request('POST', '/v1/sessions', body=b'{"project_id": "p"}')
+            response = connection.getresponse()
+            self.assertEqual((response.status, json.loads(response.read())["project_id"]), (200, "p"))
+        self.assertTrue(all(nodelay) and len(nodelay) == 2)
+
+
+class TestCapture(ProxyTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name + '/capture.jsonl'
+        super().setUp()
+
+    def handler_attrs(self):
+        return {"capture": http_proxy.TrafficCapture(self.path)}
+
+    def test_requests_are_captured_with_secrets_redacted(self):
+        RecordingAPI.delay = 0.05
+        self.post('/proxy', self.envelope('/v1/x', '{}', headers={"Authorization": "Bearer secret"}, api_key="k"),
+                  headers={'X-Proxy-Client': 'game-1'})
+        self.handler.capture.close()
+        [record] = proxy_replay.load_capture(self.path)
+        self.assertEqual((record["path"], record["status"], record["headers"]["X-Proxy-Client"]),
+                         ('/proxy', 200, 'game-1'))
+        self.assertEqual((record["payload"]["headers"]["Authorization"], record["payload"]["api_key"]),
+                         ('<redacted>', '<redacted>'))
+        self.assertGreaterEqual(record["ms"], 50)
+
+    def test_each_run_overwrites_the_file(self):
+        self.post('/proxy', self.envelope('/v1/x', '{}'))
+        self.handler.capture.close()
+        capture = http_proxy.TrafficCapture(self.path)
+        capture.close()
+        self.assertEqual(proxy_replay.load_capture(self.path), [])
+
+
+class TestReplay(unittest.TestCase):
+    def test_records_are_retargeted_and_classified(self):
+        envelope = {"url": "https://api.example/v1/sessions/s/agents/a/messages", "body": "{}"}
+        self.assertEqual(proxy_replay.retarget({"steps": [envelope]}, '127.0.0.1:9')["steps"][0]["url"],
+                         'http://127.0.0.1:9/v1/sessions/s/agents/a/messages')
+        self.assertEqual(proxy_replay.classify({"path": '/proxy', "payload": envelope}), 'add_messages')
+        self.assertEqual(proxy_replay.classify({"path": '/agents/a/generate_text', "payload": {}}),
+                         'facade generate_text')
+
+    @unittest.skipIf(http_proxy.aa_async_client is None, "artificial_agency is not installed")
+    def test_replay_drives_envelopes_and_the_facade(self):
+        records = [
+            {"t": 0.0, "path": '/proxy', "headers": {},
+             "payload": {"url": "https://api.example/v1/sessions", "method": "POST",
+                         "headers": {"Authorization": "<redacted>"}, "body": '{"project_id": "p"}'}},
+            {"t": 0.01, "path": '/sessions', "headers": {}, "payload": {"project_id": "p"}},
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            with open(directory + '/capture.jsonl', 'w') as f:
+                f.writelines(json.dumps(record) + '\n' for record in records)
+            with mock.patch.object(proxy_loadtest.StandInAPI, 'latency_scale'), \
+                    mock.patch.object(proxy_replay, 'print', create=True):
+                code = proxy_replay.main([directory + '/capture.jsonl', '--speed', '10', '--latency-scale', '0.01',
+                                          '--json-out', directory + '/report.json'])
+            with open(directory + '/report.json') as f:
+                report = json.load(f)
+        self.assertEqual(code, 0)
+        self.assertEqual({kind: (stats["count"], stats["errors"]) for kind, stats in report["calls"].items()},
+                         {"create_session": (1, 0), "sessions": (1, 0)})
+
+
+class TestChain(ProxyTestCase):
+    def setUp(self):
+        super().setUp()
+        RecordingAPI.reply = lambda method, path, body: (
+            200, {'Content-Type': 'application/json'},
+            json.dumps({"id": path.rsplit('/', 1)[-1] + "_1", "n": 3, "args": {"to": "barn"}}).encode('utf-8'))
+
+    def test_later_steps_use_earlier_responses(self):
+        status, body = self.post('/chain', {"steps": [
+            self.envelope('/v1/sessions', {"project_id": "p"}),
+            self.envelope('/v1/sessions/{{$[0].id}}/agents', '{"count": "{{$[0].n}}", "go": "{{$[0].args}}"}',
+                          headers={"X-Session": "{{ $[0].id }}"}, fields=["id"]),
+        ]})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["results"],
+                         [{"status": 200, "body": {"id": "sessions_1", "n": 3, "args": {"to": "barn"}}},
+                          {"status": 200, "body": {"id": "agents_1"}}])
+        _, path, headers, sent = RecordingAPI.requests[1]
+        self.assertEqual((path, headers['X-Session']), ('/v1/sessions/sessions_1/agents', 'sessions_1'))
+        # A whole-string reference keeps the value's type
+        self.assertEqual(json.loads(sent), {"count": 3, "go": {"to": "barn"}})
+
+    def test_failed_step_stops_the_chain(self):
+        RecordingAPI.reply = (404, {'Content-Type': 'application/json'}, b'{"error": "gone"}')
+        status, body = self.post('/chain', {"steps": [self.envelope('/v1/a'), self.envelope('/v1/b')]})
+        self.assertEqual((status, json.loads(body)["failed_step"]), (502, 0))
+        self.assertEqual(len(RecordingAPI.requests), 1)
+
+    def test_missing_reference_is_a_bad_request(self):
+        status, body = self.post('/chain', {"steps": [self.envelope('/v1/a'),
+                                                      self.envelope('/v1/{{$[0].missing}}')]})
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (400, "invalid_reference"))
+        status, body = self.post('/chain', {"steps": [self.envelope('/v1/{{$[1].id}}')]})
+        self.assertEqual(status, 400)
+
+    def test_malformed_chains_are_rejected(self):
+        self.assertEqual(self.post('/chain', {"steps": []})[0], 400)
+        self.assertEqual(self.post('/chain', {"steps": ["not an envelope"]})[0], 400)
+        self.assertEqual(self.post('/chain', {"steps": [self.envelope('/v1/a')] * 17})[0], 400)
+        self.assertEqual(RecordingAPI.requests, [])
+
+
+class TestTemplates(ProxyTestCase):
+    def handler_attrs(self):
+        return {"templates": http_proxy.TemplateStore(8)}
+
+    def test_bodyless_get_template_sends_no_body(self):
+        url = self.api_url('/v1/services')
+        self.assertEqual(self.post('/templates/services', {"url": url, "method": "GET"})[0], 201)
+
+        self.assertEqual(self.post('/call/services', {}), (200, b'{}'))
+        [(method, path, headers, body)] = RecordingAPI.requests
+        self.assertEqual((method, path, body), ('GET', '/v1/services', b''))
+        self.assertNotIn('Content-Type', headers)
+
+    def test_call_fills_params_and_merges_the_body(self):
+        template = {"url": self.api_url('/v1/sessions/{session_id}/agents/{agent_id}/messages'),
+                    "headers": {"Authorization": "Bearer {token}"},
+                    "body": '{"messages": [], "meta": {"game": "mh", "turn": 0}}'}
+        self.assertEqual(self.post('/templates/add_messages', template)[0], 201)
+
+        status, _ = self.post('/call/add_messages', {"params": {"session_id": "s/1", "agent_id": "a", "token": "t"},
+                                                     "body": {"messages": ["hi"], "meta": {"turn": 4}}})
+        self.assertEqual(status, 200)
+        [(method, path, headers, body)] = RecordingAPI.requests
+        self.assertEqual((method, path, headers['Authorization']),
+                         ('POST', '/v1/sessions/s%2F1/agents/a/messages', 'Bearer t'))
+        self.assertEqual(json.loads(body), {"messages": ["hi"], "meta": {"game": "mh", "turn": 4}})
+
+    def test_unknown_template_and_missing_params(self):
+        status, body = self.post('/call/nope', {})
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (404, "unknown_template"))
+        self.post('/templates/agent', {"url": self.api_url('/v1/agents/{agent_id}')})
+        status, body = self.post('/call/agent', {"params": {}})
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (400, "invalid_request"))
+        self.assertEqual(RecordingAPI.requests, [])
+
+    def test_store_is_bounded(self):
+        for n in range(8):
+            self.assertEqual(self.post(f'/templates/t{n}', {"url": self.api_url('/v1/x')})[0], 201)
+        status, body = self.post('/templates/t8', {"url": self.api_url('/v1/x')})
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (400, "invalid_template"))
+        # Replacing an existing template still works
+        self.assertEqual(self.post('/templates/t0', {"url": self.api_url('/v1/y')})[0], 201)
+
+
+if __name__ == '__main__':
+    unittest.main()